@@ -0,0 +1,174 @@
+"""
+Реестр активных запусков ассистентов.
+
+Пока по треду выполняется запуск, OpenAI не принимает в него новые
+сообщения ("Can't add messages to thread ... while a run is active").
+Запуск, ответ которого уже некому доставить (поток оборвался, обработчик
+упал, ассистент ждёт вызова функции), отменяется в фоне: runs.cancel
+и ограниченный по времени опрос до конечного статуса. Новое сообщение
+в тот же тред сначала дожидается этой отмены. Запуски, о которых
+реестр не знает (остались от прошлого запуска бота), находятся по списку
+запусков треда и тоже отменяются - тред сбрасывается только в крайнем случае.
+"""
+
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, Optional, Set
+
+from openai import BadRequestError
+
+from config_manager import get_assistant_cancel_timeout
+
+# Статусы, в которых запуск занимает тред
+ACTIVE_RUN_STATUSES = {"queued", "in_progress", "requires_action", "cancelling"}
+
+# Период опроса статуса отменяемого запуска (сек)
+RUN_POLL_INTERVAL = 1.0
+
+
+class ActiveRun:
+    """Запуск ассистента, который может занимать тред"""
+
+    __slots__ = ("user_id", "thread_id", "run_id", "status", "cancel_task")
+
+    def __init__(self, user_id: int, thread_id: str):
+        self.user_id = user_id
+        self.thread_id = thread_id
+        self.run_id: Optional[str] = None
+        self.status = "queued"
+        self.cancel_task: Optional[asyncio.Task] = None
+
+    def update(self, run) -> None:
+        """Запоминает id и статус из события запуска"""
+        self.run_id = run.id
+        self.status = run.status
+
+
+# Активные запуски по thread_id
+_active: Dict[str, ActiveRun] = {}
+_cancel_tasks: Set[asyncio.Task] = set()
+_stats = {
+    "started": 0,
+    "orphaned": 0,
+    "cancelled": 0,
+    "waited": 0,
+    "recovered": 0,
+    "unrecovered": 0,
+}
+
+
+async def cancel_run(client, thread_id: str, run_id: str) -> str:
+    """
+    Отменяет запуск и опрашивает его до конечного статуса,
+    но не дольше cancel_timeout. Возвращает последний известный статус.
+    """
+    try:
+        run = await client.beta.threads.runs.cancel(
+            run_id=run_id, thread_id=thread_id
+        )
+    except BadRequestError:
+        # Запуск уже завершился сам
+        run = await client.beta.threads.runs.retrieve(
+            run_id=run_id, thread_id=thread_id
+        )
+
+    deadline = time.monotonic() + get_assistant_cancel_timeout()
+    while run.status in ACTIVE_RUN_STATUSES and time.monotonic() < deadline:
+        await asyncio.sleep(RUN_POLL_INTERVAL)
+        run = await client.beta.threads.runs.retrieve(
+            run_id=run_id, thread_id=thread_id
+        )
+
+    if run.status in ACTIVE_RUN_STATUSES:
+        logging.warning(
+            f"Запуск {run_id} в треде {thread_id} не завершился после отмены: "
+            f"{run.status}"
+        )
+    else:
+        _stats["cancelled"] += 1
+        logging.info(f"Запуск {run_id} в треде {thread_id} отменён: {run.status}")
+    return run.status
+
+
+async def _cancel_orphan(client, active: ActiveRun) -> None:
+    try:
+        active.status = await cancel_run(client, active.thread_id, active.run_id)
+    except Exception as e:
+        logging.error(f"Ошибка отмены запуска {active.run_id}: {e}")
+    finally:
+        if _active.get(active.thread_id) is active:
+            del _active[active.thread_id]
+
+
+@asynccontextmanager
+async def active_run(client, user_id: int, thread_id: str):
+    """
+    Регистрирует запуск в треде на время его потока. Вызывающий код
+    передаёт в ActiveRun.update события запуска; если поток закончился,
+    а запуск ещё занимает тред, он отменяется в фоне.
+    """
+    active = ActiveRun(user_id, thread_id)
+    _active[thread_id] = active
+    _stats["started"] += 1
+    try:
+        yield active
+    finally:
+        if active.run_id is not None and active.status in ACTIVE_RUN_STATUSES:
+            _stats["orphaned"] += 1
+            logging.warning(
+                f"Запуск {active.run_id} пользователя {user_id} остался "
+                f"в статусе {active.status}, отменяем"
+            )
+            task = asyncio.create_task(_cancel_orphan(client, active))
+            active.cancel_task = task
+            _cancel_tasks.add(task)
+            task.add_done_callback(_cancel_tasks.discard)
+        elif _active.get(thread_id) is active:
+            del _active[thread_id]
+
+
+async def settle_thread(thread_id: str) -> None:
+    """Дожидается отмены брошенного запуска в треде перед новым сообщением"""
+    active = _active.get(thread_id)
+    if active is None or active.cancel_task is None:
+        return
+    _stats["waited"] += 1
+    try:
+        await asyncio.wait_for(
+            asyncio.shield(active.cancel_task),
+            timeout=get_assistant_cancel_timeout() + RUN_POLL_INTERVAL,
+        )
+    except asyncio.TimeoutError:
+        logging.warning(f"Не дождались отмены запуска в треде {thread_id}")
+
+
+async def recover_thread(client, thread_id: str) -> bool:
+    """
+    Отменяет незавершённые запуски треда, о которых реестр не знает.
+    Возвращает True, если тред освободился и в него можно писать.
+    """
+    await settle_thread(thread_id)
+    runs = await client.beta.threads.runs.list(thread_id=thread_id, limit=5)
+    free = True
+    for run in runs.data:
+        if run.status not in ACTIVE_RUN_STATUSES:
+            continue
+        logging.warning(f"Тред {thread_id} занят запуском {run.id} ({run.status})")
+        if await cancel_run(client, thread_id, run.id) in ACTIVE_RUN_STATUSES:
+            free = False
+
+    _stats["recovered" if free else "unrecovered"] += 1
+    return free
+
+
+async def stop_active_runs() -> None:
+    """Дожидается фоновых отмен при остановке бота"""
+    if _cancel_tasks:
+        await asyncio.gather(*_cancel_tasks, return_exceptions=True)
+
+
+def run_stats() -> dict:
+    """Счётчики запусков: начато, брошено, отменено, восстановлено тредов"""
+    return {**_stats, "active": len(_active)}
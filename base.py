@@ -1,156 +1,661 @@
-import json
+import asyncio
+import itertools
 import logging
+import time
 from collections import OrderedDict
-from typing import Dict
+from datetime import datetime
+from typing import Callable, Dict, Iterable, Optional, Set
 
-from sqlalchemy import select
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy import select, delete, func, bindparam, text
+from sqlalchemy.dialects.sqlite import dialect as sqlite_dialect
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
-from classes import SessionLocal, UserDataModel
+from classes import (
+    SessionLocal,
+    UserDataModel,
+    MessageModel,
+    SummaryModel,
+    UserSettings,
+    History,
+)
+from config_manager import (
+    get_flush_interval_ms,
+    get_flush_batch_size,
+    get_cache_max_bytes,
+    get_cache_idle_ttl,
+)
 
-# Локальный кэш с ограничением размера
-# Используем OrderedDict для LRU-поведения
-_MAX_CACHE_SIZE = 1000  # Максимальное количество пользователей в кэше
-users_data: Dict[int, dict] = OrderedDict()
 
+class UserCache:
+    """
+    LRU-кэш историй пользователей с ограничением по оценочному объёму
+    в байтах и по времени простоя записи. Ведёт статистику попаданий,
+    промахов, вытеснений и занятого объёма.
+    """
+
+    def __init__(self, max_bytes: int, idle_ttl: float) -> None:
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self._entries: "OrderedDict[int, History]" = OrderedDict()
+        self._sizes: Dict[int, int] = {}
+        self._last_access: Dict[int, float] = {}
+        self.resident_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Признак того, что историю сейчас использует обработчик:
+        # такие записи не вытесняются, иначе его изменения потеряются
+        self.in_use: Callable[[int], bool] = lambda user_id: False
+        # Пользователи, запись которых сейчас идёт: при ошибке commit
+        # они возвращаются в очередь, и история должна остаться в кэше
+        self.flushing: Set[int] = set()
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, user_id: int) -> Optional[History]:
+        """Возвращает запись без учёта в статистике и LRU-порядке"""
+        return self._entries.get(user_id)
+
+    def lookup(self, user_id: int) -> Optional[History]:
+        """Возвращает запись, обновляя LRU-порядок и статистику"""
+        messages = self._entries.get(user_id)
+        if messages is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._entries.move_to_end(user_id)
+        self._last_access[user_id] = time.monotonic()
+        return messages
+
+    def put(self, user_id: int, messages: History) -> None:
+        self._entries[user_id] = messages
+        self._entries.move_to_end(user_id)
+        self._last_access[user_id] = time.monotonic()
+        self.resize(user_id)
+
+    def resize(self, user_id: int) -> None:
+        """Пересчитывает оценку объёма записи после её изменения"""
+        messages = self._entries.get(user_id)
+        if messages is None:
+            return
+        new_size = messages.memory_size()
+        self.resident_bytes += new_size - self._sizes.get(user_id, 0)
+        self._sizes[user_id] = new_size
+
+    def pop(self, user_id: int) -> Optional[History]:
+        self.resident_bytes -= self._sizes.pop(user_id, 0)
+        self._last_access.pop(user_id, None)
+        return self._entries.pop(user_id, None)
+
+    def eviction_candidate(self) -> Optional[int]:
+        """
+        Возвращает пользователя для вытеснения: самого давнего из неиспользуемых,
+        если превышен бюджет памяти или истёк срок простоя.
+        Последнюю запись не вытесняем.
+        """
+        if len(self._entries) <= 1:
+            return None
+        over_budget = self.resident_bytes > self.max_bytes
+        now = time.monotonic()
+        for user_id in itertools.islice(self._entries, len(self._entries) - 1):
+            if self.in_use(user_id) or user_id in self.flushing:
+                continue
+            if over_budget or now - self._last_access[user_id] > self.idle_ttl:
+                return user_id
+            # Остальные записи обращались позже - срок простоя у них не истёк
+            return None
+        return None
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "resident_bytes": self.resident_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+# Настройки пользователей: маленькие записи, всегда находятся в кэше
+users_data: Dict[int, UserSettings] = {}
+
+# Истории сообщений: загружаются лениво, кэш ограничен по памяти
+# и времени простоя
+users_history = UserCache(get_cache_max_bytes(), get_cache_idle_ttl())
+
+# Состояние синхронизации истории с таблицей messages:
+# list - объект истории в кэше, persisted - сколько её сообщений
+# уже записано, next_seq - порядковый номер следующего сообщения,
+# max_tokens - лимит контекста, под который загружен хвост истории
+_history_sync: Dict[int, dict] = {}
 
-def _manage_cache_size() -> None:
+# Отложенная запись (write-behind): изменённые пользователи
+# сохраняются фоновой задачей пакетами в одной транзакции
+_dirty_users: Set[int] = set()
+_flush_event = asyncio.Event()
+_flush_lock = asyncio.Lock()
+_flusher_task: Optional[asyncio.Task] = None
+
+
+async def _manage_cache_size() -> None:
     """
-    Управляет размером кэша, удаляя самые старые записи при превышении лимита.
+    Вытесняет из кэша давние истории при превышении бюджета памяти
+    и истории, простаивающие дольше idle_ttl.
+    Несохранённые изменения записываются в БД до удаления записи.
     """
-    while len(users_data) > _MAX_CACHE_SIZE:
-        # Удаляем самую старую запись (первую в OrderedDict)
-        oldest_user_id = next(iter(users_data))
-        users_data.pop(oldest_user_id)
-        logging.info(f"Удален из кэша пользователь {oldest_user_id} (кэш переполнен)")
+    while (user_id := users_history.eviction_candidate()) is not None:
+        if user_id in _dirty_users:
+            try:
+                await flush_user_data([user_id])
+            except Exception as e:
+                # Несохранённую историю не вытесняем, повторим позже
+                logging.error(
+                    f"Не удалось сохранить историю пользователя {user_id} "
+                    f"перед вытеснением: {e}"
+                )
+                return
+            # Пока шла запись, к пользователю могли обратиться снова
+            if users_history.eviction_candidate() != user_id:
+                continue
+            if user_id in _dirty_users:
+                return
+        users_history.pop(user_id)
+        _history_sync.pop(user_id, None)
+        users_history.evictions += 1
+        logging.info(f"Удалена из кэша история пользователя {user_id}")
+
 
+def cache_stats() -> dict:
+    """Возвращает статистику кэша историй пользователей"""
+    return users_history.stats()
 
-async def get_or_create_user_data(user_id: int):
+
+async def get_or_create_user_data(user_id: int) -> UserSettings:
     """
-    Возвращает словарь-данные пользователя, либо создаёт запись в БД, если её нет.
-    Если возникает гонка при создании, обрабатываем IntegrityError и повторно получаем запись.
+    Возвращает настройки пользователя, либо создаёт запись в БД, если её нет.
+    Создание и чтение записи выполняются одним UPSERT-запросом,
+    поэтому гонка при одновременном создании невозможна.
     """
-    # Если пользователь уже в кэше, перемещаем его в конец (LRU)
-    if user_id in users_data:
-        # Перемещаем в конец для LRU-поведения
-        users_data.move_to_end(user_id)
-        return users_data[user_id]
+    # Настройки пользователя всегда остаются в кэше
+    cached = users_data.get(user_id)
+    if cached is not None:
+        return cached
 
     str_user_id = str(user_id)
     try:
         async with SessionLocal() as session:
-            stmt = select(UserDataModel).where(UserDataModel.user_id == str_user_id)
-            result = await session.execute(stmt)
-            user_db_obj = result.scalars().first()
-
-            if not user_db_obj:
-                user_db_obj = UserDataModel(user_id=str_user_id)
-                session.add(user_db_obj)
-                try:
-                    await session.commit()
-                except IntegrityError:
-                    await session.rollback()
-                    result = await session.execute(stmt)
-                    user_db_obj = result.scalars().first()
-                    if not user_db_obj:
-                        user_db_obj = UserDataModel(user_id=str_user_id)
-                        session.add(user_db_obj)
-                        await session.commit()
-
-                if user_db_obj is None:
-                    raise RuntimeError(
-                        "Не удалось создать или найти пользователя в БД."
-                    )
-
-                await session.refresh(user_db_obj)
-
-            user_data_dict = user_db_obj.to_dict()
-
-            # Добавляем в кэш и управляем его размером
-            users_data[user_id] = user_data_dict
-            _manage_cache_size()
-
-            return user_data_dict
+            user_db_obj = await upsert_user(session, str_user_id)
+            await session.commit()
+
+        user_settings = user_db_obj.to_settings()
+        users_data[user_id] = user_settings
+        return user_settings
 
     except Exception as e:
         logging.error(f"Ошибка при получении данных пользователя {user_id}: {e}")
         raise
 
 
+async def get_user_history(user_id: int) -> History:
+    """
+    Возвращает историю сообщений пользователя, загружая её лениво.
+    Из БД читается только хвост, который помещается в контекст (max_tokens).
+    Если с момента загрузки лимит контекста вырос (сменилась модель),
+    история загружается заново с новым лимитом.
+    """
+    user_settings = await get_or_create_user_data(user_id)
+
+    # Если история уже в кэше, она перемещается в конец (LRU)
+    cached = users_history.lookup(user_id)
+    if cached is not None:
+        loaded_tokens = _history_sync.get(user_id, {}).get("max_tokens")
+        if loaded_tokens is None or user_settings.max_tokens <= loaded_tokens:
+            return cached
+
+        # Несохранённые сообщения записываются до повторной загрузки
+        _dirty_users.add(user_id)
+        try:
+            await flush_user_data([user_id])
+        except Exception:
+            return cached
+        if users_history.get(user_id) is not cached or user_id in _dirty_users:
+            # Историю могли очистить, пока шла запись: пустая History ложна
+            current = users_history.get(user_id)
+            return cached if current is None else current
+        users_history.pop(user_id)
+        _history_sync.pop(user_id, None)
+        logging.info(
+            f"Лимит контекста пользователя {user_id} вырос до "
+            f"{user_settings.max_tokens}, история загружается заново"
+        )
+
+    try:
+        async with SessionLocal() as session:
+            messages, next_seq = await _load_history_tail(
+                session, str(user_id), user_settings.max_tokens
+            )
+    except Exception as e:
+        logging.error(f"Ошибка при загрузке истории пользователя {user_id}: {e}")
+        raise
+
+    # Историю могли загрузить параллельно, пока шёл запрос
+    cached = users_history.get(user_id)
+    if cached is not None:
+        return cached
+
+    _history_sync[user_id] = {
+        "list": messages,
+        "persisted": len(messages),
+        "next_seq": next_seq,
+        # Лимит контекста, под который загружен хвост истории
+        "max_tokens": user_settings.max_tokens,
+    }
+
+    # Добавляем в кэш и управляем его размером
+    users_history.put(user_id, messages)
+    await _manage_cache_size()
+
+    return messages
+
+
+async def clear_user_history(user_id: int) -> History:
+    """
+    Очищает историю сообщений пользователя.
+    Старые строки удаляются из БД при следующей записи.
+    """
+    await get_or_create_user_data(user_id)
+
+    messages = History()
+    sync_state = _history_sync.setdefault(
+        user_id, {"list": None, "persisted": 0, "next_seq": 0}
+    )
+    # Другой объект списка - признак замены истории для _sync_history
+    sync_state["list"] = None
+    users_history.put(user_id, messages)
+    await save_user_data(user_id)
+    return messages
+
+
 async def save_user_data(user_id: int) -> None:
     """
-    Сохраняем изменения из локального кэша в БД.
+    Помечает данные пользователя как изменённые.
+    Запись в БД выполняет фоновая задача пакетами (write-behind);
+    если она не запущена, данные сохраняются сразу.
     """
-    user_data_dict = users_data.get(user_id)
-    if not user_data_dict:
+    if user_id not in users_data:
         logging.warning(
             f"Попытка сохранить данные пользователя {user_id}, но он не найден в кэше"
         )
         return
 
-    str_user_id = str(user_id)
+    _dirty_users.add(user_id)
+    users_history.resize(user_id)
+
+    if _flusher_task is None or _flusher_task.done():
+        await flush_user_data()
+    elif len(_dirty_users) >= get_flush_batch_size():
+        _flush_event.set()
+
+
+async def flush_user_data(user_ids: Optional[Iterable[int]] = None) -> None:
+    """
+    Записывает изменённых пользователей в БД одной транзакцией.
+    Если user_ids не указан, сохраняются все изменённые пользователи.
+    """
+    async with _flush_lock:
+        if user_ids is None:
+            batch = set(_dirty_users)
+        else:
+            batch = _dirty_users.intersection(user_ids)
+        if not batch:
+            return
+
+        _dirty_users.difference_update(batch)
+        # Пока идёт запись, истории пакета не вытесняются из кэша
+        users_history.flushing.update(batch)
+        try:
+            await _write_batch(batch)
+        finally:
+            users_history.flushing.difference_update(batch)
+
+
+async def _write_batch(batch: Set[int]) -> None:
     try:
-        async with SessionLocal() as session:
-            stmt = select(UserDataModel).where(UserDataModel.user_id == str_user_id)
-            result = await session.execute(stmt)
-            user_db_obj = result.scalars().first()
-
-            if user_db_obj:
-                # Обновляем поля
-                user_db_obj.model = user_data_dict["model"]
-                user_db_obj.model_message_info = user_data_dict["model_message_info"]
-                user_db_obj.model_message_chat = user_data_dict["model_message_chat"]
-                user_db_obj.messages = json.dumps(user_data_dict["messages"])
-                user_db_obj.count_messages = user_data_dict["count_messages"]
-                user_db_obj.max_out = user_data_dict["max_out"]
-                user_db_obj.voice_answer = user_data_dict["voice_answer"]
-                user_db_obj.system_message = user_data_dict["system_message"]
-                user_db_obj.pic_grade = user_data_dict["pic_grade"]
-                user_db_obj.pic_size = user_data_dict["pic_size"]
-
-                # Поля для ассистентов
-                user_db_obj.assistant_thread_id = user_data_dict["assistant_thread_id"]
-                user_db_obj.assistant_thread_id_2 = user_data_dict[
-                    "assistant_thread_id_2"
-                ]
-                user_db_obj.assistant_thread_id_3 = user_data_dict[
-                    "assistant_thread_id_3"
-                ]
-                user_db_obj.current_assistant = user_data_dict["current_assistant"]
-
-                # ID ассистентов
-                user_db_obj.assistant_id_1 = user_data_dict["assistant_id_1"]
-                user_db_obj.assistant_id_2 = user_data_dict["assistant_id_2"]
-                user_db_obj.assistant_id_3 = user_data_dict["assistant_id_3"]
+        await _commit_users(batch)
+        return
+    except Exception as e:
+        if len(batch) == 1:
+            # Возвращаем пользователя в очередь, чтобы повторить запись позже
+            _dirty_users.update(batch)
+            logging.error(f"Ошибка при сохранении данных пользователя {batch}: {e}")
+            raise
+        logging.warning(
+            f"Ошибка при пакетном сохранении пользователей {batch}: {e}, "
+            f"сохраняем по одному"
+        )
 
-                await session.commit()
-            else:
-                # Если записи нет - создаём
-                new_obj = UserDataModel(
-                    user_id=str_user_id,
-                    model=user_data_dict["model"],
-                    model_message_info=user_data_dict["model_message_info"],
-                    model_message_chat=user_data_dict["model_message_chat"],
-                    messages=json.dumps(user_data_dict["messages"]),
-                    count_messages=user_data_dict["count_messages"],
-                    max_out=user_data_dict["max_out"],
-                    voice_answer=user_data_dict["voice_answer"],
-                    system_message=user_data_dict["system_message"],
-                    pic_grade=user_data_dict["pic_grade"],
-                    pic_size=user_data_dict["pic_size"],
-                    # Поля для ассистентов
-                    assistant_thread_id=user_data_dict["assistant_thread_id"],
-                    assistant_thread_id_2=user_data_dict["assistant_thread_id_2"],
-                    assistant_thread_id_3=user_data_dict["assistant_thread_id_3"],
-                    current_assistant=user_data_dict["current_assistant"],
-                    # ID ассистентов
-                    assistant_id_1=user_data_dict["assistant_id_1"],
-                    assistant_id_2=user_data_dict["assistant_id_2"],
-                    assistant_id_3=user_data_dict["assistant_id_3"],
+    # Пользователь с ошибкой не должен блокировать запись остальных
+    error = None
+    for user_id in batch:
+        try:
+            await _commit_users([user_id])
+        except Exception as e:
+            error = e
+            _dirty_users.add(user_id)
+            logging.error(f"Ошибка при сохранении данных пользователя {user_id}: {e}")
+    if error is not None:
+        raise error
+
+
+async def _commit_users(user_ids: Iterable[int]) -> None:
+    """
+    Записывает пользователей одной транзакцией. Состояние синхронизации
+    историй обновляется только после успешного commit.
+    """
+    async with SessionLocal() as session:
+        sync_states = []
+        for user_id in user_ids:
+            sync_state = await _write_user(session, user_id)
+            if sync_state is not None:
+                sync_states.append(sync_state)
+
+        await session.commit()
+
+    for sync_state in sync_states:
+        sync_state["list"] = sync_state.pop("pending_list")
+        sync_state["persisted"] = sync_state["pending_persisted"]
+        sync_state["next_seq"] = sync_state["pending_seq"]
+
+
+async def _flush_loop() -> None:
+    """
+    Фоновая задача: сбрасывает изменения каждые flush_interval_ms
+    или сразу после набора flush_batch_size изменённых пользователей.
+    """
+    interval = get_flush_interval_ms() / 1000
+    while True:
+        try:
+            await asyncio.wait_for(_flush_event.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
+        _flush_event.clear()
+
+        try:
+            await flush_user_data()
+            # Заодно вытесняем записи с истёкшим сроком простоя
+            await _manage_cache_size()
+        except Exception:
+            # Ошибка уже залогирована, пользователи остались в очереди
+            pass
+
+
+def start_write_behind() -> None:
+    """Запускает фоновую задачу отложенной записи"""
+    global _flusher_task
+    if _flusher_task is None or _flusher_task.done():
+        _flush_event.clear()
+        _flusher_task = asyncio.create_task(_flush_loop())
+
+
+async def stop_write_behind() -> None:
+    """Останавливает фоновую задачу и сохраняет все оставшиеся изменения"""
+    global _flusher_task
+    if _flusher_task is not None:
+        _flusher_task.cancel()
+        try:
+            await _flusher_task
+        except asyncio.CancelledError:
+            pass
+        _flusher_task = None
+
+    await flush_user_data()
+
+
+# Скомпилированные UPSERT-запросы по набору обновляемых колонок
+_upsert_statements: Dict[tuple, object] = {}
+
+
+def _upsert_statement(update_columns: tuple):
+    """
+    Возвращает UPSERT-запрос для таблицы users_data.
+    Конструкция ON CONFLICT не кэшируется SQLAlchemy и компилировалась бы
+    при каждом вызове, поэтому компилируем её один раз и храним как text().
+    """
+    statement = _upsert_statements.get(update_columns)
+    if statement is None:
+        table = UserDataModel.__table__
+        stmt = sqlite_insert(table).values(
+            {column.name: bindparam(column.name) for column in table.columns}
+        )
+        if update_columns:
+            set_ = {name: stmt.excluded[name] for name in update_columns}
+        else:
+            # Пустое обновление нужно, чтобы RETURNING вернул существующую строку
+            set_ = {"user_id": stmt.excluded.user_id}
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.user_id], set_=set_
+        ).returning(*table.columns)
+
+        sql = str(stmt.compile(dialect=sqlite_dialect(paramstyle="named")))
+        statement = select(UserDataModel).from_statement(
+            text(sql).columns(*table.columns)
+        )
+        _upsert_statements[update_columns] = statement
+    return statement
+
+
+# Значения по умолчанию для новой записи users_data
+_USER_DEFAULTS = {
+    column.name: column.default.arg
+    for column in UserDataModel.__table__.columns
+    if column.default is not None
+}
+
+
+async def upsert_user(
+    session, str_user_id: str, values: Optional[dict] = None
+) -> UserDataModel:
+    """
+    Создаёт или обновляет запись пользователя одним запросом
+    INSERT ... ON CONFLICT DO UPDATE ... RETURNING.
+    Без values существующая запись не меняется и просто возвращается.
+    """
+    values = values or {}
+    params = {**_USER_DEFAULTS, **values, "user_id": str_user_id}
+    result = await session.execute(
+        _upsert_statement(tuple(values)),
+        params,
+        execution_options={"populate_existing": True},
+    )
+    return result.scalars().one()
+
+
+async def _write_user(session, user_id: int) -> Optional[dict]:
+    """
+    Добавляет в сессию запись настроек пользователя и новых сообщений
+    (если история загружена). Возвращает состояние синхронизации истории.
+    """
+    user_settings = users_data.get(user_id)
+    if user_settings is not None:
+        await upsert_user(session, str(user_id), user_settings.column_values())
+
+    messages = users_history.get(user_id)
+    if messages is None:
+        return None
+
+    # Дописываем в таблицу messages только новые сообщения
+    return await _sync_history(session, user_id, messages)
+
+
+async def _load_history_tail(session, str_user_id: str, max_tokens: int):
+    """
+    Загружает последние сообщения пользователя, суммарная стоимость которых
+    укладывается в max_tokens (плюс одно сообщение, попадающее на границу).
+    Сообщения, покрытые кратким содержанием, не загружаются.
+    Возвращает список сообщений и порядковый номер следующего сообщения.
+    """
+    summary = await session.get(SummaryModel, str_user_id)
+    covered_seq = summary.covered_seq if summary is not None else 0
+
+    tail_tokens = (
+        func.sum(MessageModel.tokens)
+        .over(order_by=MessageModel.seq.desc())
+        .label("tail_tokens")
+    )
+    ranked = (
+        select(
+            MessageModel.seq,
+            MessageModel.role,
+            MessageModel.content,
+            MessageModel.tokens,
+            tail_tokens,
+        )
+        .where(
+            MessageModel.user_id == str_user_id,
+            MessageModel.seq >= covered_seq,
+        )
+        .subquery()
+    )
+    stmt = (
+        select(ranked.c.seq, ranked.c.role, ranked.c.content, ranked.c.tokens)
+        .where(ranked.c.tail_tokens - ranked.c.tokens < max_tokens)
+        .order_by(ranked.c.seq)
+    )
+    rows = (await session.execute(stmt)).all()
+
+    if rows:
+        next_seq = rows[-1].seq + 1
+    else:
+        last_seq = await session.scalar(
+            select(func.max(MessageModel.seq)).where(
+                MessageModel.user_id == str_user_id
+            )
+        )
+        next_seq = 0 if last_seq is None else last_seq + 1
+
+    messages = History()
+    for row in rows:
+        messages.add(row.role, row.content, row.tokens)
+    if summary is not None:
+        messages.set_summary(summary.content, 0)
+    return messages, next_seq
+
+
+async def save_history_summary(
+    user_id: int, messages: History, summary: str, index: int
+) -> bool:
+    """
+    Сохраняет краткое содержание сообщений истории до index.
+    Если история за это время была очищена или вытеснена из кэша,
+    краткое содержание отбрасывается. Возвращает признак сохранения.
+    """
+    # Под блокировкой записи: seq сообщений и замена истории
+    # не меняются, пока сохраняется краткое содержание
+    async with _flush_lock:
+        sync_state = _history_sync.get(user_id)
+        if users_history.get(user_id) is not messages or sync_state is None:
+            return False
+        if sync_state["list"] is not messages:
+            return False
+
+        # seq сообщения с индексом i: next_seq - persisted + i
+        covered_seq = sync_state["next_seq"] - sync_state["persisted"] + index
+        try:
+            async with SessionLocal() as session:
+                stmt = sqlite_insert(SummaryModel).values(
+                    user_id=str(user_id),
+                    content=summary,
+                    covered_seq=covered_seq,
+                    updated_at=datetime.utcnow(),
+                )
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=[SummaryModel.user_id],
+                    set_={
+                        "content": stmt.excluded.content,
+                        "covered_seq": stmt.excluded.covered_seq,
+                        "updated_at": stmt.excluded.updated_at,
+                    },
                 )
-                session.add(new_obj)
+                await session.execute(stmt)
                 await session.commit()
+        except Exception as e:
+            logging.error(
+                f"Ошибка при сохранении краткого содержания пользователя {user_id}: {e}"
+            )
+            return False
 
-    except Exception as e:
-        logging.error(f"Ошибка при сохранении данных пользователя {user_id}: {e}")
-        raise
+        messages.set_summary(summary, index)
+        users_history.resize(user_id)
+        return True
+
+
+async def load_full_history(user_id: int) -> list:
+    """
+    Возвращает полную историю пользователя из таблицы messages
+    (для просмотра контекста).
+    """
+    # Дописываем несохранённые сообщения, чтобы история была полной
+    await flush_user_data([user_id])
+
+    async with SessionLocal() as session:
+        stmt = (
+            select(MessageModel.role, MessageModel.content)
+            .where(MessageModel.user_id == str(user_id))
+            .order_by(MessageModel.seq)
+        )
+        rows = (await session.execute(stmt)).all()
+
+    return [{"role": row.role, "content": row.content} for row in rows]
+
+
+async def _sync_history(session, user_id: int, messages: History) -> dict:
+    """
+    Добавляет в сессию вставку новых сообщений пользователя.
+    Если история была очищена или заменена, удаляет старые строки.
+    """
+    str_user_id = str(user_id)
+    sync_state = _history_sync.setdefault(
+        user_id, {"list": messages, "persisted": 0, "next_seq": 0}
+    )
+
+    persisted = sync_state["persisted"]
+    next_seq = sync_state["next_seq"]
+    if sync_state["list"] is not messages or len(messages) < persisted:
+        # История заменена новым списком - начинаем её заново.
+        # Состояние сбрасывается только после commit: если транзакция
+        # не пройдёт, повторная запись снова удалит старые строки
+        await session.execute(
+            delete(MessageModel).where(MessageModel.user_id == str_user_id)
+        )
+        await session.execute(
+            delete(SummaryModel).where(SummaryModel.user_id == str_user_id)
+        )
+        persisted = 0
+        next_seq = 0
+
+    pending = len(messages)
+    now = datetime.utcnow()
+    for index in range(persisted, pending):
+        session.add(
+            MessageModel(
+                user_id=str_user_id,
+                seq=next_seq + index - persisted,
+                role=messages.role(index),
+                content=messages.content(index),
+                chars=len(messages.content(index)),
+                tokens=messages.tokens(index),
+                created_at=now,
+            )
+        )
+
+    # Фиксируем, что будет записано, на момент формирования транзакции:
+    # пока идёт commit, в историю могут добавиться новые сообщения
+    sync_state["pending_list"] = messages
+    sync_state["pending_persisted"] = pending
+    sync_state["pending_seq"] = next_seq + pending - persisted
+    return sync_state
@@ -0,0 +1,84 @@
+"""
+Бенчмарк построения окна контекста на один ход диалога:
+прежний prune_messages (проход с конца + insert(0, system))
+против History.context_window на нарастающих суммах длин.
+
+Запуск из корня проекта:
+    python benchmarks/bench_context_window.py [бюджет в токенах]
+"""
+
+import random
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from classes import History
+
+HISTORY_SIZES = (100, 1_000, 10_000, 100_000)
+SYSTEM = {"role": "system", "content": "Ты полезный ассистент."}
+
+
+def legacy_prune(messages, max_chars):
+    """Прежняя реализация prune_messages из function.py"""
+    pruned_messages = []
+    total_chars = 0
+    for message in reversed(messages):
+        content_length = len(message["content"])
+        remaining_chars = max_chars - total_chars
+        if remaining_chars <= 0:
+            break
+        if content_length > remaining_chars:
+            pruned_content = message["content"][:remaining_chars]
+            pruned_messages.append({"role": message["role"], "content": pruned_content})
+            break
+        pruned_messages.append(message)
+        total_chars += content_length
+    return list(reversed(pruned_messages))
+
+
+def make_history(count: int) -> History:
+    random.seed(count)
+    history = History()
+    for index in range(count):
+        history.add(
+            "user" if index % 2 == 0 else "assistant",
+            "слово " * random.randint(5, 200),
+        )
+    return history
+
+
+def legacy_turn(history: History, budget: int) -> list:
+    history.add("user", "новый вопрос")
+    # Прежний лимит задавался в символах (~4 символа на токен)
+    messages = legacy_prune(history, budget * 4)
+    messages.insert(0, SYSTEM)
+    return messages
+
+
+def window_turn(history: History, budget: int) -> list:
+    history.add("user", "новый вопрос")
+    return history.context_window(budget, system=SYSTEM)
+
+
+def main(budget: int) -> None:
+    print(f"Бюджет окна: {budget} токенов")
+    print(
+        f"{'сообщений':>10} {'prune_messages, мкс':>20} "
+        f"{'context_window, мкс':>20}"
+    )
+    number = 50
+    for count in HISTORY_SIZES:
+        results = []
+        for turn in (legacy_turn, window_turn):
+            history = make_history(count)
+            elapsed = min(
+                timeit.repeat(lambda: turn(history, budget), number=number, repeat=3)
+            )
+            results.append(elapsed / number * 1e6)
+        print(f"{count:>10} {results[0]:>20.1f} {results[1]:>20.1f}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 60000)
@@ -0,0 +1,104 @@
+"""
+Бенчмарк кодека истории: прежний json.dumps/json.loads всей истории
+против history_codec (блок целиком и построчно, как в таблице messages).
+Измеряются время кодирования/декодирования и размер на диске.
+
+Запуск из корня проекта:
+    python benchmarks/bench_history_codec.py
+"""
+
+import json
+import random
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import history_codec
+from history_codec import decode_history, decode_text, encode_history, encode_text
+
+SIZES = (10_000, 100_000, 750_000)
+
+WORDS = (
+    "модель ответ запрос контекст сообщение пользователь данные функция "
+    "пример код файл список результат ошибка можно нужно если чтобы это "
+    "the model answer request context message user data function example "
+    "code file list result error can should if that this is of and for"
+).split()
+
+
+def make_history(total_chars: int) -> list:
+    """Генерирует историю примерно заданной длины из случайных фраз"""
+    random.seed(total_chars)
+    messages = []
+    size = 0
+    index = 0
+    while size < total_chars:
+        words = random.randint(3, 15) if index % 2 == 0 else random.randint(40, 300)
+        content = " ".join(random.choice(WORDS) for _ in range(words)) + "."
+        messages.append(
+            {"role": "user" if index % 2 == 0 else "assistant", "content": content}
+        )
+        size += len(content)
+        index += 1
+    return messages
+
+
+def best(func, number: int = 5) -> float:
+    return min(timeit.repeat(func, number=number, repeat=3)) / number
+
+
+def row_size(value) -> int:
+    return len(value.encode("utf-8")) if isinstance(value, str) else len(value)
+
+
+def main() -> None:
+    print(
+        f"orjson: {history_codec.orjson is not None}, "
+        f"msgpack: {history_codec.msgpack is not None}, "
+        f"zstandard: {history_codec.zstandard is not None}"
+    )
+    print(
+        f"{'символов':>9} {'формат':<22} {'байт':>10} {'сжатие':>7} "
+        f"{'encode, мс':>11} {'decode, мс':>11}"
+    )
+
+    for total_chars in SIZES:
+        messages = make_history(total_chars)
+
+        legacy = json.dumps(messages)
+        block = encode_history(messages)
+        rows = [encode_text(message["content"]) for message in messages]
+        legacy_bytes = len(legacy.encode("utf-8"))
+
+        results = [
+            (
+                "json (прежний)",
+                legacy_bytes,
+                best(lambda: json.dumps(messages)),
+                best(lambda: json.loads(legacy)),
+            ),
+            (
+                "codec, блок",
+                len(block),
+                best(lambda: encode_history(messages)),
+                best(lambda: decode_history(block)),
+            ),
+            (
+                "codec, по строкам",
+                sum(row_size(value) for value in rows),
+                best(lambda: [encode_text(m["content"]) for m in messages]),
+                best(lambda: [decode_text(value) for value in rows]),
+            ),
+        ]
+        for title, size, encode_time, decode_time in results:
+            print(
+                f"{total_chars:>9} {title:<22} {size:>10} "
+                f"{legacy_bytes / size:>6.2f}x "
+                f"{encode_time * 1000:>11.2f} {decode_time * 1000:>11.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Бенчмарк скачивания медиафайла: новая aiohttp.ClientSession на каждый
+запрос (TCP + TLS рукопожатие каждый раз) против общей сессии
+из http_manager, которая держит соединение открытым.
+
+По умолчанию поднимается локальный HTTPS сервер с самоподписанным
+сертификатом (нужна утилита openssl). Можно указать реальный URL:
+    python benchmarks/bench_http_handshake.py [количество запросов] [URL]
+"""
+
+import asyncio
+import ssl
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import aiohttp
+from aiohttp import web
+
+from http_manager import close_http_clients, get_http_session, http_pool_stats
+
+# Размер «изображения», которое отдаёт локальный сервер
+PAYLOAD = b"\xff" * 64 * 1024
+
+
+async def start_local_server(workdir: Path):
+    cert, key = workdir / "cert.pem", workdir / "key.pem"
+    subprocess.run(
+        [
+            "openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes",
+            "-keyout", str(key), "-out", str(cert), "-days", "1",
+            "-subj", "/CN=localhost",
+        ],
+        check=True,
+        capture_output=True,
+    )
+    server_ssl = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    server_ssl.load_cert_chain(cert, key)
+
+    async def handle(request):
+        return web.Response(body=PAYLOAD)
+
+    app = web.Application()
+    app.router.add_get("/file", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0, ssl_context=server_ssl)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    client_ssl = ssl.create_default_context(cafile=str(cert))
+    client_ssl.check_hostname = False
+    return runner, f"https://127.0.0.1:{port}/file", client_ssl
+
+
+async def fresh_session(url: str, ssl_context) -> None:
+    """Прежний путь: новая сессия (и новое соединение) на каждый файл"""
+    async with aiohttp.ClientSession() as session:
+        async with session.get(url, ssl=ssl_context) as response:
+            await response.read()
+
+
+async def shared_session(url: str, ssl_context) -> None:
+    async with get_http_session().get(url, ssl=ssl_context) as response:
+        await response.read()
+
+
+async def measure(fetch, url: str, ssl_context, count: int) -> list:
+    timings = []
+    for _ in range(count):
+        started = time.perf_counter()
+        await fetch(url, ssl_context)
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+async def main(count: int, url: str = "") -> None:
+    runner = None
+    ssl_context = None
+    with tempfile.TemporaryDirectory() as workdir:
+        if not url:
+            runner, url, ssl_context = await start_local_server(Path(workdir))
+        print(f"URL: {url}, запросов: {count}")
+
+        # Прогрев: DNS и первое соединение общей сессии
+        await shared_session(url, ssl_context)
+
+        fresh = await measure(fresh_session, url, ssl_context, count)
+        shared = await measure(shared_session, url, ssl_context, count)
+
+        print(f"{'':>22} {'p50, мс':>10} {'p95, мс':>10}")
+        for name, timings in (("новая сессия", fresh), ("общая сессия", shared)):
+            p95 = statistics.quantiles(timings, n=20)[-1]
+            print(f"{name:>22} {statistics.median(timings):>10.2f} {p95:>10.2f}")
+        saved = statistics.median(fresh) - statistics.median(shared)
+        print(f"Экономия на рукопожатии: {saved:.2f} мс на запрос")
+        print(f"Пул: {http_pool_stats()['telegram']}")
+
+        await close_http_clients()
+        if runner is not None:
+            await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(
+        main(
+            int(sys.argv[1]) if len(sys.argv) > 1 else 200,
+            sys.argv[2] if len(sys.argv) > 2 else "",
+        )
+    )
@@ -0,0 +1,99 @@
+"""
+Бенчмарк представления пользователя в кэше: прежние словари
+(17 ключей настроек + список словарей сообщений) против UserSettings
+со __slots__ и компактной History.
+
+Запуск из корня проекта:
+    python benchmarks/bench_user_state.py [пользователей] [сообщений]
+"""
+
+import random
+import sys
+import timeit
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from classes import History, UserSettings
+
+SHORT_REPLIES = ["ок", "да", "нет", "продолжи", "спасибо", "подробнее"]
+
+
+def make_messages(count: int) -> list:
+    """Генерирует историю: короткие реплики пользователя и длинные ответы"""
+    messages = []
+    for index in range(count):
+        if index % 2 == 0:
+            content = random.choice(SHORT_REPLIES)
+        else:
+            content = "ответ модели " * random.randint(5, 40)
+        messages.append(
+            {"role": "user" if index % 2 == 0 else "assistant", "content": content}
+        )
+    return messages
+
+
+# Тексты копируются через "".join, чтобы у каждого пользователя были
+# собственные объекты строк, как после чтения из БД
+
+
+def legacy_user(user_id: int, messages: list) -> dict:
+    settings = UserSettings(user_id=str(user_id))
+    user_data = {name: getattr(settings, name) for name in settings.keys()}
+    user_data["messages"] = [
+        {"role": message["role"], "content": "".join(message["content"])}
+        for message in messages
+    ]
+    return user_data
+
+
+def compact_user(user_id: int, messages: list):
+    settings = UserSettings(user_id=str(user_id))
+    history = History.from_pairs(
+        (message["role"], "".join(message["content"])) for message in messages
+    )
+    return settings, history
+
+
+def measure_memory(factory, users: int, messages: list) -> float:
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    cache = [factory(user_id, messages) for user_id in range(users)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del cache
+    return (after - before) / users
+
+
+def main(users: int, message_count: int) -> None:
+    random.seed(1)
+    messages = make_messages(message_count)
+
+    legacy_bytes = measure_memory(legacy_user, users, messages)
+    compact_bytes = measure_memory(compact_user, users, messages)
+
+    print(f"Пользователей: {users}, сообщений на пользователя: {message_count}")
+    print(f"dict + list[dict]:       {legacy_bytes:10.0f} байт/пользователь")
+    print(f"UserSettings + History:  {compact_bytes:10.0f} байт/пользователь")
+    print(f"Экономия: {(1 - compact_bytes / legacy_bytes) * 100:.1f}%")
+
+    user_data = legacy_user(0, messages)
+    settings, _ = compact_user(0, messages)
+    number = 2_000_000
+    cases = {
+        'dict["model"]': lambda: user_data["model"],
+        "settings.model": lambda: settings.model,
+        'settings["model"]': lambda: settings["model"],
+    }
+    print("Чтение поля настроек:")
+    for title, func in cases.items():
+        elapsed = min(timeit.repeat(func, number=number, repeat=3))
+        print(f"  {title:<20} {elapsed / number * 1e9:6.1f} нс")
+
+
+if __name__ == "__main__":
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 1000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 200,
+    )
@@ -0,0 +1,140 @@
+"""
+Микробенчмарк хранилища пользователей: прежний путь
+(SELECT -> INSERT -> IntegrityError -> SELECT -> refresh / SELECT + UPDATE)
+против одного запроса INSERT ... ON CONFLICT DO UPDATE ... RETURNING.
+
+Запуск из корня проекта:
+    python benchmarks/bench_user_storage.py [количество пользователей]
+"""
+
+import asyncio
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from sqlalchemy import event, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+from base import upsert_user
+from classes import Base, UserDataModel, UserSettings
+
+
+async def legacy_get_or_create(session, str_user_id):
+    """Прежняя реализация get_or_create_user_data (без кэша)"""
+    stmt = select(UserDataModel).where(UserDataModel.user_id == str_user_id)
+    result = await session.execute(stmt)
+    user_db_obj = result.scalars().first()
+
+    if not user_db_obj:
+        user_db_obj = UserDataModel(user_id=str_user_id)
+        session.add(user_db_obj)
+        try:
+            await session.commit()
+        except IntegrityError:
+            await session.rollback()
+            result = await session.execute(stmt)
+            user_db_obj = result.scalars().first()
+        await session.refresh(user_db_obj)
+
+    return user_db_obj.to_dict()
+
+
+async def legacy_save(session, str_user_id, values):
+    """Прежняя реализация save_user_data: SELECT и UPDATE"""
+    stmt = select(UserDataModel).where(UserDataModel.user_id == str_user_id)
+    result = await session.execute(stmt)
+    user_db_obj = result.scalars().first()
+    for key, value in values.items():
+        setattr(user_db_obj, key, value)
+    await session.commit()
+
+
+async def upsert_get_or_create(session, str_user_id):
+    user_db_obj = await upsert_user(session, str_user_id)
+    await session.commit()
+    return user_db_obj.to_dict()
+
+
+async def upsert_save(session, str_user_id, values):
+    await upsert_user(session, str_user_id, values)
+    await session.commit()
+
+
+async def measure(session_factory, counter, operation, user_ids, *args):
+    latencies = []
+    counter[0] = 0
+    for user_id in user_ids:
+        async with session_factory() as session:
+            started = time.perf_counter()
+            await operation(session, str(user_id), *args)
+            latencies.append((time.perf_counter() - started) * 1000)
+    return counter[0] / len(user_ids), latencies
+
+
+def report(title, round_trips, latencies):
+    latencies.sort()
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(
+        f"{title:<28} запросов/оп: {round_trips:5.2f}   "
+        f"p50: {statistics.median(latencies):6.3f} мс   p95: {p95:6.3f} мс"
+    )
+
+
+async def main(count: int):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_dir}/bench.sqlite")
+        session_factory = async_sessionmaker(engine, expire_on_commit=False)
+
+        # Считаем запросы к SQLite (round trips)
+        counter = [0]
+
+        @event.listens_for(engine.sync_engine, "before_cursor_execute")
+        def _count(*_args):
+            counter[0] += 1
+
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+
+        legacy_ids = range(1, count + 1)
+        upsert_ids = range(count + 1, 2 * count + 1)
+
+        cold_legacy = await measure(
+            session_factory, counter, legacy_get_or_create, legacy_ids
+        )
+        cold_upsert = await measure(
+            session_factory, counter, upsert_get_or_create, upsert_ids
+        )
+
+        values = UserSettings(
+            user_id="0",
+            model="gpt-4o",
+            model_message_info="4o",
+            model_message_chat="4o:\n\n",
+            count_messages=1,
+            voice_answer=True,
+            pic_grade="hd",
+        ).column_values()
+
+        warm_legacy = await measure(
+            session_factory, counter, legacy_save, legacy_ids, values
+        )
+        warm_upsert = await measure(
+            session_factory, counter, upsert_save, upsert_ids, values
+        )
+
+        await engine.dispose()
+
+    print(f"Пользователей: {count}")
+    report("cold get_or_create: legacy", *cold_legacy)
+    report("cold get_or_create: upsert", *cold_upsert)
+    report("warm save: legacy", *warm_legacy)
+    report("warm save: upsert", *warm_upsert)
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 500))
@@ -1,11 +1,32 @@
-import json
+import logging
+import sys
+from array import array
+from bisect import bisect_left
+from dataclasses import dataclass, fields
+from datetime import datetime
 from pathlib import Path
-from typing import Optional
+from typing import Iterable, Iterator, Optional
 
-from sqlalchemy import String, Boolean, Integer, Text
+from sqlalchemy import (
+    String,
+    Boolean,
+    Integer,
+    Text,
+    DateTime,
+    Float,
+    TypeDecorator,
+    bindparam,
+    select,
+    update,
+    func,
+    text,
+)
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.orm import declarative_base, mapped_column, Mapped
 
+from history_codec import encode_text, decode_text, decode_history
+from tokenizer import message_tokens, truncate_message
+
 # Указываем путь к файлу базы
 db_file = Path(__file__).parent / "database.sqlite"
 DB_URI = f"sqlite+aiosqlite:///{db_file}"
@@ -26,6 +47,258 @@ SessionLocal = async_sessionmaker(
 Base = declarative_base()
 
 
+@dataclass(slots=True)
+class UserSettings:
+    """
+    Компактные настройки пользователя (строка таблицы 'users_data').
+    Поддерживает доступ как к словарю (user_data["model"]) на время перехода
+    со старого формата.
+    """
+
+    user_id: str
+    model: str = "gpt-4o-mini"
+    model_message_info: str = "4o mini"
+    model_message_chat: str = "4o mini:\n\n"
+    count_messages: int = 0
+    max_tokens: int = 60000
+    voice_answer: bool = False
+    system_message: str = ""
+    pic_grade: str = "standard"
+    pic_size: str = "1024x1024"
+
+    # === Поля для режима ассистентов (Threads) ===
+    assistant_thread_id: str = ""
+    assistant_thread_id_2: str = ""
+    assistant_thread_id_3: str = ""
+    current_assistant: int = 1
+
+    # === ID ассистентов из OpenAI ===
+    assistant_id_1: str = ""
+    assistant_id_2: str = ""
+    assistant_id_3: str = ""
+
+    def __getitem__(self, key: str):
+        if key not in _SETTINGS_KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key: str, value) -> None:
+        if key not in _SETTINGS_KEYS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key: str) -> bool:
+        return key in _SETTINGS_KEYS
+
+    def get(self, key: str, default=None):
+        if key not in _SETTINGS_KEYS:
+            return default
+        return getattr(self, key)
+
+    def keys(self):
+        return iter(_SETTINGS_FIELDS)
+
+    def column_values(self) -> dict:
+        """Возвращает значения колонок users_data (кроме user_id)"""
+        return {name: getattr(self, name) for name in _SETTINGS_FIELDS[1:]}
+
+
+_SETTINGS_FIELDS = tuple(field.name for field in fields(UserSettings))
+_SETTINGS_KEYS = frozenset(_SETTINGS_FIELDS)
+
+# Роли сообщений хранятся кодами, а не строками
+ROLES = ("system", "user", "assistant")
+_ROLE_CODES = {role: code for code, role in enumerate(ROLES)}
+
+# Заголовок, с которым краткое содержание подставляется в запрос
+SUMMARY_PREFIX = "Краткое содержание предыдущей части разговора:\n"
+
+# Короткие повторяющиеся реплики ("ок", "да", "продолжи") интернируются
+_INTERN_MAX_LENGTH = 32
+
+
+class History:
+    """
+    Компактная история сообщений: параллельные массивы кодов ролей
+    и текстов вместо списка словарей.
+    Хранит нарастающие суммы токенов сообщений, чтобы окно контекста
+    находилось бинарным поиском без просмотра всей истории.
+    Начало истории может быть заменено в запросе кратким содержанием
+    (summary): оно покрывает сообщения до summary_index.
+    Для совместимости отдаёт сообщения как словари {"role", "content"}.
+    """
+
+    __slots__ = (
+        "_roles",
+        "_contents",
+        "_ends",
+        "_cut",
+        "_cut_key",
+        "summary",
+        "summary_index",
+        "summary_tokens",
+    )
+
+    def __init__(self, messages: Iterable[dict] = ()) -> None:
+        self._roles = array("B")
+        self._contents: list[str] = []
+        # _ends[i] - суммарное число токенов сообщений 0..i включительно
+        self._ends = array("Q")
+        # Последняя найденная граница окна и параметры, для которых она найдена
+        self._cut = 0
+        self._cut_key = None
+        self.summary = ""
+        self.summary_index = 0
+        self.summary_tokens = 0
+        for message in messages:
+            self.add(message["role"], message["content"])
+
+    @classmethod
+    def from_pairs(cls, pairs: Iterable) -> "History":
+        """Создаёт историю из пар (role, content)"""
+        history = cls()
+        for role, content in pairs:
+            history.add(role, content)
+        return history
+
+    def add(self, role: str, content: str, tokens: Optional[int] = None) -> None:
+        """
+        Добавляет сообщение. tokens - сохранённая ранее стоимость сообщения,
+        если не передана, считается токенизатором.
+        """
+        if len(content) <= _INTERN_MAX_LENGTH:
+            content = sys.intern(content)
+        if tokens is None:
+            tokens = message_tokens(content)
+        self._roles.append(_ROLE_CODES[role])
+        self._contents.append(content)
+        self._ends.append(self.total_tokens() + tokens)
+
+    def append(self, message: dict) -> None:
+        self.add(message["role"], message["content"])
+
+    def role(self, index: int) -> str:
+        return ROLES[self._roles[index]]
+
+    def content(self, index: int) -> str:
+        return self._contents[index]
+
+    def tokens(self, index: int) -> int:
+        """Стоимость сообщения в токенах"""
+        return self._ends[index] - (self._ends[index - 1] if index else 0)
+
+    def total_tokens(self) -> int:
+        """Суммарное число токенов всех сообщений"""
+        return self._ends[-1] if self._ends else 0
+
+    def unsummarized_tokens(self) -> int:
+        """Число токенов сообщений, не покрытых кратким содержанием"""
+        covered = self._ends[self.summary_index - 1] if self.summary_index else 0
+        return self.total_tokens() - covered
+
+    def set_summary(self, summary: str, index: int) -> None:
+        """Заменяет сообщения до index кратким содержанием"""
+        self.summary = summary
+        self.summary_index = index
+        self.summary_tokens = 0
+        if summary:
+            self.summary_tokens = message_tokens(SUMMARY_PREFIX + summary)
+
+    def window_start(self, budget: int, block_tokens: int = 0) -> int:
+        """
+        Индекс первого сообщения окна из последних сообщений суммарной
+        стоимостью не больше budget токенов. Последнее сообщение входит
+        в окно всегда, даже если оно одно больше budget.
+        При block_tokens > 0 граница окна сдвигается целыми блоками:
+        начало запроса не меняется, пока история не вырастет на блок,
+        и префикс запроса попадает в кэш промптов OpenAI.
+        """
+        threshold = self.total_tokens() - budget
+        if threshold <= 0:
+            return 0
+        if block_tokens > 0:
+            threshold = -(-threshold // block_tokens) * block_tokens
+
+        # При добавлении сообщений граница окна только сдвигается вперёд
+        key = (budget, block_tokens)
+        lo = max(self._cut - 1, 0) if key == self._cut_key else 0
+        # Сообщение i помещается целиком, если предыдущие занимают >= threshold
+        start = min(bisect_left(self._ends, threshold, lo) + 1, len(self._ends) - 1)
+        self._cut = start
+        self._cut_key = key
+        return start
+
+    def context_window(
+        self,
+        budget: int,
+        system: Optional[dict] = None,
+        summary_role: str = "system",
+        block_tokens: int = 0,
+    ) -> list:
+        """
+        Возвращает список сообщений для запроса: system (если передан),
+        краткое содержание начала разговора (если есть и занимает не больше
+        половины бюджета) и последние сообщения суммарной стоимостью
+        не больше budget токенов.
+        System и краткое содержание передаются без изменений, чтобы начало
+        запроса оставалось побайтно стабильным. Окно никогда не бывает
+        пустым: последнее сообщение, которое одно больше бюджета, обрезается.
+        """
+        window = [system] if system is not None else []
+
+        floor = 0
+        if self.summary and self.summary_tokens * 2 <= budget:
+            window.append(
+                {"role": summary_role, "content": SUMMARY_PREFIX + self.summary}
+            )
+            budget -= self.summary_tokens
+            floor = self.summary_index
+
+        if not self._contents:
+            return window
+
+        last = len(self._contents) - 1
+        start = min(max(self.window_start(budget, block_tokens), floor), last)
+        window.extend(self[start:])
+        if start == last and self.tokens(last) > budget:
+            window[-1]["content"] = truncate_message(self._contents[last], budget)
+        return window
+
+    def __len__(self) -> int:
+        return len(self._contents)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [
+                {"role": ROLES[role], "content": content}
+                for role, content in zip(self._roles[index], self._contents[index])
+            ]
+        return {"role": ROLES[self._roles[index]], "content": self._contents[index]}
+
+    def __iter__(self) -> Iterator[dict]:
+        for role, content in zip(self._roles, self._contents):
+            yield {"role": ROLES[role], "content": content}
+
+    def __reversed__(self) -> Iterator[dict]:
+        for index in range(len(self._contents) - 1, -1, -1):
+            yield {
+                "role": ROLES[self._roles[index]],
+                "content": self._contents[index],
+            }
+
+    def memory_size(self) -> int:
+        """Оценивает объём истории в памяти (байт)"""
+        size = (
+            sys.getsizeof(self._roles)
+            + sys.getsizeof(self._contents)
+            + sys.getsizeof(self._ends)
+            + sys.getsizeof(self.summary)
+        )
+        for content in self._contents:
+            size += sys.getsizeof(content)
+        return size
+
+
 class UserDataModel(Base):
     """
     SQLAlchemy-модель для хранения пользовательских данных.
@@ -38,9 +311,12 @@ class UserDataModel(Base):
     model: Mapped[str] = mapped_column(String, default="gpt-4o-mini")
     model_message_info: Mapped[str] = mapped_column(String, default="4o mini")
     model_message_chat: Mapped[str] = mapped_column(String, default="4o mini:\n\n")
+    # Устаревшее поле: история перенесена в таблицу 'messages'
     messages: Mapped[Optional[str]] = mapped_column(Text, default="[]")
     count_messages: Mapped[int] = mapped_column(Integer, default=0)
+    # Устаревшее поле: лимит контекста в символах, заменён на max_tokens
     max_out: Mapped[int] = mapped_column(Integer, default=240000)
+    max_tokens: Mapped[int] = mapped_column(Integer, default=60000)
     voice_answer: Mapped[bool] = mapped_column(Boolean, default=False)
     system_message: Mapped[str] = mapped_column(Text, default="")
     pic_grade: Mapped[str] = mapped_column(String, default="standard")
@@ -57,6 +333,14 @@ class UserDataModel(Base):
     assistant_id_2: Mapped[str] = mapped_column(String, default="")
     assistant_id_3: Mapped[str] = mapped_column(String, default="")
 
+    def to_settings(self) -> UserSettings:
+        """
+        Преобразует SQLAlchemy-объект в компактные настройки пользователя.
+        """
+        return UserSettings(
+            **{name: getattr(self, name) for name in _SETTINGS_FIELDS}
+        )
+
     def to_dict(self) -> dict:
         """
         Преобразует SQLAlchemy-объект в словарь для удобной передачи в код.
@@ -66,9 +350,8 @@ class UserDataModel(Base):
             "model": self.model,
             "model_message_info": self.model_message_info,
             "model_message_chat": self.model_message_chat,
-            "messages": json.loads(self.messages) if self.messages else [],
             "count_messages": self.count_messages,
-            "max_out": self.max_out,
+            "max_tokens": self.max_tokens,
             "voice_answer": self.voice_answer,
             "system_message": self.system_message,
             "pic_grade": self.pic_grade,
@@ -85,9 +368,317 @@ class UserDataModel(Base):
         }
 
 
+class HistoryText(TypeDecorator):
+    """
+    Текст сообщения в формате history_codec: короткие тексты хранятся
+    как есть, длинные - сжатым блоком. Старые текстовые строки читаются
+    без преобразований.
+    """
+
+    impl = Text
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return encode_text(value)
+
+    def process_result_value(self, value, dialect):
+        return decode_text(value)
+
+
+class MessageModel(Base):
+    """
+    SQLAlchemy-модель для хранения истории сообщений.
+    Таблица 'messages', одна строка на сообщение; строки только добавляются.
+    """
+
+    __tablename__ = "messages"
+
+    user_id: Mapped[str] = mapped_column(String, primary_key=True)
+    seq: Mapped[int] = mapped_column(Integer, primary_key=True)
+    role: Mapped[str] = mapped_column(String)
+    content: Mapped[str] = mapped_column(HistoryText)
+    # Длина текста в символах: content может храниться в сжатом виде
+    chars: Mapped[int] = mapped_column(Integer, default=0)
+    # Стоимость сообщения в токенах, считается один раз при добавлении
+    tokens: Mapped[int] = mapped_column(Integer, default=0)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+
+class SummaryModel(Base):
+    """
+    SQLAlchemy-модель краткого содержания начала разговора.
+    Таблица 'history_summaries': summary заменяет в запросах сообщения
+    с seq < covered_seq; сами сообщения остаются в таблице 'messages'.
+    """
+
+    __tablename__ = "history_summaries"
+
+    user_id: Mapped[str] = mapped_column(String, primary_key=True)
+    content: Mapped[str] = mapped_column(HistoryText)
+    covered_seq: Mapped[int] = mapped_column(Integer)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+
+class ResponseCacheModel(Base):
+    """
+    SQLAlchemy-модель кэша ответов Chat Completions.
+    Таблица 'response_cache': ключ - хэш параметров запроса.
+    """
+
+    __tablename__ = "response_cache"
+
+    key: Mapped[str] = mapped_column(String, primary_key=True)
+    model: Mapped[str] = mapped_column(String)
+    response: Mapped[str] = mapped_column(HistoryText)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    last_used: Mapped[datetime] = mapped_column(
+        DateTime, default=datetime.utcnow, index=True
+    )
+
+
+class UsageModel(Base):
+    """
+    SQLAlchemy-модель журнала вызовов OpenAI.
+    Таблица 'usage_ledger', одна строка на вызов; строки только добавляются.
+    """
+
+    __tablename__ = "usage_ledger"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime, default=datetime.utcnow, index=True
+    )
+    user_id: Mapped[Optional[str]] = mapped_column(String, nullable=True)
+    # Вид вызова: chat, vision, whisper, tts, image, assistant, summary
+    kind: Mapped[str] = mapped_column(String)
+    model: Mapped[str] = mapped_column(String)
+    prompt_tokens: Mapped[int] = mapped_column(Integer, default=0)
+    completion_tokens: Mapped[int] = mapped_column(Integer, default=0)
+    cached_tokens: Mapped[int] = mapped_column(Integer, default=0)
+    audio_seconds: Mapped[float] = mapped_column(Float, default=0.0)
+    characters: Mapped[int] = mapped_column(Integer, default=0)
+    images: Mapped[int] = mapped_column(Integer, default=0)
+    latency_ms: Mapped[int] = mapped_column(Integer, default=0)
+    # ok, error:<тип исключения> или cancelled
+    status: Mapped[str] = mapped_column(String, default="ok")
+
+
+class UsageDailyModel(Base):
+    """
+    SQLAlchemy-модель дневных итогов журнала вызовов.
+    Таблица 'usage_daily': суммы по дню, пользователю и модели
+    и гистограмма задержек для перцентилей.
+    """
+
+    __tablename__ = "usage_daily"
+
+    day: Mapped[str] = mapped_column(String, primary_key=True)
+    user_id: Mapped[str] = mapped_column(String, primary_key=True)
+    model: Mapped[str] = mapped_column(String, primary_key=True)
+    requests: Mapped[int] = mapped_column(Integer, default=0)
+    errors: Mapped[int] = mapped_column(Integer, default=0)
+    prompt_tokens: Mapped[int] = mapped_column(Integer, default=0)
+    completion_tokens: Mapped[int] = mapped_column(Integer, default=0)
+    cached_tokens: Mapped[int] = mapped_column(Integer, default=0)
+    audio_seconds: Mapped[float] = mapped_column(Float, default=0.0)
+    characters: Mapped[int] = mapped_column(Integer, default=0)
+    images: Mapped[int] = mapped_column(Integer, default=0)
+    latency_ms: Mapped[int] = mapped_column(Integer, default=0)
+    # Число вызовов по корзинам задержки (JSON-список)
+    latency_histogram: Mapped[str] = mapped_column(Text, default="[]")
+
+
+class OpenAIFileModel(Base):
+    """
+    SQLAlchemy-модель индекса файлов, загруженных в OpenAI.
+    Таблица 'openai_files': file_id по хэшу содержимого и назначению.
+    """
+
+    __tablename__ = "openai_files"
+
+    sha256: Mapped[str] = mapped_column(String, primary_key=True)
+    # vision или assistants
+    purpose: Mapped[str] = mapped_column(String, primary_key=True)
+    file_id: Mapped[str] = mapped_column(String, index=True)
+    filename: Mapped[str] = mapped_column(String)
+    bytes: Mapped[int] = mapped_column(Integer, default=0)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    last_used_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    # Когда OpenAI последний раз подтвердил, что файл существует
+    verified_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+
+class OpenAIResourceModel(Base):
+    """
+    SQLAlchemy-модель ресурсов OpenAI, созданных ботом.
+    Таблица 'openai_resources': файлы, треды и хранилища для уборки.
+    """
+
+    __tablename__ = "openai_resources"
+
+    resource_id: Mapped[str] = mapped_column(String, primary_key=True)
+    # file, thread или vector_store
+    kind: Mapped[str] = mapped_column(String, index=True)
+    # purpose файла, для тредов пусто
+    purpose: Mapped[str] = mapped_column(String, default="")
+    user_id: Mapped[Optional[str]] = mapped_column(String, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    deleted_at: Mapped[Optional[datetime]] = mapped_column(
+        DateTime, nullable=True, index=True
+    )
+
+
+class VectorStoreModel(Base):
+    """
+    SQLAlchemy-модель векторных хранилищ документов.
+    Таблица 'vector_stores': одно хранилище на пользователя и слот ассистента.
+    """
+
+    __tablename__ = "vector_stores"
+
+    user_id: Mapped[str] = mapped_column(String, primary_key=True)
+    slot: Mapped[int] = mapped_column(Integer, primary_key=True)
+    vector_store_id: Mapped[str] = mapped_column(String, index=True)
+    # Тред, к которому хранилище подключено через tool_resources
+    thread_id: Mapped[str] = mapped_column(String, default="")
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+
+class VectorStoreFileModel(Base):
+    """
+    SQLAlchemy-модель документов, уже проиндексированных в хранилище.
+    Таблица 'vector_store_files'.
+    """
+
+    __tablename__ = "vector_store_files"
+
+    vector_store_id: Mapped[str] = mapped_column(String, primary_key=True)
+    file_id: Mapped[str] = mapped_column(String, primary_key=True)
+    added_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+
+# Колонки, добавленные после создания таблиц: create_all их не добавляет
+_ADDED_COLUMNS = {
+    "users_data": {"max_tokens": "INTEGER"},
+    "messages": {"chars": "INTEGER", "tokens": "INTEGER"},
+}
+
+
+async def _add_missing_columns(conn) -> None:
+    """
+    Добавляет в существующие таблицы недостающие колонки (ALTER TABLE).
+    """
+    for table, columns in _ADDED_COLUMNS.items():
+        result = await conn.execute(text(f"PRAGMA table_info({table})"))
+        existing = {row[1] for row in result.all()}
+        for column, ddl in columns.items():
+            if column not in existing:
+                await conn.execute(
+                    text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+                )
+                logging.warning(f"В таблицу {table} добавлена колонка {column}")
+
+    # Старые строки истории хранят текст без сжатия - длина считается в SQL
+    await conn.execute(
+        text("UPDATE messages SET chars = length(content) WHERE chars IS NULL")
+    )
+    # Лимит контекста в символах переводится в токены (~4 символа на токен)
+    await conn.execute(
+        text(
+            "UPDATE users_data SET max_tokens = max_out / 4 "
+            "WHERE max_tokens IS NULL"
+        )
+    )
+    await _backfill_message_tokens(conn)
+
+
+async def _backfill_message_tokens(conn) -> None:
+    """
+    Считает токены для сообщений, сохранённых до появления колонки tokens.
+    """
+    result = await conn.execute(
+        select(MessageModel.user_id, MessageModel.seq, MessageModel.content).where(
+            MessageModel.tokens.is_(None)
+        )
+    )
+    rows = [
+        {"b_user_id": user_id, "b_seq": seq, "tokens": message_tokens(content)}
+        for user_id, seq, content in result.all()
+    ]
+    if not rows:
+        return
+
+    await conn.execute(
+        update(MessageModel.__table__)
+        .where(
+            MessageModel.user_id == bindparam("b_user_id"),
+            MessageModel.seq == bindparam("b_seq"),
+        )
+        .values(tokens=bindparam("tokens")),
+        rows,
+    )
+    logging.warning(f"Посчитаны токены для {len(rows)} сообщений")
+
+
+async def _migrate_messages_blob(conn) -> None:
+    """
+    Однократно переносит историю из JSON-поля users_data.messages
+    в таблицу 'messages' и очищает старое поле.
+    """
+    result = await conn.execute(
+        select(UserDataModel.user_id, UserDataModel.messages).where(
+            UserDataModel.messages.is_not(None),
+            UserDataModel.messages.not_in(["", "[]"]),
+        )
+    )
+    migrated = 0
+    for user_id, messages_blob in result.all():
+        try:
+            messages = decode_history(messages_blob)
+        except ValueError as e:
+            logging.error(f"Не удалось разобрать историю пользователя {user_id}: {e}")
+            continue
+
+        # Если история уже перенесена, повторно не вставляем
+        existing = await conn.scalar(
+            select(func.count()).where(MessageModel.user_id == user_id)
+        )
+        if not existing and messages:
+            now = datetime.utcnow()
+            await conn.execute(
+                MessageModel.__table__.insert(),
+                [
+                    {
+                        "user_id": user_id,
+                        "seq": seq,
+                        "role": message["role"],
+                        "content": message["content"],
+                        "chars": len(message["content"]),
+                        "tokens": message_tokens(message["content"]),
+                        "created_at": now,
+                    }
+                    for seq, message in enumerate(messages)
+                ],
+            )
+
+        await conn.execute(
+            update(UserDataModel)
+            .where(UserDataModel.user_id == user_id)
+            .values(messages="[]")
+        )
+        migrated += 1
+
+    if migrated:
+        logging.warning(f"История {migrated} пользователей перенесена в таблицу messages")
+
+
 async def init_async_db() -> None:
     """
     Создаём таблицы на лету (без Alembic).
     """
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await _add_missing_columns(conn)
+        await _migrate_messages_blob(conn)
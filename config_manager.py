@@ -1,6 +1,6 @@
 import configparser
 from pathlib import Path
-from typing import Set
+from typing import List, Optional, Set, Tuple
 
 # Инициализируем конфигурацию
 _config = configparser.ConfigParser()
@@ -29,9 +29,264 @@ def get_openai_api_key() -> str:
     return _config.get("OpenAI", "api_key")
 
 
+def get_openai_api_keys() -> List[Tuple[str, Optional[str]]]:
+    """
+    Возвращает ключи OpenAI в виде пар (ключ, проект): первым основной
+    api_key, затем extra_api_keys - список через запятую, элемент
+    либо ключ, либо ключ:proj_id.
+    """
+    project = _config.get("OpenAI", "project", fallback="")
+    keys = [(get_openai_api_key(), project or None)]
+    extra = _config.get("OpenAI", "extra_api_keys", fallback="")
+    for item in extra.split(","):
+        api_key, _, project = item.strip().partition(":")
+        if api_key:
+            keys.append((api_key, project or None))
+    return keys
+
+
 def get_openai_assistant_id(assistant_number: int = 1) -> str:
     """Возвращает ID ассистента OpenAI"""
     if assistant_number == 1:
         return _config.get("OpenAI", "assistant_id", fallback="")
     else:
         return _config.get("OpenAI", f"assistant_id_{assistant_number}", fallback="")
+
+
+def get_stream_enabled() -> bool:
+    """Возвращает признак потоковой выдачи ответов"""
+    return _config.getboolean("Streaming", "enabled", fallback=True)
+
+
+def get_stream_edit_interval() -> float:
+    """Возвращает минимальный интервал между редактированиями сообщения (сек)"""
+    return _config.getfloat("Streaming", "edit_interval", fallback=1.0)
+
+
+def get_flush_interval_ms() -> int:
+    """Возвращает период фоновой записи изменённых пользователей (мс)"""
+    return _config.getint("Database", "flush_interval_ms", fallback=500)
+
+
+def get_flush_batch_size() -> int:
+    """Возвращает число изменённых пользователей, запускающее запись досрочно"""
+    return _config.getint("Database", "flush_batch_size", fallback=50)
+
+
+def get_cache_max_bytes() -> int:
+    """Возвращает бюджет памяти кэша пользователей (байт)"""
+    return _config.getint("Cache", "max_bytes", fallback=128 * 1024 * 1024)
+
+
+def get_cache_idle_ttl() -> float:
+    """Возвращает время простоя, после которого запись вытесняется из кэша (сек)"""
+    return _config.getfloat("Cache", "idle_ttl", fallback=3600.0)
+
+
+def get_tokenizer_vocab_dir() -> str:
+    """Возвращает каталог с локальными словарями tiktoken"""
+    return _config.get("Tokenizer", "vocab_dir", fallback="")
+
+
+def get_summary_enabled() -> bool:
+    """Возвращает признак сжатия старой части истории в краткое содержание"""
+    return _config.getboolean("Summary", "enabled", fallback=True)
+
+
+def get_summary_model() -> str:
+    """Возвращает модель для составления краткого содержания"""
+    return _config.get("Summary", "model", fallback="gpt-4o-mini")
+
+
+def get_prune_block_tokens() -> int:
+    """Возвращает размер блока (токенов), которым сдвигается начало окна контекста"""
+    return _config.getint("Context", "prune_block_tokens", fallback=8192)
+
+
+def get_response_cache_enabled() -> bool:
+    """Возвращает признак кэширования одинаковых запросов к Chat Completions"""
+    return _config.getboolean("ResponseCache", "enabled", fallback=False)
+
+
+def get_response_cache_force_deterministic() -> bool:
+    """
+    Возвращает признак отправки temperature=0 в запросах gpt-4o, 4o mini
+    и 4.1, чтобы их ответы попадали в кэш ответов
+    """
+    return _config.getboolean("ResponseCache", "force_deterministic", fallback=False)
+
+
+def get_response_cache_ttl() -> int:
+    """Возвращает время жизни записи кэша ответов (сек)"""
+    return _config.getint("ResponseCache", "ttl", fallback=86400)
+
+
+def get_response_cache_max_entries() -> int:
+    """Возвращает максимальное число записей в кэше ответов"""
+    return _config.getint("ResponseCache", "max_entries", fallback=1000)
+
+
+def get_openai_max_retries() -> int:
+    """Возвращает число повторов запроса внутри SDK OpenAI"""
+    return _config.getint("Scheduler", "max_retries", fallback=1)
+
+
+def get_scheduler_concurrency(model: str) -> int:
+    """
+    Возвращает число одновременных запросов к модели.
+    Переопределения задаются списком model:число в model_concurrency.
+    """
+    overrides = _config.get("Scheduler", "model_concurrency", fallback="")
+    for item in overrides.split(","):
+        name, _, value = item.strip().partition(":")
+        if name == model and value:
+            return int(value)
+    return _config.getint("Scheduler", "concurrency", fallback=8)
+
+
+def get_scheduler_rpm() -> int:
+    """Возвращает начальный лимит запросов в минуту на модель (до ответа API)"""
+    return _config.getint("Scheduler", "rpm", fallback=500)
+
+
+def get_scheduler_tpm() -> int:
+    """Возвращает начальный лимит токенов в минуту на модель (до ответа API)"""
+    return _config.getint("Scheduler", "tpm", fallback=200000)
+
+
+def get_openai_key_cooldown() -> float:
+    """Возвращает время (сек), на которое ключ после 429 выходит из ротации"""
+    return _config.getfloat("Scheduler", "key_cooldown", fallback=30.0)
+
+
+def get_openai_auth_cooldown() -> float:
+    """Возвращает время (сек), на которое ключ после 401 выходит из ротации"""
+    return _config.getfloat("Scheduler", "auth_cooldown", fallback=600.0)
+
+
+def get_hedging_enabled() -> bool:
+    """Возвращает признак дублирования медленных запросов к чату"""
+    return _config.getboolean("Hedging", "enabled", fallback=True)
+
+
+def get_hedging_percentile() -> float:
+    """Возвращает перцентиль задержки, после которого запрос дублируется"""
+    return _config.getfloat("Hedging", "percentile", fallback=0.95)
+
+
+def get_hedging_min_samples() -> int:
+    """Возвращает число замеров модели, нужное для расчёта срока"""
+    return _config.getint("Hedging", "min_samples", fallback=20)
+
+
+def get_hedging_min_delay() -> float:
+    """Возвращает минимальный срок (сек) до дублирования запроса"""
+    return _config.getfloat("Hedging", "min_delay", fallback=5.0)
+
+
+def get_hedging_budget() -> float:
+    """Возвращает допустимую долю дублированных запросов"""
+    return _config.getfloat("Hedging", "budget", fallback=0.05)
+
+
+def get_hedging_fallback(model: str) -> str:
+    """
+    Возвращает модель для дублирующего запроса: из списка model:запасная
+    в fallback, иначе ту же модель.
+    """
+    pairs = _config.get("Hedging", "fallback", fallback="")
+    for item in pairs.split(","):
+        name, _, fallback = item.strip().partition(":")
+        if name == model and fallback:
+            return fallback
+    return model
+
+
+def get_http_max_connections() -> int:
+    """Возвращает размер пула соединений HTTP клиента"""
+    return _config.getint("HTTP", "max_connections", fallback=100)
+
+
+def get_http_max_keepalive() -> int:
+    """Возвращает число соединений, которые держатся открытыми между запросами"""
+    return _config.getint("HTTP", "max_keepalive", fallback=20)
+
+
+def get_http_keepalive_expiry() -> float:
+    """Возвращает время (сек), через которое закрывается простаивающее соединение"""
+    return _config.getfloat("HTTP", "keepalive_expiry", fallback=60.0)
+
+
+def get_http_connect_timeout() -> float:
+    """Возвращает таймаут установки соединения (сек)"""
+    return _config.getfloat("HTTP", "connect_timeout", fallback=10.0)
+
+
+def get_http_read_timeout() -> float:
+    """Возвращает общий таймаут запроса (сек)"""
+    return _config.getfloat("HTTP", "read_timeout", fallback=600.0)
+
+
+def get_http2_enabled() -> bool:
+    """Возвращает признак HTTP/2 для OpenAI (нужен пакет h2)"""
+    return _config.getboolean("HTTP", "http2", fallback=False)
+
+
+def get_usage_flush_interval() -> float:
+    """Возвращает период записи журнала расходов в БД (сек)"""
+    return _config.getfloat("Usage", "flush_interval", fallback=5.0)
+
+
+def get_usage_batch_size() -> int:
+    """Возвращает число записей журнала, запускающее запись досрочно"""
+    return _config.getint("Usage", "batch_size", fallback=100)
+
+
+def get_assistant_cancel_timeout() -> float:
+    """Возвращает максимальное время ожидания отмены запуска ассистента (сек)"""
+    return _config.getfloat("Assistants", "cancel_timeout", fallback=30.0)
+
+
+def get_file_verify_interval() -> float:
+    """Возвращает период (сек), после которого file_id из индекса перепроверяется"""
+    return _config.getfloat("Files", "verify_interval", fallback=3600.0)
+
+
+def get_janitor_mode() -> str:
+    """Возвращает режим уборки ресурсов OpenAI: delete, dry_run, metrics или off"""
+    return _config.get("Janitor", "mode", fallback="dry_run").strip().lower()
+
+
+def get_janitor_interval() -> float:
+    """Возвращает период уборки ресурсов OpenAI (сек)"""
+    return _config.getfloat("Janitor", "interval", fallback=3600.0)
+
+
+def get_janitor_vision_ttl() -> float:
+    """Возвращает срок хранения изображений vision после использования (сек)"""
+    return _config.getfloat("Janitor", "vision_ttl", fallback=86400.0)
+
+
+def get_janitor_document_ttl() -> float:
+    """Возвращает срок хранения документов после использования (сек, 0 - вечно)"""
+    return _config.getfloat("Janitor", "document_ttl", fallback=2592000.0)
+
+
+def get_janitor_thread_grace() -> float:
+    """Возвращает минимальный возраст брошенного треда перед удалением (сек)"""
+    return _config.getfloat("Janitor", "thread_grace", fallback=3600.0)
+
+
+def get_janitor_batch_size() -> int:
+    """Возвращает максимальное число удалений за один проход уборки"""
+    return _config.getint("Janitor", "batch_size", fallback=50)
+
+
+def get_janitor_delete_interval() -> float:
+    """Возвращает паузу между запросами удаления (сек)"""
+    return _config.getfloat("Janitor", "delete_interval", fallback=0.2)
+
+
+def get_vector_store_expire_days() -> int:
+    """Возвращает срок жизни неактивного векторного хранилища (дни, 0 - вечно)"""
+    return _config.getint("VectorStores", "expire_days", fallback=30)
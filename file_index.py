@@ -0,0 +1,161 @@
+"""
+Индекс файлов, загруженных в OpenAI.
+
+Изображения и документы режима ассистента загружаются в OpenAI один раз:
+таблица 'openai_files' хранит file_id по SHA-256 содержимого и назначению
+(purpose). Повторная отправка того же файла - в любой тред, любому
+ассистенту - берёт file_id из индекса без загрузки. Существование файла
+проверяется лениво, не чаще раза в verify_interval: если OpenAI отвечает,
+что файла нет, запись удаляется и файл загружается заново.
+"""
+
+import hashlib
+import logging
+from datetime import datetime, timedelta
+from typing import Optional, Tuple
+
+from openai import NotFoundError
+from sqlalchemy import delete, select, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from classes import SessionLocal, OpenAIFileModel
+from config_manager import get_file_verify_interval
+from janitor import register_resource
+from openai_manager import get_async_openai_client, openai_single_flight
+
+_stats = {"hits": 0, "uploads": 0, "stale": 0, "bytes_saved": 0}
+
+
+async def _lookup(digest: str, purpose: str) -> Optional[OpenAIFileModel]:
+    try:
+        async with SessionLocal() as session:
+            return await session.scalar(
+                select(OpenAIFileModel).where(
+                    OpenAIFileModel.sha256 == digest,
+                    OpenAIFileModel.purpose == purpose,
+                )
+            )
+    except Exception as e:
+        logging.error(f"Ошибка чтения индекса файлов: {e}")
+        return None
+
+
+async def _touch(record: OpenAIFileModel, verified: bool) -> None:
+    now = datetime.utcnow()
+    values = {"last_used_at": now}
+    if verified:
+        values["verified_at"] = now
+    try:
+        async with SessionLocal() as session:
+            await session.execute(
+                update(OpenAIFileModel)
+                .where(
+                    OpenAIFileModel.sha256 == record.sha256,
+                    OpenAIFileModel.purpose == record.purpose,
+                )
+                .values(**values)
+            )
+            await session.commit()
+    except Exception as e:
+        logging.error(f"Ошибка обновления индекса файлов: {e}")
+
+
+async def _verified(record: OpenAIFileModel) -> bool:
+    """Проверяет, что файл ещё есть в OpenAI (не чаще verify_interval)"""
+    cutoff = datetime.utcnow() - timedelta(seconds=get_file_verify_interval())
+    if record.verified_at >= cutoff:
+        await _touch(record, verified=False)
+        return True
+
+    try:
+        await get_async_openai_client().files.retrieve(record.file_id)
+    except NotFoundError:
+        _stats["stale"] += 1
+        logging.warning(f"Файл {record.file_id} удалён в OpenAI, загружаем заново")
+        await forget_file(record.file_id)
+        return False
+    except Exception as e:
+        # Проверка не удалась - используем file_id, как есть
+        logging.warning(f"Не удалось проверить файл {record.file_id}: {e}")
+        return True
+
+    await _touch(record, verified=True)
+    return True
+
+
+async def _upload(
+    file: Tuple[str, bytes, str], purpose: str, digest: str, user_id: Optional[int]
+) -> str:
+    filename, data, _ = file
+    uploaded = await get_async_openai_client().files.create(file=file, purpose=purpose)
+    _stats["uploads"] += 1
+    await register_resource("file", uploaded.id, user_id, purpose)
+
+    now = datetime.utcnow()
+    try:
+        async with SessionLocal() as session:
+            stmt = sqlite_insert(OpenAIFileModel).values(
+                sha256=digest,
+                purpose=purpose,
+                file_id=uploaded.id,
+                filename=filename,
+                bytes=len(data),
+                created_at=now,
+                last_used_at=now,
+                verified_at=now,
+            )
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[OpenAIFileModel.sha256, OpenAIFileModel.purpose],
+                set_={
+                    "file_id": stmt.excluded.file_id,
+                    "filename": stmt.excluded.filename,
+                    "created_at": stmt.excluded.created_at,
+                    "last_used_at": stmt.excluded.last_used_at,
+                    "verified_at": stmt.excluded.verified_at,
+                },
+            )
+            await session.execute(stmt)
+            await session.commit()
+    except Exception as e:
+        logging.error(f"Ошибка записи в индекс файлов: {e}")
+    return uploaded.id
+
+
+async def upload_file(
+    file: Tuple[str, bytes, str], purpose: str, user_id: Optional[int] = None
+) -> str:
+    """
+    Возвращает file_id для файла (имя, содержимое, mime-тип):
+    из индекса, если такой файл уже загружался с тем же purpose,
+    иначе загружает его. Одновременные загрузки одного файла объединяются.
+    """
+    data = file[1]
+    digest = hashlib.sha256(data).hexdigest()
+
+    record = await _lookup(digest, purpose)
+    if record is not None and await _verified(record):
+        _stats["hits"] += 1
+        _stats["bytes_saved"] += len(data)
+        logging.info(f"Файл {record.file_id} взят из индекса ({purpose})")
+        return record.file_id
+
+    return await openai_single_flight.do(
+        f"upload:{purpose}:{digest}", lambda: _upload(file, purpose, digest, user_id)
+    )
+
+
+async def forget_file(file_id: str) -> None:
+    """Удаляет file_id из индекса (файл удалён в OpenAI)"""
+    try:
+        async with SessionLocal() as session:
+            await session.execute(
+                delete(OpenAIFileModel).where(OpenAIFileModel.file_id == file_id)
+            )
+            await session.commit()
+    except Exception as e:
+        logging.error(f"Ошибка удаления из индекса файлов: {e}")
+
+
+def file_index_stats() -> dict:
+    """Счётчики индекса: повторные использования, загрузки, сэкономленные байты"""
+    return dict(_stats)
@@ -7,9 +7,23 @@ from aiogram import Bot, types
 from aiogram.types import FSInputFile
 from pydub import AudioSegment
 
-from base import get_or_create_user_data
+from assistant_runs import run_stats
+from base import cache_stats, get_or_create_user_data
 from bot_manager import get_bot
-from openai_manager import get_async_openai_client
+from file_index import file_index_stats
+from hedging import hedge_stats
+from http_manager import get_http_session, http_pool_stats
+from openai_manager import (
+    openai_single_flight,
+    prompt_cache_stats,
+    request_key,
+    scheduled,
+    scheduler,
+    PRIORITY_BACKGROUND,
+)
+from response_cache import response_cache_stats
+from usage_ledger import track
+from vector_store_manager import vector_store_stats
 
 
 async def info_menu_func(user_id):
@@ -30,30 +44,59 @@ async def info_menu_func(user_id):
     return info_menu
 
 
-async def prune_messages(messages, max_chars):
-    """
-    Обрезает историю сообщений по символам, начиная с конца.
-    """
-    pruned_messages = []
-    total_chars = 0
-
-    # Идём с конца к началу
-    for message in reversed(messages):
-        content_length = len(message["content"])
-        remaining_chars = max_chars - total_chars
-        if remaining_chars <= 0:
-            break
+def _counters(stats: dict) -> str:
+    """Словарь счётчиков одной строкой: 'name value, ...'"""
+    return ", ".join(
+        f"{name} {value:.2f}" if isinstance(value, float) else f"{name} {value}"
+        for name, value in stats.items()
+    )
 
-        if content_length > remaining_chars:
-            pruned_content = message["content"][:remaining_chars]
-            pruned_messages.append({"role": message["role"], "content": pruned_content})
-            break
 
-        pruned_messages.append(message)
-        total_chars += content_length
+def runtime_stats_report(lane_metrics: dict) -> str:
+    """Счётчики бота с момента запуска: ключи API, очереди, кэши, пулы (HTML)"""
+    lines = ["<b>Ключи API</b>"]
+    for name, key in scheduler.stats().items():
+        line = (
+            f"{name}: {key['requests']} запр., {key['tokens']} ток., "
+            f"429: {key['throttled']}, 401: {key['unauthorized']}"
+        )
+        if key["cooldown"]:
+            line += f", остывает {key['cooldown']:.0f} с"
+        lines.append(line)
+        for model, limiter in key["models"].items():
+            lines.append(
+                f"  {model}: активно {limiter['active']}, ждут {limiter['waiting']}, "
+                f"ожидание {limiter['avg_wait']:.2f} с, 429: {limiter['throttled']}, "
+                f"запас RPM {limiter['requests_left']} / TPM {limiter['tokens_left']}"
+            )
 
-    # Возвращаем в прямом порядке
-    return list(reversed(pruned_messages))
+    queued = [metrics["queued"] for metrics in lane_metrics.values()]
+    lines += [
+        "",
+        f"<b>Очереди пользователей</b>: активно {len(lane_metrics)}, "
+        f"ждут {sum(queued)}, самая длинная {max(queued, default=0)}",
+        f"<b>Кэш историй</b>: {_counters(cache_stats())}",
+        f"<b>Кэш ответов</b>: {_counters(response_cache_stats())}",
+    ]
+
+    prompt_cache = prompt_cache_stats()
+    if prompt_cache:
+        lines.append("<b>Кэш промптов</b>")
+        for model, stats in prompt_cache.items():
+            lines.append(f"  {model}: {_counters(stats)}")
+
+    lines.append("<b>Пулы соединений</b>")
+    for name, stats in http_pool_stats().items():
+        lines.append(f"  {name}: {_counters(stats)}")
+
+    lines += [
+        f"<b>Дублирование запросов</b>: {_counters(hedge_stats())}",
+        f"<b>Общие вызовы</b>: {_counters(openai_single_flight.stats())}",
+        f"<b>Запуски ассистентов</b>: {_counters(run_stats())}",
+        f"<b>Индекс файлов</b>: {_counters(file_index_stats())}",
+        f"<b>Векторные хранилища</b>: {_counters(vector_store_stats())}",
+    ]
+    return "\n".join(lines)
 
 
 async def process_voice_message(bot: Bot, message: types.Message, user_id: int):
@@ -103,9 +146,6 @@ async def process_voice_message(bot: Bot, message: types.Message, user_id: int):
                 "Конвертация файла завершилась неудачно, mp3-файл не создан."
             )
 
-        # Используем асинхронный клиент для Whisper API
-        client_async = get_async_openai_client()
-
         # Читаем файл асинхронно
         try:
             audio_data = await asyncio.to_thread(lambda: mp3_path.read_bytes())
@@ -119,9 +159,18 @@ async def process_voice_message(bot: Bot, message: types.Message, user_id: int):
         audio_file = BytesIO(audio_data)
         audio_file.name = mp3_path.name
 
+        async def transcribe():
+            async with track("whisper", "whisper-1", user_id) as entry:
+                entry.audio_seconds = message.voice.duration or 0
+                async with scheduled("whisper-1") as client_async:
+                    return await client_async.audio.transcriptions.create(
+                        model="whisper-1", file=audio_file
+                    )
+
         try:
-            transcription = await client_async.audio.transcriptions.create(
-                model="whisper-1", file=audio_file
+            # Одно и то же аудио, присланное повторно, распознаётся один раз
+            transcription = await openai_single_flight.do(
+                request_key("whisper-1", audio_data), transcribe
             )
         except Exception as e:
             logging.error(f"Ошибка распознавания речи через OpenAI: {e}")
@@ -165,7 +214,6 @@ async def text_to_speech(unic_id: int, text_message: str):
     """
     try:
         bot = get_bot()  # Получаем bot из менеджера
-        client_async = get_async_openai_client()
     except Exception as e:
         logging.error(f"Ошибка инициализации для TTS: {e}")
         return []
@@ -196,11 +244,16 @@ async def text_to_speech(unic_id: int, text_message: str):
 
             # Используем асинхронный клиент для TTS API
             try:
-                response_voice = await client_async.audio.speech.create(
-                    model="tts-1",
-                    voice="nova",
-                    input=chunk,
-                )
+                # Озвучка - фоновая работа, она уступает запросам к чату
+                async with track("tts", "tts-1", unic_id) as entry, scheduled(
+                    "tts-1", priority=PRIORITY_BACKGROUND
+                ) as client_async:
+                    entry.characters = len(chunk)
+                    response_voice = await client_async.audio.speech.create(
+                        model="tts-1",
+                        voice="nova",
+                        input=chunk,
+                    )
             except Exception as e:
                 logging.error(f"Ошибка вызова OpenAI TTS API для части {index}: {e}")
                 failed_parts.append(index)
@@ -282,32 +335,32 @@ async def download_image(bot_instance, file_id: str) -> bytes:
         # Добавляем таймауты для предотвращения зависания
         timeout = aiohttp.ClientTimeout(total=30, connect=10)
 
-        # Скачиваем содержимое
+        # Скачиваем содержимое через общий пул соединений
         try:
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.get(url) as response:
-                    if response.status != 200:
-                        logging.error(
-                            f"HTTP ошибка при скачивании файла: {response.status}"
-                        )
-                        raise ValueError(
-                            f"Ошибка HTTP {response.status} при скачивании файла"
-                        )
-
-                    content_length = response.headers.get("content-length")
-                    if (
-                        content_length and int(content_length) > 20 * 1024 * 1024
-                    ):  # 20MB лимит
-                        logging.error(f"Файл слишком большой: {content_length} байт")
-                        raise ValueError("Файл слишком большой для обработки")
-
-                    data = await response.read()
-
-                    if len(data) == 0:
-                        logging.error("Скачан пустой файл")
-                        raise ValueError("Скачанный файл пуст")
-
-                    return data
+            session = get_http_session()
+            async with session.get(url, timeout=timeout) as response:
+                if response.status != 200:
+                    logging.error(
+                        f"HTTP ошибка при скачивании файла: {response.status}"
+                    )
+                    raise ValueError(
+                        f"Ошибка HTTP {response.status} при скачивании файла"
+                    )
+
+                content_length = response.headers.get("content-length")
+                if (
+                    content_length and int(content_length) > 20 * 1024 * 1024
+                ):  # 20MB лимит
+                    logging.error(f"Файл слишком большой: {content_length} байт")
+                    raise ValueError("Файл слишком большой для обработки")
+
+                data = await response.read()
+
+                if len(data) == 0:
+                    logging.error("Скачан пустой файл")
+                    raise ValueError("Скачанный файл пуст")
+
+                return data
 
         except asyncio.TimeoutError:
             logging.error(f"Таймаут при скачивании файла {file_id}")
@@ -10,7 +10,13 @@ from aiogram.types import CallbackQuery
 from aiogram.types import Message
 from aiogram.utils.formatting import Text
 
-from base import get_or_create_user_data, save_user_data
+from base import (
+    get_or_create_user_data,
+    save_user_data,
+    load_full_history,
+    clear_user_history,
+    users_history,
+)
 from bot_manager import get_bot
 from buttons import (
     keyboard_pic,
@@ -24,10 +30,13 @@ from decorators import owner_only, owner_only_with_user_id_display
 from function import (
     process_voice_message,
     info_menu_func,
+    runtime_stats_report,
 )
 from handler_work import reset_thread
-from middlewares import ThrottlingMiddleware
+from janitor import janitor_report
+from middlewares import ThrottlingMiddleware, UserLaneMiddleware
 from text import start_message, system_message_text, help_message, null_message
+from usage_ledger import usage_report
 
 # Установка часового пояса
 timezone = pytz.timezone("Europe/Moscow")
@@ -44,6 +53,12 @@ router = Router()
 
 router.message.middleware(ThrottlingMiddleware(spin=1.5))
 
+# Последовательная обработка сообщений каждого пользователя
+user_lanes = UserLaneMiddleware()
+router.message.middleware(user_lanes)
+# История не вытесняется из кэша, пока её использует обработчик
+users_history.in_use = user_lanes.is_active
+
 
 # Создаем класс для машины состояний
 class ChangeValueState(StatesGroup):
@@ -81,9 +96,9 @@ async def command_null_handler(message: Message, state: FSMContext):
     user_data["model"] = "gpt-4o-mini"
     user_data["model_message_info"] = "4o mini"
     user_data["model_message_chat"] = "4o mini:\n\n"
-    user_data["messages"] = []
+    await clear_user_history(user_id)
     user_data["count_messages"] = 0
-    user_data["max_out"] = 240000
+    user_data["max_tokens"] = 60000
     user_data["voice_answer"] = False
     user_data["system_message"] = ""
     user_data["pic_grade"] = "standard"
@@ -117,6 +132,43 @@ async def command_null_handler(message: Message, state: FSMContext):
     return
 
 
+@router.message(F.text.regexp(r"^/usage(\s+\d+)?$"))
+@flags.throttling_key("spin")
+@owner_only
+async def command_usage_handler(message: Message, state: FSMContext):
+    if state is not None:
+        await state.clear()
+
+    # Период отчёта в днях: /usage 30
+    parts = message.text.split()
+    days = min(int(parts[1]), 365) if len(parts) > 1 else 7
+
+    await message.answer(await usage_report(max(days, 1)))
+    return
+
+
+@router.message(F.text == "/stats")
+@flags.throttling_key("spin")
+@owner_only
+async def command_stats_handler(message: Message, state: FSMContext):
+    if state is not None:
+        await state.clear()
+
+    await message.answer(runtime_stats_report(user_lanes.lane_metrics()))
+    return
+
+
+@router.message(F.text == "/janitor")
+@flags.throttling_key("spin")
+@owner_only
+async def command_janitor_handler(message: Message, state: FSMContext):
+    if state is not None:
+        await state.clear()
+
+    await message.answer(await janitor_report())
+    return
+
+
 @router.message(F.text == "/menu")
 @flags.throttling_key("spin")
 @owner_only
@@ -161,7 +213,7 @@ async def process_callback_menu_1(callback_query: CallbackQuery):
         "model": "gpt-4o-mini",
         "model_message_info": "4o mini",
         "model_message_chat": "4o mini:\n\n",
-        "max_out": 240000,
+        "max_tokens": 60000,
     }
     await handle_model_selection(callback_query, model_config)
 
@@ -172,7 +224,7 @@ async def process_callback_menu_2(callback_query: CallbackQuery):
         "model": "gpt-4o",
         "model_message_info": "4o",
         "model_message_chat": "4o:\n\n",
-        "max_out": 240000,
+        "max_tokens": 60000,
     }
     await handle_model_selection(callback_query, model_config)
 
@@ -183,7 +235,7 @@ async def process_callback_menu_3(callback_query: CallbackQuery):
         "model": "o1-mini",
         "model_message_info": "o1 mini",
         "model_message_chat": "o1 mini:\n\n",
-        "max_out": 240000,
+        "max_tokens": 60000,
     }
     await handle_model_selection(callback_query, model_config)
 
@@ -194,7 +246,7 @@ async def process_callback_menu_4(callback_query: CallbackQuery):
         "model": "o1-preview",
         "model_message_info": "o1 preview",
         "model_message_chat": "o1 preview:\n\n",
-        "max_out": 240000,
+        "max_tokens": 60000,
     }
     await handle_model_selection(callback_query, model_config)
 
@@ -205,7 +257,7 @@ async def process_callback_menu_5(callback_query: CallbackQuery):
         "model": "o3-mini",
         "model_message_info": "o3 mini",
         "model_message_chat": "o3 mini:\n\n",
-        "max_out": 240000,
+        "max_tokens": 60000,
     }
     await handle_model_selection(callback_query, model_config)
 
@@ -226,7 +278,7 @@ async def process_callback_o1_pro(callback_query: CallbackQuery):
         "model": "o1-pro",
         "model_message_info": "o1 pro",
         "model_message_chat": "o1 pro:\n\n",
-        "max_out": 240000,
+        "max_tokens": 60000,
     }
     await handle_model_selection(callback_query, model_config)
 
@@ -237,7 +289,7 @@ async def process_callback_gpt_4o_search_preview(callback_query: CallbackQuery):
         "model": "gpt-4o-search-preview",
         "model_message_info": "Web 4o",
         "model_message_chat": "Web 4o:\n\n",
-        "max_out": 5900,
+        "max_tokens": 1500,
     }
     await handle_model_selection(callback_query, model_config)
 
@@ -379,8 +431,8 @@ async def process_callback_context_work(
 async def process_callback_context(callback_query: CallbackQuery):
     user_id = callback_query.from_user.id
 
-    user_data = await get_or_create_user_data(user_id)
-    history = await generate_history(user_data["messages"])
+    await get_or_create_user_data(user_id)
+    history = await generate_history(await load_full_history(user_id))
 
     if callback_query.message.text == "Контекст пуст":
         await callback_query.answer()
@@ -469,7 +521,7 @@ async def process_callback_clear(callback_query: CallbackQuery):
     user_data = await get_or_create_user_data(user_id)
 
     # Очищаем сообщения
-    user_data["messages"] = []
+    await clear_user_history(user_id)
     user_data["count_messages"] = 0
 
     # Определяем текущий ассистент и сбрасываем его thread_id
@@ -746,7 +798,7 @@ async def process_new_value(message: types.Message, state: FSMContext):
 async def handle_model_selection(callback_query: CallbackQuery, model_config: dict):
     """
     Универсальная функция для обработки выбора модели
-    model_config должен содержать: model, model_message_info, model_message_chat, max_out (опционально)
+    model_config должен содержать: model, model_message_info, model_message_chat, max_tokens (опционально)
     """
     user_id = callback_query.from_user.id
     user_data = await get_or_create_user_data(user_id)
@@ -770,9 +822,9 @@ async def handle_model_selection(callback_query: CallbackQuery, model_config: di
     user_data["model_message_info"] = model_config["model_message_info"]
     user_data["model_message_chat"] = model_config["model_message_chat"]
 
-    # Устанавливаем max_out если указан
-    if "max_out" in model_config:
-        user_data["max_out"] = model_config["max_out"]
+    # Устанавливаем лимит контекста в токенах, если указан
+    if "max_tokens" in model_config:
+        user_data["max_tokens"] = model_config["max_tokens"]
 
     # Специальная обработка для ассистентов
     if model_config["model"] == "assistant":
@@ -805,7 +857,7 @@ async def process_callback_gpt_4_1(callback_query: CallbackQuery, state: FSMCont
         "model": "gpt-4.1-2025-04-14",
         "model_message_info": "4.1",
         "model_message_chat": "4.1:\n\n",
-        "max_out": 750000,  # ~1M токенов контекста
+        "max_tokens": 190000,
     }
     await handle_model_selection(callback_query, model_config)
 
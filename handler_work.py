@@ -1,25 +1,89 @@
+import asyncio
 import base64
 import logging
 import re
+import time
+from contextlib import AsyncExitStack
+from typing import Optional
 
 from aiogram import F, Bot, types, flags
-from aiogram.client.session import aiohttp
 from aiogram.enums import ParseMode
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from aiogram.fsm.context import FSMContext
 from aiogram.types import Message
 from openai import NotFoundError
 
-from base import get_or_create_user_data, save_user_data
-from config_manager import get_openai_assistant_id
+from assistant_runs import ActiveRun, active_run, recover_thread, settle_thread
+from base import get_or_create_user_data, get_user_history, save_user_data
+from config_manager import (
+    get_openai_assistant_id,
+    get_prune_block_tokens,
+    get_stream_enabled,
+    get_stream_edit_interval,
+)
 from decorators import owner_only
+from file_index import upload_file
+from janitor import register_resource
 from function import (
-    prune_messages,
     process_voice_message,
     text_to_speech,
     download_image,
 )
-from openai_manager import get_async_openai_client
+from hedging import hedged, model_label
+from http_manager import get_http_session
+from openai_manager import (
+    get_async_openai_client,
+    record_prompt_usage,
+    openai_single_flight,
+    request_key,
+    scheduled,
+    estimate_tokens,
+)
+from response_cache import (
+    deterministic_params,
+    response_cache_key,
+    get_cached_response,
+    store_cached_response,
+)
+from summarizer import schedule_compaction
+from usage_ledger import track
+from vector_store_manager import (
+    add_documents,
+    drop_vector_store,
+    ensure_vector_store,
+)
+
+
+# Модели, поддерживающие потоковую выдачу в Chat Completions
+STREAMING_MODELS = {
+    "gpt-4o-mini",
+    "gpt-4o",
+    "gpt-4.1-2025-04-14",
+    "o1-mini",
+    "o1-preview",
+    "o3-mini",
+    "gpt-4o-search-preview",
+}
+
+
+def chat_params(model: str, messages: list) -> dict:
+    """Параметры запроса Chat Completions для модели"""
+    params = {"model": model, "messages": messages}
+    if model == "o3-mini":
+        params["reasoning_effort"] = "high"
+
+    if model == "gpt-4o-search-preview":
+        params["web_search_options"] = {
+            "search_context_size": "medium",
+        }
+    return deterministic_params(params)
+
+
+def answered_as(user_data: dict, model: str) -> dict:
+    """Данные для отправки ответа с подписью модели, которая его дала"""
+    if model == user_data["model"]:
+        return user_data
+    return {**user_data, "model_message_chat": model_label(model)}
 
 
 def register_handlers(router, bot: Bot):
@@ -61,43 +125,103 @@ def register_handlers(router, bot: Bot):
             "o1-pro",
             "gpt-4o-search-preview",
         ]:
-            # Добавляем сообщение пользователя в историю чата
-            user_data["messages"].append({"role": "user", "content": prompt})
+            # История загружается только для режимов чата
+            history = await get_user_history(user_id)
 
-            # Применяем функцию обрезки
-            pruned_messages = await prune_messages(
-                user_data["messages"], max_chars=user_data["max_out"]
-            )
+            # Добавляем сообщение пользователя в историю чата
+            history.append({"role": "user", "content": prompt})
 
             try:
                 # Добавляем роль system временно, без сохранения в контексте
-                system_message = {
-                    "role": "system",
-                    "content": user_data["system_message"],
-                }
+                system_message = None
+                summary_role = "user"
                 if user_data["model"] in [
                     "gpt-4o-mini",
                     "gpt-4o",
                     "gpt-4.1-2025-04-14",
                 ]:
-                    pruned_messages.insert(0, system_message)
+                    system_message = {
+                        "role": "system",
+                        "content": user_data["system_message"],
+                    }
+                    summary_role = "system"
+
+                # Окно контекста в пределах лимита модели; начало окна
+                # сдвигается блоками, чтобы префикс запроса попадал в кэш
+                max_tokens = user_data["max_tokens"]
+                block_tokens = min(get_prune_block_tokens(), max_tokens // 4)
+                context_messages = history.context_window(
+                    max_tokens,
+                    system=system_message,
+                    summary_role=summary_role,
+                    block_tokens=block_tokens,
+                )
 
                 # Формируем параметры для запроса
-                params = {
-                    "model": user_data["model"],
-                    "messages": pruned_messages,
-                }
-                if user_data["model"] == "o3-mini":
-                    params["reasoning_effort"] = "high"
-
-                if user_data["model"] == "gpt-4o-search-preview":
-                    params["web_search_options"] = {
-                        "search_context_size": "medium",
-                    }
+                params = chat_params(user_data["model"], context_messages)
+
+                # Кэш ответов: одинаковый запрос отдаётся без обращения к API
+                response_key = response_cache_key(params)
+                if response_key is not None:
+                    response_message = await get_cached_response(response_key)
+                    if response_message is not None:
+                        history.append(
+                            {"role": "assistant", "content": response_message}
+                        )
+                        user_data["count_messages"] += 1
+                        await save_user_data(user_id)
+                        schedule_compaction(
+                            user_id, history, max_tokens, block_tokens
+                        )
 
-                # Используем асинхронный клиент для вызова API OpenAI
-                client_async = get_async_openai_client()
-                chat_completion = await client_async.chat.completions.create(**params)
+                        await message.bot.delete_message(chat_id, last_message_id)
+                        await send_safe_message(message, response_message, user_data)
+                        return
+
+                # Потоковый режим: ответ появляется по мере генерации
+                if get_stream_enabled() and user_data["model"] in STREAMING_MODELS:
+                    response_message, answered_by = await stream_chat_completion(
+                        message, response, params, user_data
+                    )
+
+                    # Добавляем ответ модели в историю чата
+                    history.append(
+                        {"role": "assistant", "content": response_message}
+                    )
+                    user_data["count_messages"] += 1
+
+                    # Сохраняем обновленные данные
+                    await save_user_data(user_id)
+                    schedule_compaction(user_id, history, max_tokens, block_tokens)
+
+                    # Голосовой ответ
+                    if user_data.get("voice_answer"):
+                        await text_to_speech(chat_id, response_message)
+
+                    if response_key is not None and answered_by == params["model"]:
+                        await store_cached_response(
+                            response_key, params["model"], response_message
+                        )
+                    return
+
+                tokens = estimate_tokens(context_messages)
+
+                async def complete(model):
+                    # Клиент ключа с наибольшим запасом по лимитам модели
+                    async with track("chat", model, user_id) as entry, scheduled(
+                        model, tokens
+                    ) as client_async:
+                        completion = await client_async.chat.completions.create(
+                            **chat_params(model, context_messages)
+                        )
+                        entry.add_usage(completion.usage)
+                        return completion
+
+                # Медленный запрос дублируется в запасную модель
+                chat_completion, answered_by = await hedged(
+                    params["model"], complete, tokens=tokens
+                )
+                record_prompt_usage(answered_by, chat_completion.usage)
 
                 # Бот печатает...
                 await message.bot.send_chat_action(chat_id, action="typing")
@@ -106,19 +230,26 @@ def register_handlers(router, bot: Bot):
                 response_message = chat_completion.choices[0].message.content
 
                 # Добавляем ответ модели в историю чата
-                user_data["messages"].append(
-                    {"role": "assistant", "content": response_message}
-                )
+                history.append({"role": "assistant", "content": response_message})
                 user_data["count_messages"] += 1
 
                 # Сохраняем обновленные данные
                 await save_user_data(user_id)
+                schedule_compaction(user_id, history, max_tokens, block_tokens)
 
                 # Удаляем временное сообщение
                 await message.bot.delete_message(chat_id, last_message_id)
 
                 # Отправляем ответ через send_safe_message
-                await send_safe_message(message, response_message, user_data)
+                await send_safe_message(
+                    message, response_message, answered_as(user_data, answered_by)
+                )
+
+                # Ответ запасной модели не кэшируется под ключом основной
+                if response_key is not None and answered_by == params["model"]:
+                    await store_cached_response(
+                        response_key, params["model"], response_message
+                    )
                 return
 
             except Exception as e:
@@ -131,14 +262,17 @@ def register_handlers(router, bot: Bot):
         elif user_data["model"] == "dall-e-3":
             try:
                 # Используем асинхронный клиент для вызова API OpenAI
-                client_async = get_async_openai_client()
-                response = await client_async.images.generate(
-                    prompt=prompt,
-                    n=1,
-                    size=user_data["pic_size"],
-                    model="dall-e-3",
-                    quality=user_data["pic_grade"],
-                )
+                async with track("image", "dall-e-3", user_id) as entry, scheduled(
+                    "dall-e-3"
+                ) as client_async:
+                    entry.images = 1
+                    response = await client_async.images.generate(
+                        prompt=prompt,
+                        n=1,
+                        size=user_data["pic_size"],
+                        model="dall-e-3",
+                        quality=user_data["pic_grade"],
+                    )
             except Exception as e:
                 logging.exception(e)
                 await message.reply(
@@ -187,9 +321,10 @@ def register_handlers(router, bot: Bot):
             file_url = f"https://api.telegram.org/file/bot{message.bot.token}/{file_info.file_path}"
 
             base64_image = await download_and_encode_image(file_url)
-            ai_response = await process_image_with_gpt(text, base64_image)
+            ai_response = await process_image_with_gpt(text, base64_image, user_id)
 
-            user_data["messages"].append({"role": "assistant", "content": ai_response})
+            history = await get_user_history(user_id)
+            history.append({"role": "assistant", "content": ai_response})
             user_data["count_messages"] += 1
             await save_user_data(user_id)
 
@@ -201,15 +336,15 @@ def register_handlers(router, bot: Bot):
             await message.reply(f"Произошла ошибка: {e}", disable_web_page_preview=True)
 
     async def download_and_encode_image(url):
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as resp:
-                if resp.status == 200:
-                    image_content = await resp.read()
-                    base64_image = base64.b64encode(image_content).decode("utf-8")
-                    return f"data:image/jpeg;base64,{base64_image}"
+        # Общая сессия: соединение с сервером файлов Telegram переиспользуется
+        async with get_http_session().get(url) as resp:
+            if resp.status == 200:
+                image_content = await resp.read()
+                base64_image = base64.b64encode(image_content).decode("utf-8")
+                return f"data:image/jpeg;base64,{base64_image}"
         raise ValueError("Failed to download image")
 
-    async def process_image_with_gpt(text, base64_image):
+    async def process_image_with_gpt(text, base64_image, user_id=None):
         messages = [
             {
                 "role": "user",
@@ -219,10 +354,23 @@ def register_handlers(router, bot: Bot):
                 ],
             }
         ]
-        client_async = get_async_openai_client()
-        chat_completion = await client_async.chat.completions.create(
-            model="gpt-4o", messages=messages, max_tokens=4000
-        )
+
+        # Одинаковые изображения с одинаковым вопросом распознаются один раз
+        key = request_key("vision", "gpt-4o", "4000", text, base64_image)
+
+        async def recognize():
+            tokens = estimate_tokens(messages, 4000)
+            async with track("vision", "gpt-4o", user_id) as entry, scheduled(
+                "gpt-4o", tokens
+            ) as client_async:
+                completion = await client_async.chat.completions.create(
+                    model="gpt-4o", messages=messages, max_tokens=4000
+                )
+                entry.images = 1
+                entry.add_usage(completion.usage)
+                return completion
+
+        chat_completion = await openai_single_flight.do(key, recognize)
         return chat_completion.choices[0].message.content
 
 
@@ -230,284 +378,299 @@ async def handle_assistant_message(message: Message, user_data: dict, bot: Bot):
     user_id = message.from_user.id
     chat_id = message.chat.id
 
-    MAX_RETRIES = 3
+    # Повторы нужны только для восстановления треда
+    MAX_RETRIES = 2
     attempts = 0
+    # Зависший запуск уже отменяли - дальше только сброс треда
+    runs_recovered = False
 
-    while attempts <= MAX_RETRIES:
-        try:
-            # Обработка входящих данных
-            user_text = message.caption or message.text or ""
-            image_file_ids = []
-            document_attachments = []
+    history = await get_user_history(user_id)
 
-            # Получаем номер текущего ассистента сразу, чтобы он был доступен всем обработчикам
-            current_assistant = user_data.get("current_assistant", 1)
+    # Обработка входящих данных
+    user_text = message.caption or message.text or ""
+    image_file_ids = []
+    document_file_ids = []
 
-            # Обработка голосовых сообщений
-            if message.voice:
-                try:
-                    user_text = await process_voice_message(bot, message, user_id)
-                except Exception as e:
-                    logging.error(f"Ошибка обработки голоса: {str(e)}")
-                    await message.answer("⚠️ Ошибка распознавания голоса")
-                    return
-
-            # Обработка изображений
-            if message.photo:
-                try:
-                    photo = message.photo[-1]
-                    image_data = await download_image(bot, photo.file_id)
-
-                    # Загружаем изображение для vision - purpose="vision"
-                    client_async = get_async_openai_client()
-                    file = await client_async.files.create(
-                        file=("image.jpg", image_data, "image/jpeg"), purpose="vision"
-                    )
-                    image_file_ids.append(file.id)
-
-                except Exception as e:
-                    logging.error(f"Ошибка загрузки изображения из фото: {str(e)}")
-                    await message.answer("⚠️ Не удалось обработать изображение")
-                    return
-
-            # Обработка документов-изображений
-            if message.document and message.document.mime_type.startswith("image/"):
-                try:
-                    file_info = await bot.get_file(message.document.file_id)
-                    downloaded_file = await bot.download_file(file_info.file_path)
-                    file_data = downloaded_file.read()
-
-                    # Определяем mime-тип для правильного создания файла
-                    image_mime = message.document.mime_type
-                    extension = image_mime.split("/")[1]
-
-                    # Загружаем изображение-документ для vision - purpose="vision"
-                    client_async = get_async_openai_client()
-                    file = await client_async.files.create(
-                        file=(f"image.{extension}", file_data, image_mime),
-                        purpose="vision",
-                    )
-                    image_file_ids.append(file.id)
-
-                except Exception as e:
-                    logging.error(f"Ошибка загрузки изображения из документа: {str(e)}")
-                    await message.answer("⚠️ Не удалось обработать изображение-документ")
-                    return
+    # Получаем номер текущего ассистента сразу, чтобы он был доступен всем обработчикам
+    current_assistant = user_data.get("current_assistant", 1)
 
-            # Обработка документов (не изображений)
-            if message.document and not message.document.mime_type.startswith("image/"):
-                try:
-                    file_info = await bot.get_file(message.document.file_id)
-                    downloaded_file = await bot.download_file(file_info.file_path)
-                    file_data = downloaded_file.read()
-
-                    # Загружаем файл с purpose="assistants", что делает его доступным для всех тредов
-                    client_async = get_async_openai_client()
-                    uploaded_file = await client_async.files.create(
-                        file=(
-                            message.document.file_name,
-                            file_data,
-                            message.document.mime_type,
-                        ),
-                        purpose="assistants",
-                    )
-
-                    # Файлы с purpose="assistants" автоматически становятся доступными в тредах
-                    logging.info(
-                        f"Файл {uploaded_file.id} загружен для использования в тредах"
-                    )
-
-                    # Добавляем в attachments для текущего сообщения с указанием tools
-                    document_attachments.append(
-                        {
-                            "file_id": uploaded_file.id,
-                            "tools": [{"type": "file_search"}],
-                        }
-                    )
-
-                except Exception as e:
-                    logging.error(f"Ошибка загрузки документа: {str(e)}")
-                    await message.answer("⚠️ Не удалось обработать документ")
-                    return
-
-            # Выбор thread_id в зависимости от текущего ассистента
-            thread_id_key = get_thread_id_key(current_assistant)
-            thread_id = user_data.get(thread_id_key)
-
-            if not thread_id:
-                try:
-                    thread_id = await create_new_thread(
-                        user_data, user_id, current_assistant
-                    )
-                    if not thread_id:
-                        await message.answer(
-                            "⚠️ Ошибка создания нового треда. Попробуйте позже."
-                        )
-                        return
-                except Exception as e:
-                    logging.error(f"Непредвиденная ошибка при создании треда: {str(e)}")
-                    await message.answer(
-                        "⚠️ Ошибка создания нового треда. Попробуйте позже."
-                    )
-                    return
-
-            # Формирование контента сообщения
-            content = []
-            if user_text:
-                user_data["messages"].append({"role": "user", "content": user_text})
-                content.append({"type": "text", "text": user_text})
-
-            for file_id in image_file_ids:
-                content.append(
-                    {"type": "image_file", "image_file": {"file_id": file_id}}
-                )
+    # Обработка голосовых сообщений
+    if message.voice:
+        try:
+            user_text = await process_voice_message(bot, message, user_id)
+        except Exception as e:
+            logging.error(f"Ошибка обработки голоса: {str(e)}")
+            await message.answer("⚠️ Ошибка распознавания голоса")
+            return
 
-            if not content:
-                fallback_text = " "
-                user_data["messages"].append({"role": "user", "content": fallback_text})
-                content.append({"type": "text", "text": fallback_text})
+    # Обработка изображений
+    if message.photo:
+        try:
+            photo = message.photo[-1]
+            image_data = await download_image(bot, photo.file_id)
 
-            client_async = get_async_openai_client()
-            await client_async.beta.threads.messages.create(
-                thread_id=thread_id,
-                role="user",
-                content=content,
-                attachments=document_attachments,
+            # Загружаем изображение для vision - purpose="vision"
+            # (уже загруженное ранее берётся из индекса файлов)
+            file_id = await upload_file(
+                ("image.jpg", image_data, "image/jpeg"), "vision", user_id
             )
+            image_file_ids.append(file_id)
 
-            logging.info(
-                f"Сообщение создано в thread {thread_id} с {len(image_file_ids)} изображениями и {len(document_attachments)} документами"
-            )
+        except Exception as e:
+            logging.error(f"Ошибка загрузки изображения из фото: {str(e)}")
+            await message.answer("⚠️ Не удалось обработать изображение")
+            return
 
-            await bot.send_chat_action(chat_id, action="typing")
+    # Обработка документов-изображений
+    if message.document and message.document.mime_type.startswith("image/"):
+        try:
+            file_info = await bot.get_file(message.document.file_id)
+            downloaded_file = await bot.download_file(file_info.file_path)
+            file_data = downloaded_file.read()
 
-            assistant_id = get_assistant_id(user_data, current_assistant)
-            logging.info(f"Запуск ассистента {assistant_id} для пользователя {user_id}")
+            # Определяем mime-тип для правильного создания файла
+            image_mime = message.document.mime_type
+            extension = image_mime.split("/")[1]
 
-            client_async = get_async_openai_client()
-            run = await client_async.beta.threads.runs.create_and_poll(
-                thread_id=thread_id, assistant_id=assistant_id, timeout=60
+            # Загружаем изображение-документ для vision - purpose="vision"
+            file_id = await upload_file(
+                (f"image.{extension}", file_data, image_mime), "vision", user_id
             )
+            image_file_ids.append(file_id)
 
-            if run.status != "completed":
-                error_msg = f"Run завершился со статусом: {run.status}"
-                if run.last_error:
-                    error_msg += f" ({run.last_error.code}: {run.last_error.message})"
-                logging.error(f"Ошибка выполнения ассистента: {error_msg}")
-                raise Exception(error_msg)
-
-            logging.info(f"Run завершен успешно: {run.id}, получаем сообщения")
+        except Exception as e:
+            logging.error(f"Ошибка загрузки изображения из документа: {str(e)}")
+            await message.answer("⚠️ Не удалось обработать изображение-документ")
+            return
 
-            messages = await client_async.beta.threads.messages.list(
-                thread_id=thread_id, limit=1, run_id=run.id
+    # Обработка документов (не изображений)
+    if message.document and not message.document.mime_type.startswith("image/"):
+        try:
+            file_info = await bot.get_file(message.document.file_id)
+            downloaded_file = await bot.download_file(file_info.file_path)
+            file_data = downloaded_file.read()
+
+            # Загружаем файл с purpose="assistants", что делает его доступным для всех тредов
+            # Тот же документ, отправленный повторно, берётся из индекса файлов
+            uploaded_file_id = await upload_file(
+                (
+                    message.document.file_name,
+                    file_data,
+                    message.document.mime_type,
+                ),
+                "assistants",
+                user_id,
             )
 
-            if not messages.data:
-                raise Exception("Пустой ответ от ассистента")
+            # Файлы с purpose="assistants" автоматически становятся доступными в тредах
+            logging.info(f"Файл {uploaded_file_id} загружен для использования в тредах")
 
-            assistant_message = messages.data[0]
-            text_response = []
-            response_files = []
-            response_images = []
+            # Документ индексируется в векторном хранилище пользователя
+            document_file_ids.append(uploaded_file_id)
 
-            logging.info(f"Получено сообщение от ассистента: {assistant_message.id}")
-            logging.info(
-                f"Количество блоков контента: {len(assistant_message.content)}"
-            )
+        except Exception as e:
+            logging.error(f"Ошибка загрузки документа: {str(e)}")
+            await message.answer("⚠️ Не удалось обработать документ")
+            return
 
-            for content_block in assistant_message.content:
-                if content_block.type == "text":
-                    cleaned_text = content_block.text.value
-                    annotations = content_block.text.annotations
+    # Формирование контента сообщения
+    content = []
+    if user_text:
+        history.append({"role": "user", "content": user_text})
+        content.append({"type": "text", "text": user_text})
+
+    for file_id in image_file_ids:
+        content.append({"type": "image_file", "image_file": {"file_id": file_id}})
+
+    if not content:
+        fallback_text = " "
+        history.append({"role": "user", "content": fallback_text})
+        content.append({"type": "text", "text": fallback_text})
+
+    # Временное сообщение, в котором ответ появляется по мере генерации;
+    # одно на все попытки
+    placeholder = await message.answer("⏳ Подождите, Ваш запрос обрабатывается!")
+    # Временное сообщение заменено ответом или текстом ошибки
+    settled = False
+
+    async def show_error(text: str) -> None:
+        nonlocal settled
+        settled = True
+        try:
+            await placeholder.edit_text(text)
+        except Exception as e:
+            logging.warning(f"Не удалось обновить временное сообщение: {str(e)}")
+            await message.answer(text)
 
-                    logging.info(f"Текстовый блок с {len(annotations)} аннотациями")
+    try:
+        while attempts <= MAX_RETRIES:
+            thread_id = None
+            try:
+                # Выбор thread_id в зависимости от текущего ассистента
+                thread_id_key = get_thread_id_key(current_assistant)
+                thread_id = user_data.get(thread_id_key)
 
-                    for idx, ann in enumerate(annotations):
-                        if hasattr(ann, "file_path"):
-                            file_id = ann.file_path.file_id
-                            response_files.append(file_id)
-                            logging.info(f"Обнаружен файл в аннотации: {file_id}")
-                            cleaned_text = cleaned_text.replace(
-                                ann.text, f" [Файл {idx + 1}]"
+                if not thread_id:
+                    try:
+                        thread_id = await create_new_thread(
+                            user_data, user_id, current_assistant
+                        )
+                        if not thread_id:
+                            await show_error(
+                                "⚠️ Ошибка создания нового треда. Попробуйте позже."
                             )
+                            return
+                    except Exception as e:
+                        logging.error(
+                            f"Непредвиденная ошибка при создании треда: {str(e)}"
+                        )
+                        await show_error(
+                            "⚠️ Ошибка создания нового треда. Попробуйте позже."
+                        )
+                        return
 
-                    text_response.append(cleaned_text.strip())
+                # Ждём отмены запуска, брошенного предыдущим сообщением
+                await settle_thread(thread_id)
 
-                elif content_block.type == "image_file":
-                    image_id = content_block.image_file.file_id
-                    logging.info(f"Обнаружено изображение в ответе: {image_id}")
-                    response_images.append(image_id)
-                else:
-                    logging.warning(
-                        f"Неизвестный тип блока контента: {content_block.type}"
-                    )
+                # Истёкшее хранилище документов сорвало бы запуск
+                try:
+                    await ensure_vector_store(user_id, current_assistant, thread_id)
+                except Exception as e:
+                    logging.error(f"Ошибка проверки векторного хранилища: {str(e)}")
 
-            if text_response:
-                full_text = "\n".join(text_response)
-                user_data["messages"].append(
-                    {"role": "assistant", "content": full_text}
-                )
-                user_data["count_messages"] += 1
-                await save_user_data(user_id)
+                # Документы добавляются в постоянное хранилище, подключённое к треду:
+                # повторный вопрос по ним не ждёт индексации
+                document_attachments = []
+                if document_file_ids:
+                    try:
+                        await add_documents(
+                            user_id, current_assistant, thread_id, document_file_ids
+                        )
+                    except Exception as e:
+                        logging.error(
+                            f"Ошибка векторного хранилища, документы прикрепляются "
+                            f"к сообщению: {str(e)}"
+                        )
+                        document_attachments = [
+                            {"file_id": file_id, "tools": [{"type": "file_search"}]}
+                            for file_id in document_file_ids
+                        ]
 
-                await send_safe_message(message, full_text, user_data)
-            else:
-                logging.warning("Получен ответ без текста")
+                client_async = get_async_openai_client()
+                await client_async.beta.threads.messages.create(
+                    thread_id=thread_id,
+                    role="user",
+                    content=content,
+                    attachments=document_attachments,
+                )
 
-            logging.info(f"Найдено {len(response_files)} файлов для отправки")
-            for file_id in response_files:
-                file_sent = await send_file_to_user(
-                    bot, file_id, message, chat_id, is_image=False
+                logging.info(
+                    f"Сообщение создано в thread {thread_id} с {len(image_file_ids)} изображениями и {len(document_file_ids)} документами"
                 )
-                if not file_sent:
-                    logging.warning(f"Не удалось отправить файл {file_id}")
 
-            logging.info(f"Найдено {len(response_images)} изображений для отправки")
-            for file_id in response_images:
-                image_sent = await send_file_to_user(
-                    bot, file_id, message, chat_id, is_image=True
+                assistant_id = get_assistant_id(user_data, current_assistant)
+                logging.info(
+                    f"Запуск ассистента {assistant_id} для пользователя {user_id}"
                 )
-                if not image_sent:
-                    logging.warning(f"Не удалось отправить изображение {file_id}")
 
-            break
+                async with track(
+                    "assistant", assistant_id, user_id
+                ) as entry, active_run(client_async, user_id, thread_id) as active:
+                    result = await stream_assistant_run(
+                        message,
+                        placeholder,
+                        client_async,
+                        thread_id,
+                        assistant_id,
+                        user_data,
+                        entry,
+                        active,
+                    )
+                full_text, response_files, response_images = result
+                # Временное сообщение стало ответом
+                settled = True
+
+                if full_text:
+                    history.append({"role": "assistant", "content": full_text})
+                    user_data["count_messages"] += 1
+                    await save_user_data(user_id)
+
+                    # Голосовой ответ
+                    if user_data.get("voice_answer"):
+                        await text_to_speech(chat_id, full_text)
+                else:
+                    logging.warning("Получен ответ без текста")
 
-        except NotFoundError:
-            logging.warning("Тред не найден, создаём новый тред и повторяем попытку.")
-            current_assistant = user_data.get("current_assistant", 1)
+                logging.info(f"Найдено {len(response_files)} файлов для отправки")
+                for file_id in response_files:
+                    file_sent = await send_file_to_user(
+                        bot, file_id, message, chat_id, is_image=False
+                    )
+                    if not file_sent:
+                        logging.warning(f"Не удалось отправить файл {file_id}")
 
-            # Сбрасываем текущий thread_id и создаем новый
-            await reset_thread(user_data, user_id, current_assistant)
+                logging.info(f"Найдено {len(response_images)} изображений для отправки")
+                for file_id in response_images:
+                    image_sent = await send_file_to_user(
+                        bot, file_id, message, chat_id, is_image=True
+                    )
+                    if not image_sent:
+                        logging.warning(f"Не удалось отправить изображение {file_id}")
 
-            attempts += 1
-            if attempts > MAX_RETRIES:
-                logging.error("Максимальное количество попыток достигнуто.")
-                await message.answer(
-                    "⚠️ Не удалось создать новый тред. Попробуйте позже."
-                )
                 break
 
-        except Exception as e:
-            if "Can't add messages to thread" in str(e):
+            except NotFoundError:
                 logging.warning(
-                    "Невозможно добавить сообщение в тред. Создаём новый тред."
+                    "Тред не найден, создаём новый тред и повторяем попытку."
                 )
-                current_assistant = user_data.get("current_assistant", 1)
 
-                # Сбрасываем текущий thread_id
+                # Сбрасываем текущий thread_id и создаем новый
                 await reset_thread(user_data, user_id, current_assistant)
 
                 attempts += 1
                 if attempts > MAX_RETRIES:
                     logging.error("Максимальное количество попыток достигнуто.")
-                    await message.answer(
-                        "⚠️ Не удалось добавить сообщение в тред. Попробуйте позже."
+                    await show_error(
+                        "⚠️ Не удалось создать новый тред. Попробуйте позже."
                     )
                     break
-            else:
-                logging.exception("Assistant error:")
-                await message.answer(f"⚠️ Ошибка: {str(e)}")
-                break
+
+            except Exception as e:
+                if "Can't add messages to thread" in str(e):
+                    attempts += 1
+                    if attempts > MAX_RETRIES:
+                        logging.error("Максимальное количество попыток достигнуто.")
+                        await show_error(
+                            "⚠️ Не удалось добавить сообщение в тред. Попробуйте позже."
+                        )
+                        break
+
+                    # Тред занят запуском: сначала отменяем его, сохраняя контекст
+                    if not runs_recovered:
+                        runs_recovered = True
+                        client_async = get_async_openai_client()
+                        try:
+                            if await recover_thread(client_async, thread_id):
+                                continue
+                        except Exception as err:
+                            logging.error(f"Ошибка отмены запусков треда: {str(err)}")
+
+                    logging.warning(
+                        "Невозможно добавить сообщение в тред. Создаём новый тред."
+                    )
+                    # Сбрасываем текущий thread_id
+                    await reset_thread(user_data, user_id, current_assistant)
+                else:
+                    logging.exception("Assistant error:")
+                    await show_error(f"⚠️ Ошибка: {str(e)}")
+                    break
+    finally:
+        if not settled:
+            # Запрос прерван без ответа - временное сообщение не оставляем
+            try:
+                await placeholder.delete()
+            except Exception as e:
+                logging.warning(f"Не удалось удалить временное сообщение: {str(e)}")
 
 
 def get_thread_id_key(assistant_number):
@@ -533,6 +696,9 @@ async def reset_thread(user_data, user_id, current_assistant):
         # Сохраняем данные пользователя
         await save_user_data(user_id)
 
+        # Хранилище документов живёт столько же, сколько тред
+        await drop_vector_store(user_id, current_assistant)
+
         logging.info(
             f"Успешно сброшен thread_id для ассистента {current_assistant}: {old_thread_id}"
         )
@@ -560,224 +726,203 @@ def get_assistant_id(user_data, assistant_number):
     return get_openai_assistant_id(assistant_number)
 
 
-async def send_safe_message(message: Message, text: str, user_data: dict) -> None:
-    """Отправка сообщений с удалением маркеров заголовков, конструкций вида 【...】
-    и сохранением кода."""
-    try:
-        # Шаг 1: Извлечение блоков кода
-        code_blocks = []
-        parts = re.split(r"(```[\s\S]*?```)", text)
-
-        processed_parts = []
-        for i, part in enumerate(parts):
-            if i % 2 == 1:
-                code_blocks.append(part)
-                processed_parts.append(f"%%CODE_BLOCK_{len(code_blocks) - 1}%%")
-            else:
-                cleaned_part = re.sub(r"#{2,4}\s+", "", part)
-                cleaned_part = re.sub(r"【[^】]*】", "", cleaned_part)
-                processed_parts.append(cleaned_part)
-
-        formatted_text = "".join(processed_parts)
-
-        # Шаг 2: Разбивка на части ≤ 4000 символов (более безопасный лимит для Telegram)
-        max_chunk_size = 4000
-        chunks = []
-        current_chunk = []
-        current_length = 0
-
-        # Разбиваем текст на строки
-        lines = formatted_text.split("\n")
-
-        for line in lines:
-            # Если строка слишком длинная, разбиваем её на подстроки
-            if len(line) > max_chunk_size:
-                # Сначала добавляем текущий chunk, если он не пустой
-                if current_chunk:
-                    chunks.append("\n".join(current_chunk))
-                    current_chunk = []
-                    current_length = 0
-
-                # Разбиваем длинную строку на части по max_chunk_size символов
-                # Стараемся делить по пробелам, когда возможно
-                start = 0
-                while start < len(line):
-                    # Если оставшаяся часть строки помещается в chunk
-                    if len(line) - start <= max_chunk_size:
-                        part = line[start:]
-                        chunks.append(part)
-                        start = len(line)
-                    else:
-                        # Ищем последний пробел в диапазоне
-                        end = start + max_chunk_size
-                        split_pos = line.rfind(" ", start, end)
-
-                        # Если пробел не найден, просто разрезаем по размеру
-                        if split_pos == -1 or split_pos <= start:
-                            part = line[start:end]
-                            start = end
-                        else:
-                            part = line[start:split_pos]
-                            start = split_pos + 1  # +1 чтобы пропустить пробел
-
-                        chunks.append(part)
-            else:
-                # Обычная обработка для строк нормальной длины
-                line_length = len(line) + 1  # +1 для символа новой строки
-                if current_length + line_length > max_chunk_size:
-                    chunks.append("\n".join(current_chunk))
-                    current_chunk = [line]
-                    current_length = line_length
+# Безопасный лимит длины одного сообщения Telegram
+MAX_MESSAGE_LENGTH = 4000
+
+
+def split_safe_chunks(text: str) -> list[str]:
+    """
+    Удаляет маркеры заголовков и конструкции вида 【...】, сохраняя код,
+    и делит текст на части не длиннее MAX_MESSAGE_LENGTH.
+    """
+    # Шаг 1: Извлечение блоков кода
+    code_blocks = []
+    parts = re.split(r"(```[\s\S]*?```)", text)
+
+    processed_parts = []
+    for i, part in enumerate(parts):
+        if i % 2 == 1:
+            code_blocks.append(part)
+            processed_parts.append(f"%%CODE_BLOCK_{len(code_blocks) - 1}%%")
+        else:
+            cleaned_part = re.sub(r"#{2,4}\s+", "", part)
+            cleaned_part = re.sub(r"【[^】]*】", "", cleaned_part)
+            processed_parts.append(cleaned_part)
+
+    formatted_text = "".join(processed_parts)
+
+    # Шаг 2: Разбивка на части ≤ 4000 символов (более безопасный лимит для Telegram)
+    max_chunk_size = MAX_MESSAGE_LENGTH
+    chunks = []
+    current_chunk = []
+    current_length = 0
+
+    # Разбиваем текст на строки
+    lines = formatted_text.split("\n")
+
+    for line in lines:
+        # Если строка слишком длинная, разбиваем её на подстроки
+        if len(line) > max_chunk_size:
+            # Сначала добавляем текущий chunk, если он не пустой
+            if current_chunk:
+                chunks.append("\n".join(current_chunk))
+                current_chunk = []
+                current_length = 0
+
+            # Разбиваем длинную строку на части по max_chunk_size символов
+            # Стараемся делить по пробелам, когда возможно
+            start = 0
+            while start < len(line):
+                # Если оставшаяся часть строки помещается в chunk
+                if len(line) - start <= max_chunk_size:
+                    part = line[start:]
+                    chunks.append(part)
+                    start = len(line)
                 else:
-                    current_chunk.append(line)
-                    current_length += line_length
-
-        # Добавляем последний chunk, если он есть
-        if current_chunk:
-            chunks.append("\n".join(current_chunk))
-
-        # Шаг 3: Восстановление блоков кода
-        final_chunks = []
-        for chunk in chunks:
-            restored_chunk = chunk
-            for idx, code in enumerate(code_blocks):
-                restored_chunk = restored_chunk.replace(f"%%CODE_BLOCK_{idx}%%", code)
-            final_chunks.append(restored_chunk)
-
-        # Функция для конвертации Markdown в HTML
-        def markdown_to_html(text):
-            # Обработка блоков кода (многострочных)
-            code_blocks_html = []
-            parts = re.split(r"(```[\s\S]*?```)", text)
-
-            result_parts = []
-            for i, part in enumerate(parts):
-                if i % 2 == 1:  # Это блок кода
-                    # Извлекаем язык программирования, если указан
-                    lang_match = re.match(r"```(\w*)\n([\s\S]*?)```", part)
-                    if lang_match:
-                        lang, code_content = lang_match.groups()
-                        if lang:
-                            html_code = f'<pre><code class="language-{lang}">{code_content}</code></pre>'
-                        else:
-                            html_code = f"<pre>{code_content}</pre>"
+                    # Ищем последний пробел в диапазоне
+                    end = start + max_chunk_size
+                    split_pos = line.rfind(" ", start, end)
+
+                    # Если пробел не найден, просто разрезаем по размеру
+                    if split_pos == -1 or split_pos <= start:
+                        part = line[start:end]
+                        start = end
                     else:
-                        # Если формат не соответствует ожидаемому, сохраняем как простой блок кода
-                        code_content = part.strip("`").strip()
-                        html_code = f"<pre>{code_content}</pre>"
+                        part = line[start:split_pos]
+                        start = split_pos + 1  # +1 чтобы пропустить пробел
 
-                    code_blocks_html.append(html_code)
-                    result_parts.append(
-                        f"%%HTML_CODE_BLOCK_{len(code_blocks_html) - 1}%%"
-                    )
+                    chunks.append(part)
+        else:
+            # Обычная обработка для строк нормальной длины
+            line_length = len(line) + 1  # +1 для символа новой строки
+            if current_length + line_length > max_chunk_size:
+                chunks.append("\n".join(current_chunk))
+                current_chunk = [line]
+                current_length = line_length
+            else:
+                current_chunk.append(line)
+                current_length += line_length
+
+    # Добавляем последний chunk, если он есть
+    if current_chunk:
+        chunks.append("\n".join(current_chunk))
+
+    # Шаг 3: Восстановление блоков кода
+    final_chunks = []
+    for chunk in chunks:
+        restored_chunk = chunk
+        for idx, code in enumerate(code_blocks):
+            restored_chunk = restored_chunk.replace(f"%%CODE_BLOCK_{idx}%%", code)
+        final_chunks.append(restored_chunk)
+
+    return final_chunks
+
+
+def markdown_to_html(text):
+    """Конвертирует разметку Markdown в HTML"""
+    # Обработка блоков кода (многострочных)
+    code_blocks_html = []
+    parts = re.split(r"(```[\s\S]*?```)", text)
+
+    result_parts = []
+    for i, part in enumerate(parts):
+        if i % 2 == 1:  # Это блок кода
+            # Извлекаем язык программирования, если указан
+            lang_match = re.match(r"```(\w*)\n([\s\S]*?)```", part)
+            if lang_match:
+                lang, code_content = lang_match.groups()
+                if lang:
+                    html_code = f'<pre><code class="language-{lang}">{code_content}</code></pre>'
                 else:
-                    # Обработка строчных элементов
-                    # Заменяем разметку жирного текста
-                    processed_part = re.sub(r"\*(.*?)\*", r"<b>\1</b>", part)
-                    # Заменяем разметку курсива
-                    processed_part = re.sub(r"_(.*?)_", r"<i>\1</i>", processed_part)
-                    # Заменяем разметку инлайн-кода
-                    processed_part = re.sub(
-                        r"`(.*?)`", r"<code>\1</code>", processed_part
-                    )
-                    # Заменяем ссылки [text](url)
-                    processed_part = re.sub(
-                        r"\[(.*?)\]\((.*?)\)", r'<a href="\2">\1</a>', processed_part
-                    )
+                    html_code = f"<pre>{code_content}</pre>"
+            else:
+                # Если формат не соответствует ожидаемому, сохраняем как простой блок кода
+                code_content = part.strip("`").strip()
+                html_code = f"<pre>{code_content}</pre>"
 
-                    result_parts.append(processed_part)
+            code_blocks_html.append(html_code)
+            result_parts.append(f"%%HTML_CODE_BLOCK_{len(code_blocks_html) - 1}%%")
+        else:
+            # Обработка строчных элементов
+            # Заменяем разметку жирного текста
+            processed_part = re.sub(r"\*(.*?)\*", r"<b>\1</b>", part)
+            # Заменяем разметку курсива
+            processed_part = re.sub(r"_(.*?)_", r"<i>\1</i>", processed_part)
+            # Заменяем разметку инлайн-кода
+            processed_part = re.sub(r"`(.*?)`", r"<code>\1</code>", processed_part)
+            # Заменяем ссылки [text](url)
+            processed_part = re.sub(
+                r"\[(.*?)\]\((.*?)\)", r'<a href="\2">\1</a>', processed_part
+            )
+
+            result_parts.append(processed_part)
 
-            # Собираем результат и восстанавливаем блоки кода
-            result = "".join(result_parts)
-            for idx, code in enumerate(code_blocks_html):
-                result = result.replace(f"%%HTML_CODE_BLOCK_{idx}%%", code)
+    # Собираем результат и восстанавливаем блоки кода
+    result = "".join(result_parts)
+    for idx, code in enumerate(code_blocks_html):
+        result = result.replace(f"%%HTML_CODE_BLOCK_{idx}%%", code)
 
-            return result
+    return result
 
-        # Шаг 4: Отправка сообщений с безопасной обработкой разметки
-        for i, chunk in enumerate(final_chunks):
+
+async def deliver_with_fallback(send, text: str) -> None:
+    """
+    Отправляет (или редактирует) сообщение, последовательно пробуя
+    MARKDOWN, HTML и текст без разметки.
+    send - корутина вида send(text, parse_mode).
+    """
+    try:
+        # Сначала пробуем отправить с MARKDOWN - без экранирования
+        await send(text, ParseMode.MARKDOWN)
+    except TelegramBadRequest as e:
+        if "message is not modified" in str(e):
+            # Текст уже совпадает с отображаемым
+            return
+        # Если ошибка в разметке, попробуем с HTML
+        if "can't parse entities" in str(e):
+            try:
+                # Конвертируем разметку Markdown в HTML
+                await send(markdown_to_html(text), ParseMode.HTML)
+            except TelegramBadRequest as html_error:
+                # Если и HTML не сработал, логируем ошибку и отправляем без форматирования
+                logging.error(f"HTML-разметка не сработала: {str(html_error)}")
+                await send(text[:MAX_MESSAGE_LENGTH], None)
+        else:
+            # Если другая ошибка
+            await send(text[:MAX_MESSAGE_LENGTH], None)
+
+
+async def send_safe_message(message: Message, text: str, user_data: dict) -> None:
+    """Отправка сообщений с удалением маркеров заголовков, конструкций вида 【...】
+    и сохранением кода."""
+    try:
+
+        async def reply(chunk_text, parse_mode):
+            await message.reply(
+                chunk_text, parse_mode=parse_mode, disable_web_page_preview=True
+            )
+
+        async def answer(chunk_text, parse_mode):
+            await message.answer(
+                chunk_text, parse_mode=parse_mode, disable_web_page_preview=True
+            )
+
+        # Отправка сообщений с безопасной обработкой разметки
+        for i, chunk in enumerate(split_safe_chunks(text)):
             try:
                 if i == 0:
                     # Безопасно отправляем первое сообщение с префиксом модели
                     msg_text = f"**{user_data['model_message_chat']}**{chunk}"
-                    try:
-                        # Сначала пробуем отправить с MARKDOWN - без экранирования
-                        await message.reply(
-                            msg_text,
-                            parse_mode=ParseMode.MARKDOWN,
-                            disable_web_page_preview=True,
-                        )
-                    except TelegramBadRequest as e:
-                        # Если ошибка в разметке, попробуем с HTML
-                        if "can't parse entities" in str(e):
-                            try:
-                                # Конвертируем разметку Markdown в HTML
-                                html_text = markdown_to_html(msg_text)
-
-                                await message.reply(
-                                    html_text,
-                                    parse_mode=ParseMode.HTML,
-                                    disable_web_page_preview=True,
-                                )
-                            except TelegramBadRequest as html_error:
-                                # Если и HTML не сработал, логируем ошибку и отправляем без форматирования
-                                logging.error(
-                                    f"HTML-разметка не сработала: {str(html_error)}"
-                                )
-                                await message.reply(
-                                    msg_text[:4000],
-                                    parse_mode=None,
-                                    disable_web_page_preview=True,
-                                )
-                        else:
-                            # Если другая ошибка
-                            await message.reply(
-                                msg_text[:4000],
-                                parse_mode=None,
-                                disable_web_page_preview=True,
-                            )
+                    await deliver_with_fallback(reply, msg_text)
                 else:
                     # Последующие сообщения
-                    try:
-                        # Также пробуем с MARKDOWN сначала
-                        await message.answer(
-                            chunk,
-                            parse_mode=ParseMode.MARKDOWN,
-                            disable_web_page_preview=True,
-                        )
-                    except TelegramBadRequest as e:
-                        # Если ошибка в разметке, пробуем HTML
-                        if "can't parse entities" in str(e):
-                            try:
-                                # Конвертируем разметку Markdown в HTML
-                                html_chunk = markdown_to_html(chunk)
-
-                                await message.answer(
-                                    html_chunk,
-                                    parse_mode=ParseMode.HTML,
-                                    disable_web_page_preview=True,
-                                )
-                            except TelegramBadRequest as html_error:
-                                # Если и HTML не сработал, логируем ошибку и отправляем без форматирования
-                                logging.error(
-                                    f"HTML-разметка не сработала: {str(html_error)}"
-                                )
-                                await message.answer(
-                                    chunk[:4000],
-                                    parse_mode=None,
-                                    disable_web_page_preview=True,
-                                )
-                        else:
-                            # Если другая ошибка
-                            await message.answer(
-                                chunk[:4000],
-                                parse_mode=None,
-                                disable_web_page_preview=True,
-                            )
+                    await deliver_with_fallback(answer, chunk)
             except Exception as e:
                 # Отправляем сообщение без разметки как последнее средство
                 logging.error(f"Ошибка при отправке сообщения: {str(e)}")
-                await message.answer(chunk[:4000], disable_web_page_preview=True)
+                await message.answer(
+                    chunk[:MAX_MESSAGE_LENGTH], disable_web_page_preview=True
+                )
 
         # Голосовой ответ
         if user_data.get("voice_answer"):
@@ -787,11 +932,435 @@ async def send_safe_message(message: Message, text: str, user_data: dict) -> Non
         logging.error(f"Ошибка в send_safe_message: {str(e)}")
         # В случае полного сбоя, отправляем текст без обработки, сократив до безопасной длины
         try:
-            await message.answer(text[:4000], disable_web_page_preview=True)
+            await message.answer(
+                text[:MAX_MESSAGE_LENGTH], disable_web_page_preview=True
+            )
         except Exception as err:
             logging.error(f"Критическая ошибка при отправке сообщения: {str(err)}")
 
 
+class StreamingReply:
+    """
+    Живой ответ: временное сообщение редактируется по мере поступления токенов.
+    Редактирования ограничены по частоте, при превышении лимита длины
+    текст переносится в новое сообщение, а финальная разметка применяется
+    один раз после завершения потока.
+    """
+
+    def __init__(self, message: Message, placeholder: Message, user_data: dict):
+        self.message = message
+        self.user_data = user_data
+        self.interval = get_stream_edit_interval()
+        # Сообщения, в которых уже отображается ответ
+        self._live_messages = [placeholder]
+        # Готовые (перенесённые) части ответа и части текущего сообщения
+        self._done_segments: list[str] = []
+        self._segment_parts: list[str] = []
+        self._segment_length = 0
+        self._shown = ""
+        self._next_edit = 0.0
+        # Строка состояния под текстом (например, ход выполнения кода)
+        self._note = ""
+
+    @property
+    def text(self) -> str:
+        return "".join(self._done_segments) + "".join(self._segment_parts)
+
+    def _header(self) -> str:
+        # Префикс модели показываем только в первом сообщении
+        if len(self._live_messages) == 1:
+            return self.user_data["model_message_chat"]
+        return ""
+
+    async def feed(self, delta: str) -> None:
+        """Добавляет очередной фрагмент ответа и при необходимости обновляет сообщение"""
+        self._note = ""
+        self._segment_parts.append(delta)
+        self._segment_length += len(delta)
+
+        # Перенос в новое сообщение при достижении лимита Telegram
+        while len(self._header()) + self._segment_length > MAX_MESSAGE_LENGTH:
+            await self._roll_over()
+
+        if time.monotonic() >= self._next_edit:
+            await self._edit_live()
+
+    async def progress(self, note: str) -> None:
+        """Показывает строку состояния под текстом до следующего фрагмента"""
+        self._note = note
+        if time.monotonic() >= self._next_edit:
+            await self._edit_live()
+
+    async def _roll_over(self) -> None:
+        segment = "".join(self._segment_parts)
+        limit = MAX_MESSAGE_LENGTH - len(self._header())
+
+        # Стараемся разрезать по переводу строки или пробелу
+        cut = segment.rfind("\n", 0, limit)
+        if cut < limit // 2:
+            cut = segment.rfind(" ", 0, limit)
+        if cut < limit // 2:
+            cut = limit
+
+        head, tail = segment[:cut], segment[cut:]
+        self._segment_parts = [head]
+        self._segment_length = len(head)
+        await self._edit_live(force=True)
+
+        self._done_segments.append(head)
+        self._segment_parts = [tail]
+        self._segment_length = len(tail)
+        self._shown = ""
+
+        try:
+            continuation = await self.message.answer("⏳")
+            self._live_messages.append(continuation)
+        except Exception as e:
+            logging.warning(f"Не удалось создать сообщение-продолжение: {e}")
+            raise
+
+    async def _edit_live(self, force: bool = False) -> None:
+        # Во время генерации показываем текст без разметки:
+        # незакрытые маркеры Markdown ломают разбор сущностей
+        text = self._header() + "".join(self._segment_parts)
+        if self._note:
+            text = f"{text.rstrip()}\n\n{self._note}"
+        if not text.strip() or text == self._shown:
+            return
+
+        now = time.monotonic()
+        self._next_edit = now + self.interval
+        try:
+            await self._live_messages[-1].edit_text(
+                text, parse_mode=None, disable_web_page_preview=True
+            )
+            self._shown = text
+        except TelegramRetryAfter as e:
+            # Telegram просит подождать - откладываем следующее редактирование
+            self._next_edit = now + e.retry_after
+        except TelegramBadRequest as e:
+            if "message is not modified" not in str(e):
+                logging.warning(f"Не удалось обновить потоковое сообщение: {e}")
+            if force:
+                self._shown = text
+
+    async def finish(self, text: Optional[str] = None) -> str:
+        """
+        Применяет финальную разметку: переиспользует живые сообщения,
+        досылает недостающие части и удаляет лишние.
+        text заменяет накопленный текст, если итоговый ответ отличается
+        от показанного по ходу генерации.
+        """
+        full_text = self.text if text is None else text
+        chunks = split_safe_chunks(full_text)
+
+        for i, chunk in enumerate(chunks):
+            msg_text = (
+                f"**{self.user_data['model_message_chat']}**{chunk}" if i == 0 else chunk
+            )
+            try:
+                if i < len(self._live_messages):
+                    live_message = self._live_messages[i]
+
+                    async def send(chunk_text, parse_mode, live_message=live_message):
+                        await live_message.edit_text(
+                            chunk_text,
+                            parse_mode=parse_mode,
+                            disable_web_page_preview=True,
+                        )
+
+                else:
+
+                    async def send(chunk_text, parse_mode):
+                        await self.message.answer(
+                            chunk_text,
+                            parse_mode=parse_mode,
+                            disable_web_page_preview=True,
+                        )
+
+                await deliver_with_fallback(send, msg_text)
+            except Exception as e:
+                # Отправляем сообщение без разметки как последнее средство
+                logging.error(f"Ошибка при финальной отправке сообщения: {str(e)}")
+                await self.message.answer(
+                    chunk[:MAX_MESSAGE_LENGTH], disable_web_page_preview=True
+                )
+
+        # Удаляем живые сообщения, которые не понадобились после разбивки
+        for extra_message in self._live_messages[len(chunks) :]:
+            try:
+                await extra_message.delete()
+            except Exception as e:
+                logging.warning(f"Не удалось удалить лишнее сообщение: {e}")
+
+        return full_text
+
+
+class OpenedStream:
+    """Поток ответа модели, по которому уже получен первый фрагмент"""
+
+    def __init__(self, model: str, stack: AsyncExitStack, entry, stream, first_chunk):
+        self.model = model
+        self.stack = stack
+        self.entry = entry
+        self.stream = stream
+        self.first_chunk = first_chunk
+
+    async def chunks(self):
+        if self.first_chunk is not None:
+            yield self.first_chunk
+            async for chunk in self.stream:
+                yield chunk
+
+    async def close(self, error: Optional[BaseException] = None) -> None:
+        if error is None:
+            await self.stack.aclose()
+        else:
+            await self.stack.__aexit__(type(error), error, error.__traceback__)
+
+    async def discard(self) -> None:
+        """Закрывает поток, ответ которого не понадобился"""
+        self.entry.status = "cancelled"
+        await self.close()
+
+
+async def open_chat_stream(
+    model: str, messages: list, tokens: int, user_id: Optional[int] = None
+) -> OpenedStream:
+    """
+    Открывает поток ответа модели и ждёт первый фрагмент.
+    Слот модели в планировщике занят до закрытия потока.
+    """
+    stack = AsyncExitStack()
+    try:
+        entry = await stack.enter_async_context(track("chat", model, user_id))
+        client_async = await stack.enter_async_context(scheduled(model, tokens))
+        stream = await client_async.chat.completions.create(
+            **chat_params(model, messages),
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        stack.push_async_callback(stream.close)
+        first_chunk = await anext(stream, None)
+    except BaseException as e:
+        await stack.__aexit__(type(e), e, e.__traceback__)
+        raise
+    return OpenedStream(model, stack, entry, stream, first_chunk)
+
+
+async def stream_chat_completion(
+    message: Message, placeholder: Message, params: dict, user_data: dict
+) -> tuple[str, str]:
+    """
+    Выполняет запрос к модели в потоковом режиме (stream=True),
+    показывая ответ по мере генерации. Если первый фрагмент задерживается,
+    запрос дублируется в запасную модель. Возвращает полный текст ответа
+    и модель, которая его дала.
+    """
+    tokens = estimate_tokens(params["messages"])
+    user_id = message.from_user.id
+    opened, answered_by = await hedged(
+        params["model"],
+        lambda model: open_chat_stream(model, params["messages"], tokens, user_id),
+        discard=OpenedStream.discard,
+        metric=":first_chunk",
+        tokens=tokens,
+    )
+
+    reply = StreamingReply(message, placeholder, answered_as(user_data, answered_by))
+    try:
+        async for chunk in opened.chunks():
+            # usage приходит последним чанком, без choices
+            if chunk.usage is not None:
+                record_prompt_usage(answered_by, chunk.usage)
+                opened.entry.add_usage(chunk.usage)
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                await reply.feed(delta)
+    except BaseException as e:
+        await opened.close(e)
+        raise
+    await opened.close()
+
+    return await reply.finish(), answered_by
+
+
+# Период обновления строки состояния, пока ассистент вызывает инструменты
+ASSISTANT_PROGRESS_INTERVAL = 5.0
+
+# Строки состояния для шагов запуска с инструментами
+TOOL_PROGRESS = {
+    "code_interpreter": "🧮 Выполняется код",
+    "file_search": "🔎 Поиск по файлам",
+    "function": "⚙️ Вызов функции",
+}
+
+# Статусы, в которых запуск ассистента больше не выполняется
+RUN_TERMINAL_STATUSES = {
+    "completed",
+    "failed",
+    "cancelled",
+    "expired",
+    "incomplete",
+    "requires_action",
+}
+
+
+def parse_assistant_message(assistant_message) -> tuple[str, list, list]:
+    """
+    Разбирает готовое сообщение ассистента: текст (ссылки на файлы
+    заменяются на [Файл N]), файлы из аннотаций и изображения.
+    """
+    text_response = []
+    response_files = []
+    response_images = []
+
+    for content_block in assistant_message.content:
+        if content_block.type == "text":
+            cleaned_text = content_block.text.value
+            annotations = content_block.text.annotations
+
+            logging.info(f"Текстовый блок с {len(annotations)} аннотациями")
+
+            for idx, ann in enumerate(annotations):
+                if hasattr(ann, "file_path"):
+                    file_id = ann.file_path.file_id
+                    response_files.append(file_id)
+                    logging.info(f"Обнаружен файл в аннотации: {file_id}")
+                    cleaned_text = cleaned_text.replace(ann.text, f" [Файл {idx + 1}]")
+
+            text_response.append(cleaned_text.strip())
+
+        elif content_block.type == "image_file":
+            image_id = content_block.image_file.file_id
+            logging.info(f"Обнаружено изображение в ответе: {image_id}")
+            response_images.append(image_id)
+        else:
+            logging.warning(f"Неизвестный тип блока контента: {content_block.type}")
+
+    return "\n".join(text_response), response_files, response_images
+
+
+def _step_tool(step_details) -> Optional[str]:
+    """Тип инструмента, который вызывает шаг запуска (или None)"""
+    if step_details is None or step_details.type != "tool_calls":
+        return None
+    for tool_call in step_details.tool_calls or ():
+        if tool_call.type in TOOL_PROGRESS:
+            return tool_call.type
+    return None
+
+
+async def stream_assistant_run(
+    message: Message,
+    placeholder: Message,
+    client_async,
+    thread_id: str,
+    assistant_id: str,
+    user_data: dict,
+    entry,
+    active: ActiveRun,
+) -> tuple[str, list, list]:
+    """
+    Запускает ассистента в потоковом режиме: текст появляется во временном
+    сообщении по мере генерации, пока выполняется код или поиск по файлам,
+    показывается строка состояния. Файлы и изображения берутся из событий
+    готовых сообщений, статус запуска передаётся в реестр активных запусков.
+    Возвращает текст ответа, файлы и изображения.
+    """
+    reply = StreamingReply(message, placeholder, user_data)
+    texts = []
+    response_files = []
+    response_images = []
+    run = None
+    # Инструмент текущего шага и момент его начала
+    tool = None
+    tool_started = 0.0
+
+    async with client_async.beta.threads.runs.stream(
+        thread_id=thread_id, assistant_id=assistant_id
+    ) as stream:
+        events = aiter(stream)
+        next_event = asyncio.ensure_future(anext(events, None))
+        try:
+            while True:
+                done, _ = await asyncio.wait(
+                    {next_event}, timeout=ASSISTANT_PROGRESS_INTERVAL
+                )
+                if not done:
+                    # Событий нет, пока инструмент работает - показываем время
+                    if tool is not None:
+                        elapsed = time.monotonic() - tool_started
+                        await reply.progress(f"{TOOL_PROGRESS[tool]}… {elapsed:.0f} с")
+                    continue
+
+                event = next_event.result()
+                if event is None:
+                    break
+                next_event = asyncio.ensure_future(anext(events, None))
+
+                if event.event == "thread.message.created":
+                    # Следующее сообщение запуска - с новой строки
+                    if reply.text:
+                        await reply.feed("\n\n")
+                elif event.event == "thread.message.delta":
+                    for block in event.data.delta.content or ():
+                        if block.type == "text" and block.text and block.text.value:
+                            await reply.feed(block.text.value)
+                elif event.event == "thread.message.completed":
+                    text, files, images = parse_assistant_message(event.data)
+                    if text:
+                        texts.append(text)
+                    response_files.extend(files)
+                    response_images.extend(images)
+                elif event.event in (
+                    "thread.run.step.created",
+                    "thread.run.step.delta",
+                ):
+                    if event.event == "thread.run.step.created":
+                        step_tool = _step_tool(event.data.step_details)
+                    else:
+                        step_tool = _step_tool(event.data.delta.step_details)
+                    if step_tool is not None and tool is None:
+                        tool = step_tool
+                        tool_started = time.monotonic()
+                        await reply.progress(f"{TOOL_PROGRESS[tool]}…")
+                elif event.event in (
+                    "thread.run.step.completed",
+                    "thread.run.step.failed",
+                    "thread.run.step.cancelled",
+                    "thread.run.step.expired",
+                ):
+                    tool = None
+                elif event.event.startswith("thread.run.") and "step" not in event.event:
+                    run = event.data
+                    active.update(run)
+                    if run.status in RUN_TERMINAL_STATUSES:
+                        break
+                elif event.event == "error":
+                    raise Exception(f"Ошибка потока ассистента: {event.data.message}")
+        finally:
+            next_event.cancel()
+
+    if run is None:
+        raise Exception("Поток ассистента завершился без статуса запуска")
+
+    entry.model = run.model or assistant_id
+    entry.add_usage(run.usage)
+    if run.status != "completed":
+        entry.status = run.status
+        error_msg = f"Run завершился со статусом: {run.status}"
+        if run.last_error:
+            error_msg += f" ({run.last_error.code}: {run.last_error.message})"
+        logging.error(f"Ошибка выполнения ассистента: {error_msg}")
+        raise Exception(error_msg)
+
+    logging.info(f"Run завершен успешно: {run.id}")
+    return await reply.finish("\n\n".join(texts)), response_files, response_images
+
+
 async def create_new_thread(user_data, user_id, current_assistant):
     """
     Создает новый тред для указанного ассистента
@@ -802,6 +1371,7 @@ async def create_new_thread(user_data, user_id, current_assistant):
         thread_id_key = get_thread_id_key(current_assistant)
         client_async = get_async_openai_client()
         new_thread = await client_async.beta.threads.create()
+        await register_resource("thread", new_thread.id, user_id)
 
         # Сохраняем ID нового треда
         user_data[thread_id_key] = new_thread.id
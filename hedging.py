@@ -0,0 +1,248 @@
+"""
+Дублирование медленных запросов к чату (включается в config.ini, [Hedging]).
+
+По каждой модели хранятся последние замеры задержки. Если ответ не пришёл
+за срок, равный перцентилю этих замеров (по умолчанию p95), запускается
+второй запрос - к запасной модели или к той же самой. Побеждает ответ,
+пришедший первым, проигравший запрос отменяется. Доля дублированных
+запросов ограничена бюджетом, поэтому расходы не удваиваются.
+"""
+
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Optional, Tuple
+
+from config_manager import (
+    get_hedging_enabled,
+    get_hedging_percentile,
+    get_hedging_min_samples,
+    get_hedging_min_delay,
+    get_hedging_budget,
+    get_hedging_fallback,
+)
+
+# Число последних замеров задержки на модель
+LATENCY_WINDOW = 200
+
+# Предельный запас бюджета: не больше стольких дублей подряд
+BUDGET_BURST = 3.0
+
+# Окно контекста моделей (токенов): запасная модель подходит,
+# только если в её окно помещается запрос
+MODEL_CONTEXT_TOKENS = {
+    "gpt-4o-mini": 128000,
+    "gpt-4o": 128000,
+    "gpt-4.1-2025-04-14": 1047576,
+    "o1-mini": 128000,
+    "o1-preview": 128000,
+    "o1-pro": 200000,
+    "o3-mini": 200000,
+    "gpt-4o-search-preview": 128000,
+}
+
+# Запас окна контекста под ответ модели (токенов)
+CONTEXT_RESERVE_TOKENS = 4096
+
+# Подписи моделей в ответах (как в меню выбора модели)
+MODEL_LABELS = {
+    "gpt-4o-mini": "4o mini",
+    "gpt-4o": "4o",
+    "gpt-4.1-2025-04-14": "4.1",
+    "o1-mini": "o1 mini",
+    "o1-preview": "o1 preview",
+    "o1-pro": "o1 pro",
+    "o3-mini": "o3 mini",
+    "gpt-4o-search-preview": "Web 4o",
+}
+
+
+class LatencyTracker:
+    """Скользящее окно задержек по моделям и срок дублирования"""
+
+    def __init__(self, window: int = LATENCY_WINDOW) -> None:
+        self._window = window
+        self._samples: Dict[str, Deque[float]] = {}
+
+    def record(self, key: str, seconds: float) -> None:
+        samples = self._samples.get(key)
+        if samples is None:
+            samples = self._samples[key] = deque(maxlen=self._window)
+        samples.append(seconds)
+
+    def quantile(self, key: str, q: float) -> Optional[float]:
+        samples = self._samples.get(key)
+        if not samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(math.ceil(q * len(ordered)) - 1, len(ordered) - 1)]
+
+    def deadline(self, key: str) -> Optional[float]:
+        """Срок до дублирования или None, пока замеров мало"""
+        samples = self._samples.get(key)
+        if samples is None or len(samples) < get_hedging_min_samples():
+            return None
+        return max(
+            self.quantile(key, get_hedging_percentile()), get_hedging_min_delay()
+        )
+
+
+class HedgeBudget:
+    """
+    Бюджет дублей: каждый запрос добавляет долю budget,
+    каждый дубль расходует единицу.
+    """
+
+    def __init__(self) -> None:
+        self._credits = 0.0
+
+    def on_request(self) -> None:
+        self._credits = min(self._credits + get_hedging_budget(), BUDGET_BURST)
+
+    def try_spend(self) -> bool:
+        if self._credits < 1.0:
+            return False
+        self._credits -= 1.0
+        return True
+
+
+_latency = LatencyTracker()
+_budget = HedgeBudget()
+_stats = {
+    "requests": 0,
+    "hedged": 0,
+    "hedge_wins": 0,
+    "denied": 0,
+    # Запасная модель не вмещала запрос, дублировалась основная
+    "oversized": 0,
+}
+
+
+def model_label(model: str) -> str:
+    """Префикс ответа с названием модели (как model_message_chat)"""
+    return f"{MODEL_LABELS.get(model, model)}:\n\n"
+
+
+def hedge_model_for(model: str, tokens: int = 0) -> str:
+    """
+    Модель для дублирующего запроса: запасная из [Hedging] fallback,
+    если запрос размером tokens помещается в её окно контекста,
+    иначе та же модель.
+    """
+    fallback = get_hedging_fallback(model)
+    context = MODEL_CONTEXT_TOKENS.get(fallback)
+    if fallback != model and context is not None:
+        if tokens + CONTEXT_RESERVE_TOKENS > context:
+            _stats["oversized"] += 1
+            return model
+    return fallback
+
+
+async def hedged(
+    model: str,
+    call: Callable[[str], Awaitable],
+    discard: Optional[Callable[[object], Awaitable]] = None,
+    metric: str = "",
+    tokens: int = 0,
+) -> Tuple[object, str]:
+    """
+    Выполняет call(model); если он не уложился в срок, параллельно
+    запускает call(запасная модель). Возвращает первый успешный результат
+    и модель, которая его дала. discard освобождает результат, который
+    пришёл, но не понадобился. metric отделяет замеры разных видов
+    запросов (например, время до первого фрагмента потока). tokens -
+    размер запроса: запасная модель с меньшим окном контекста
+    заменяется дублем основной.
+    """
+    key = f"{model}{metric}"
+    deadline = _latency.deadline(key) if get_hedging_enabled() else None
+    _budget.on_request()
+    _stats["requests"] += 1
+
+    started = time.monotonic()
+    primary = asyncio.create_task(call(model))
+    try:
+        if deadline is not None:
+            done, _ = await asyncio.wait({primary}, timeout=deadline)
+            if not done and _budget.try_spend():
+                return await _race(
+                    primary,
+                    model,
+                    hedge_model_for(model, tokens),
+                    started,
+                    call,
+                    discard,
+                    key,
+                    metric,
+                    deadline,
+                )
+            if not done:
+                _stats["denied"] += 1
+        result = await primary
+    except BaseException:
+        primary.cancel()
+        raise
+    _latency.record(key, time.monotonic() - started)
+    return result, model
+
+
+async def _race(
+    primary: asyncio.Task,
+    model: str,
+    hedge_model: str,
+    started: float,
+    call: Callable[[str], Awaitable],
+    discard: Optional[Callable[[object], Awaitable]],
+    key: str,
+    metric: str,
+    deadline: float,
+) -> Tuple[object, str]:
+    logging.info(
+        f"Нет ответа {model} за {deadline:.1f} с, дублируем запрос в {hedge_model}"
+    )
+    _stats["hedged"] += 1
+
+    hedge_started = time.monotonic()
+    hedge = asyncio.create_task(call(hedge_model))
+    pending = {primary: model, hedge: hedge_model}
+    winner = None
+    error: Optional[BaseException] = None
+    try:
+        while pending and winner is None:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task_model = pending.pop(task)
+                if task.exception() is not None:
+                    error = error or task.exception()
+                elif winner is None:
+                    winner = (task.result(), task_model)
+                    if task is hedge:
+                        _stats["hedge_wins"] += 1
+                        _latency.record(
+                            f"{hedge_model}{metric}", time.monotonic() - hedge_started
+                        )
+                elif discard is not None:
+                    await discard(task.result())
+    finally:
+        # Проигравший запрос больше не нужен
+        for task in pending:
+            task.cancel()
+        results = await asyncio.gather(*pending, return_exceptions=True)
+        # Запрос мог успеть завершиться до отмены
+        for result in results:
+            if discard is not None and not isinstance(result, BaseException):
+                await discard(result)
+
+        # Для проигравшего основного запроса это нижняя оценка задержки
+        _latency.record(key, time.monotonic() - started)
+
+    if winner is None:
+        raise error
+    return winner
+
+
+def hedge_stats() -> dict:
+    """Счётчики дублирования запросов"""
+    return dict(_stats)
@@ -0,0 +1,148 @@
+"""
+Кодек хранения истории сообщений.
+
+Закодированное значение начинается с заголовка из 4 байт:
+маркер, версия формата, вид данных и способ сжатия.
+Значения без заголовка (строки) - старый формат: обычный текст сообщения
+или JSON-список сообщений; они читаются без преобразований.
+"""
+
+import json
+import zlib
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - зависит от окружения
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - зависит от окружения
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - зависит от окружения
+    zstandard = None
+
+MAGIC = 0xC7
+FORMAT_VERSION = 1
+
+# Вид данных
+KIND_TEXT = 0
+KIND_JSON = 1
+KIND_MSGPACK = 2
+
+# Способ сжатия
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_ZSTD = 2
+
+# Тексты короче порога (в байтах UTF-8) не сжимаются и хранятся как есть
+COMPRESS_THRESHOLD = 1024
+
+_ZLIB_LEVEL = 6
+_ZSTD_LEVEL = 3
+
+
+def _compress(data: bytes) -> tuple[int, bytes]:
+    """Сжимает данные, если это выгодно. Возвращает способ сжатия и данные"""
+    if len(data) < COMPRESS_THRESHOLD:
+        return COMPRESSION_NONE, data
+
+    if zstandard is not None:
+        compressed = zstandard.ZstdCompressor(level=_ZSTD_LEVEL).compress(data)
+        compression = COMPRESSION_ZSTD
+    else:
+        compressed = zlib.compress(data, _ZLIB_LEVEL)
+        compression = COMPRESSION_ZLIB
+
+    if len(compressed) >= len(data):
+        return COMPRESSION_NONE, data
+    return compression, compressed
+
+
+def _decompress(compression: int, data: bytes) -> bytes:
+    if compression == COMPRESSION_NONE:
+        return data
+    if compression == COMPRESSION_ZLIB:
+        return zlib.decompress(data)
+    if compression == COMPRESSION_ZSTD:
+        if zstandard is None:
+            raise RuntimeError("Для чтения истории требуется пакет zstandard")
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise ValueError(f"Неизвестный способ сжатия истории: {compression}")
+
+
+def _pack(kind: int, payload: bytes) -> bytes:
+    compression, data = _compress(payload)
+    return bytes((MAGIC, FORMAT_VERSION, kind, compression)) + data
+
+
+def _unpack(value: bytes) -> tuple[int, bytes]:
+    if len(value) < 4 or value[0] != MAGIC:
+        raise ValueError("Неизвестный формат истории")
+    version, kind, compression = value[1], value[2], value[3]
+    if version != FORMAT_VERSION:
+        raise ValueError(f"Неподдерживаемая версия формата истории: {version}")
+    return kind, _decompress(compression, value[4:])
+
+
+def encode_text(text: str):
+    """
+    Кодирует текст одного сообщения.
+    Короткие тексты возвращаются без изменений, длинные сжимаются.
+    """
+    payload = text.encode("utf-8")
+    if len(payload) < COMPRESS_THRESHOLD:
+        return text
+
+    packed = _pack(KIND_TEXT, payload)
+    if packed[3] == COMPRESSION_NONE:
+        return text
+    return packed
+
+
+def decode_text(value) -> str:
+    """Декодирует текст сообщения, сохранённый encode_text или старым кодом"""
+    if value is None or isinstance(value, str):
+        return value
+
+    kind, data = _unpack(bytes(value))
+    if kind != KIND_TEXT:
+        raise ValueError(f"Ожидался текст сообщения, получен вид данных {kind}")
+    return data.decode("utf-8")
+
+
+def encode_history(messages: list) -> bytes:
+    """
+    Кодирует историю целиком одним сжатым блоком.
+    Используется orjson или msgpack, если они установлены, иначе json.
+    """
+    if orjson is not None:
+        return _pack(KIND_JSON, orjson.dumps(messages))
+    if msgpack is not None:
+        return _pack(KIND_MSGPACK, msgpack.packb(messages))
+    return _pack(
+        KIND_JSON, json.dumps(messages, ensure_ascii=False).encode("utf-8")
+    )
+
+
+def decode_history(value) -> list:
+    """
+    Декодирует историю, закодированную encode_history,
+    или JSON-строку старого формата.
+    """
+    if not value:
+        return []
+    if isinstance(value, str):
+        return json.loads(value)
+
+    kind, data = _unpack(bytes(value))
+    if kind == KIND_JSON:
+        return orjson.loads(data) if orjson is not None else json.loads(data)
+    if kind == KIND_MSGPACK:
+        if msgpack is None:
+            raise RuntimeError("Для чтения истории требуется пакет msgpack")
+        return msgpack.unpackb(data)
+    raise ValueError(f"Ожидалась история сообщений, получен вид данных {kind}")
@@ -0,0 +1,142 @@
+"""
+Менеджер HTTP клиентов
+Общие долгоживущие пулы соединений: httpx для OpenAI
+и aiohttp для скачивания файлов Telegram. Соединения переиспользуются
+между запросами, поэтому TCP и TLS рукопожатие выполняется один раз.
+"""
+
+import importlib.util
+import logging
+import time
+from typing import Dict, List, Optional
+
+import aiohttp
+import httpx
+from openai import DefaultAsyncHttpxClient
+
+from config_manager import (
+    get_http_max_connections,
+    get_http_max_keepalive,
+    get_http_keepalive_expiry,
+    get_http_connect_timeout,
+    get_http_read_timeout,
+    get_http2_enabled,
+)
+
+# Общая сессия aiohttp для файлов Telegram
+_session: Optional[aiohttp.ClientSession] = None
+
+# Клиенты httpx для OpenAI (по одному на ключ API)
+_httpx_clients: List[httpx.AsyncClient] = []
+
+# Счётчики соединений сессии aiohttp (по событиям трассировки)
+_session_stats = {"created": 0, "reused": 0, "waits": 0, "wait_time": 0.0}
+
+
+def _http2_available() -> bool:
+    if not get_http2_enabled():
+        return False
+    if importlib.util.find_spec("h2") is None:
+        logging.warning("HTTP/2 включён, но пакет h2 не установлен (pip install h2)")
+        return False
+    return True
+
+
+def create_openai_http_client(event_hooks: Optional[dict] = None) -> httpx.AsyncClient:
+    """Создаёт httpx клиент для OpenAI с настройками пула из config.ini"""
+    client = DefaultAsyncHttpxClient(
+        limits=httpx.Limits(
+            max_connections=get_http_max_connections(),
+            max_keepalive_connections=get_http_max_keepalive(),
+            keepalive_expiry=get_http_keepalive_expiry(),
+        ),
+        timeout=httpx.Timeout(
+            get_http_read_timeout(), connect=get_http_connect_timeout()
+        ),
+        http2=_http2_available(),
+        event_hooks=event_hooks or {},
+    )
+    _httpx_clients[:] = [c for c in _httpx_clients if not c.is_closed]
+    _httpx_clients.append(client)
+    return client
+
+
+def _trace_config() -> aiohttp.TraceConfig:
+    trace_config = aiohttp.TraceConfig()
+
+    async def on_queued_start(session, context, params):
+        context.queued_at = time.monotonic()
+
+    async def on_queued_end(session, context, params):
+        _session_stats["waits"] += 1
+        _session_stats["wait_time"] += time.monotonic() - context.queued_at
+
+    async def on_create_end(session, context, params):
+        _session_stats["created"] += 1
+
+    async def on_reuse(session, context, params):
+        _session_stats["reused"] += 1
+
+    trace_config.on_connection_queued_start.append(on_queued_start)
+    trace_config.on_connection_queued_end.append(on_queued_end)
+    trace_config.on_connection_create_end.append(on_create_end)
+    trace_config.on_connection_reuseconn.append(on_reuse)
+    return trace_config
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    """Возвращает общую сессию aiohttp (создаётся при первом обращении)"""
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=get_http_max_connections(),
+            keepalive_timeout=get_http_keepalive_expiry(),
+            ttl_dns_cache=300,
+        )
+        _session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(
+                total=get_http_read_timeout(), connect=get_http_connect_timeout()
+            ),
+            trace_configs=[_trace_config()],
+        )
+    return _session
+
+
+async def close_http_clients() -> None:
+    """Закрывает общую сессию aiohttp (клиенты OpenAI закрывает openai_manager)"""
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+
+def _httpx_pool_stats(client: httpx.AsyncClient) -> Dict[str, int]:
+    # Пул httpcore не имеет публичного API статистики
+    pool = getattr(client._transport, "_pool", None)
+    connections = list(getattr(pool, "connections", ()))
+    requests = list(getattr(pool, "_requests", ()))
+    idle = sum(1 for connection in connections if connection.is_idle())
+    return {
+        "connections": len(connections),
+        "in_use": len(connections) - idle,
+        "idle": idle,
+        "waiting": sum(1 for request in requests if request.is_queued()),
+    }
+
+
+def http_pool_stats() -> Dict[str, dict]:
+    """Статистика пулов соединений: занятые, свободные, ожидающие"""
+    openai_stats = {"connections": 0, "in_use": 0, "idle": 0, "waiting": 0}
+    for client in _httpx_clients:
+        if client.is_closed:
+            continue
+        for name, value in _httpx_pool_stats(client).items():
+            openai_stats[name] += value
+
+    telegram_stats = dict(_session_stats)
+    if _session is not None and not _session.closed:
+        connector = _session.connector
+        telegram_stats["in_use"] = len(connector._acquired)
+        telegram_stats["idle"] = sum(len(conns) for conns in connector._conns.values())
+    return {"openai": openai_stats, "telegram": telegram_stats}
@@ -0,0 +1,347 @@
+"""
+Уборка ресурсов OpenAI, созданных ботом ([Janitor] в config.ini).
+
+Каждый загруженный файл, созданный тред и векторное хранилище
+записываются в таблицу 'openai_resources'. Фоновая задача раз
+в interval выбирает ресурсы с истёкшим сроком хранения:
+- изображения (purpose=vision), не использовавшиеся дольше vision_ttl;
+- документы (purpose=assistants), не использовавшиеся дольше document_ttl
+  и не входящие в действующее векторное хранилище;
+- треды старше thread_grace, на которые больше не ссылается ни одно поле
+  assistant_thread_id* (брошены reset_thread или /null);
+- векторные хранилища старше thread_grace, которых больше нет
+  в таблице 'vector_stores' (не удалось удалить вместе с тредом).
+Удаление идёт пакетами не больше batch_size с паузой delete_interval
+между запросами. Режимы: delete - удалять, dry_run - только писать
+в лог, что было бы удалено, metrics - только считать кандидатов.
+"""
+
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Set
+
+from openai import NotFoundError
+from sqlalchemy import delete, exists, func, select, text, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from base import flush_user_data, users_data
+from classes import (
+    SessionLocal,
+    OpenAIFileModel,
+    OpenAIResourceModel,
+    UserDataModel,
+    VectorStoreModel,
+    VectorStoreFileModel,
+)
+from config_manager import (
+    get_janitor_mode,
+    get_janitor_interval,
+    get_janitor_vision_ttl,
+    get_janitor_document_ttl,
+    get_janitor_thread_grace,
+    get_janitor_batch_size,
+    get_janitor_delete_interval,
+)
+from openai_manager import get_async_openai_client
+
+JANITOR_MODES = ("delete", "dry_run", "metrics", "off")
+
+# Поля пользователя со ссылками на треды ассистентов
+THREAD_FIELDS = (
+    "assistant_thread_id",
+    "assistant_thread_id_2",
+    "assistant_thread_id_3",
+)
+
+_stats = {
+    "sweeps": 0,
+    "deleted": 0,
+    "missing": 0,
+    "errors": 0,
+    # Кандидаты последнего прохода по правилам
+    "last_candidates": {},
+}
+_janitor_task: Optional[asyncio.Task] = None
+
+
+async def register_resource(
+    kind: str, resource_id: str, user_id: Optional[int] = None, purpose: str = ""
+) -> None:
+    """Записывает созданный ботом ресурс OpenAI (file, thread, vector_store)"""
+    try:
+        async with SessionLocal() as session:
+            await session.execute(
+                sqlite_insert(OpenAIResourceModel)
+                .values(
+                    resource_id=resource_id,
+                    kind=kind,
+                    purpose=purpose,
+                    user_id=str(user_id) if user_id is not None else None,
+                    created_at=datetime.utcnow(),
+                )
+                .on_conflict_do_nothing()
+            )
+            await session.commit()
+    except Exception as e:
+        logging.error(f"Ошибка учёта ресурса {kind} {resource_id}: {e}")
+
+
+async def _mark_deleted(session, resource_id: str) -> None:
+    await session.execute(
+        update(OpenAIResourceModel)
+        .where(OpenAIResourceModel.resource_id == resource_id)
+        .values(deleted_at=datetime.utcnow())
+    )
+
+
+async def mark_deleted(resource_id: str) -> None:
+    """Отмечает ресурс, удалённый в обход уборки (например, вместе с тредом)"""
+    try:
+        async with SessionLocal() as session:
+            await _mark_deleted(session, resource_id)
+            await session.commit()
+    except Exception as e:
+        logging.error(f"Ошибка учёта удаления ресурса {resource_id}: {e}")
+
+
+async def _referenced_threads(session) -> Set[str]:
+    """Треды, на которые ссылаются пользователи (в БД и в кэше)"""
+    referenced = set()
+    result = await session.execute(
+        select(*(getattr(UserDataModel, field) for field in THREAD_FIELDS))
+    )
+    for row in result.all():
+        referenced.update(row)
+    for settings in users_data.values():
+        referenced.update(settings.get(field) for field in THREAD_FIELDS)
+    referenced.discard("")
+    referenced.discard(None)
+    return referenced
+
+
+async def _expired_files(
+    session, purpose: str, ttl: float, now: datetime
+) -> List[OpenAIResourceModel]:
+    # Срок считается от последнего использования файла (индекс файлов)
+    last_used = func.coalesce(
+        select(func.max(OpenAIFileModel.last_used_at))
+        .where(OpenAIFileModel.file_id == OpenAIResourceModel.resource_id)
+        .scalar_subquery(),
+        OpenAIResourceModel.created_at,
+    )
+    # Документы из действующего векторного хранилища ещё ищутся file_search
+    in_live_store = exists(
+        select(VectorStoreFileModel.file_id)
+        .join(
+            VectorStoreModel,
+            VectorStoreModel.vector_store_id == VectorStoreFileModel.vector_store_id,
+        )
+        .where(VectorStoreFileModel.file_id == OpenAIResourceModel.resource_id)
+    )
+    return list(
+        await session.scalars(
+            select(OpenAIResourceModel)
+            .where(
+                OpenAIResourceModel.kind == "file",
+                OpenAIResourceModel.purpose == purpose,
+                OpenAIResourceModel.deleted_at.is_(None),
+                last_used < now - timedelta(seconds=ttl),
+                ~in_live_store,
+            )
+            .order_by(OpenAIResourceModel.created_at)
+        )
+    )
+
+
+async def find_candidates() -> Dict[str, List[OpenAIResourceModel]]:
+    """Ресурсы с истёкшим сроком хранения по правилам"""
+    # Свежие thread_id должны попасть в БД до проверки ссылок
+    await flush_user_data()
+    now = datetime.utcnow()
+    candidates = {}
+    async with SessionLocal() as session:
+        # Файлы, загруженные до появления учёта ресурсов, берутся из индекса
+        await session.execute(
+            text(
+                "INSERT OR IGNORE INTO openai_resources "
+                "(resource_id, kind, purpose, created_at) "
+                "SELECT file_id, 'file', purpose, created_at FROM openai_files"
+            )
+        )
+        await session.commit()
+
+        candidates["vision"] = await _expired_files(
+            session, "vision", get_janitor_vision_ttl(), now
+        )
+        document_ttl = get_janitor_document_ttl()
+        candidates["documents"] = (
+            await _expired_files(session, "assistants", document_ttl, now)
+            if document_ttl > 0
+            else []
+        )
+
+        referenced = await _referenced_threads(session)
+        threads = await session.scalars(
+            select(OpenAIResourceModel)
+            .where(
+                OpenAIResourceModel.kind == "thread",
+                OpenAIResourceModel.deleted_at.is_(None),
+                OpenAIResourceModel.created_at
+                < now - timedelta(seconds=get_janitor_thread_grace()),
+            )
+            .order_by(OpenAIResourceModel.created_at)
+        )
+        candidates["threads"] = [
+            thread for thread in threads if thread.resource_id not in referenced
+        ]
+
+        candidates["vector_stores"] = list(
+            await session.scalars(
+                select(OpenAIResourceModel)
+                .where(
+                    OpenAIResourceModel.kind == "vector_store",
+                    OpenAIResourceModel.deleted_at.is_(None),
+                    OpenAIResourceModel.created_at
+                    < now - timedelta(seconds=get_janitor_thread_grace()),
+                    OpenAIResourceModel.resource_id.not_in(
+                        select(VectorStoreModel.vector_store_id)
+                    ),
+                )
+                .order_by(OpenAIResourceModel.created_at)
+            )
+        )
+    return candidates
+
+
+async def _delete_resource(client, resource: OpenAIResourceModel) -> bool:
+    try:
+        if resource.kind == "thread":
+            await client.beta.threads.delete(resource.resource_id)
+        elif resource.kind == "vector_store":
+            await client.vector_stores.delete(resource.resource_id)
+        else:
+            await client.files.delete(resource.resource_id)
+    except NotFoundError:
+        # Уже удалён вручную или истёк в OpenAI
+        _stats["missing"] += 1
+    except Exception as e:
+        _stats["errors"] += 1
+        logging.error(f"Ошибка удаления {resource.kind} {resource.resource_id}: {e}")
+        return False
+
+    async with SessionLocal() as session:
+        await _mark_deleted(session, resource.resource_id)
+        if resource.kind == "file":
+            # Удалённый файл больше нельзя брать из индекса
+            await session.execute(
+                delete(OpenAIFileModel).where(
+                    OpenAIFileModel.file_id == resource.resource_id
+                )
+            )
+        await session.commit()
+    _stats["deleted"] += 1
+    return True
+
+
+async def sweep(mode: Optional[str] = None) -> Dict[str, int]:
+    """
+    Один проход уборки. Возвращает число кандидатов по правилам;
+    в режиме delete удаляет не больше batch_size ресурсов.
+    """
+    mode = mode or get_janitor_mode()
+    candidates = await find_candidates()
+    counts = {rule: len(resources) for rule, resources in candidates.items()}
+    _stats["sweeps"] += 1
+    _stats["last_candidates"] = counts
+    logging.info(f"Уборка ресурсов OpenAI ({mode}): кандидаты {counts}")
+
+    batch = [
+        resource for resources in candidates.values() for resource in resources
+    ][: get_janitor_batch_size()]
+
+    if mode == "dry_run":
+        for resource in batch:
+            logging.info(
+                f"[dry_run] Был бы удалён {resource.kind} {resource.resource_id} "
+                f"(создан {resource.created_at:%Y-%m-%d %H:%M})"
+            )
+    elif mode == "delete":
+        client = get_async_openai_client()
+        delete_interval = get_janitor_delete_interval()
+        for index, resource in enumerate(batch):
+            if index:
+                await asyncio.sleep(delete_interval)
+            await _delete_resource(client, resource)
+    return counts
+
+
+async def _janitor_loop() -> None:
+    interval = get_janitor_interval()
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await sweep()
+        except Exception as e:
+            logging.error(f"Ошибка уборки ресурсов OpenAI: {e}")
+
+
+def start_janitor() -> None:
+    """Запускает фоновую уборку ресурсов OpenAI (если она не выключена)"""
+    global _janitor_task
+    mode = get_janitor_mode()
+    if mode not in JANITOR_MODES:
+        logging.error(f"Неизвестный режим уборки: {mode}, уборка выключена")
+        return
+    if mode != "off" and (_janitor_task is None or _janitor_task.done()):
+        _janitor_task = asyncio.create_task(_janitor_loop())
+
+
+async def stop_janitor() -> None:
+    """Останавливает фоновую уборку"""
+    global _janitor_task
+    if _janitor_task is not None:
+        _janitor_task.cancel()
+        try:
+            await _janitor_task
+        except asyncio.CancelledError:
+            pass
+        _janitor_task = None
+
+
+async def janitor_report() -> str:
+    """Ресурсы OpenAI, созданные ботом: учтено, удалено, к удалению (HTML)"""
+    async with SessionLocal() as session:
+        rows = (
+            await session.execute(
+                select(
+                    OpenAIResourceModel.kind,
+                    OpenAIResourceModel.purpose,
+                    func.count(),
+                    func.count(OpenAIResourceModel.deleted_at),
+                ).group_by(OpenAIResourceModel.kind, OpenAIResourceModel.purpose)
+            )
+        ).all()
+    candidates = {
+        rule: len(resources) for rule, resources in (await find_candidates()).items()
+    }
+
+    lines = [f"<b>Ресурсы OpenAI</b> (режим уборки: {get_janitor_mode()})", ""]
+    for kind, purpose, total, deleted in rows:
+        name = f"{kind} ({purpose})" if purpose else kind
+        lines.append(f"{name}: {total - deleted} активных, {deleted} удалено")
+    if not rows:
+        lines.append("Ресурсов пока нет")
+    lines += [
+        "",
+        "<b>К удалению</b>: "
+        + ", ".join(f"{rule} {count}" for rule, count in candidates.items()),
+        f"Проходов: {_stats['sweeps']}, удалено: {_stats['deleted']}, "
+        f"уже отсутствовали: {_stats['missing']}, ошибок: {_stats['errors']}",
+    ]
+    return "\n".join(lines)
+
+
+def janitor_stats() -> dict:
+    """Счётчики уборки ресурсов"""
+    return {**_stats, "last_candidates": dict(_stats["last_candidates"])}
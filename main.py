@@ -7,11 +7,17 @@ from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 from aiogram.fsm.storage.memory import MemoryStorage
 
+from assistant_runs import stop_active_runs
+from base import start_write_behind, stop_write_behind
 from bot_manager import set_bot, close_bot
 from classes import init_async_db
 from config_manager import get_telegram_token
 from handler_menu import router
+from http_manager import close_http_clients
+from janitor import start_janitor, stop_janitor
 from openai_manager import close_openai_client
+from summarizer import stop_compaction
+from usage_ledger import start_usage_ledger, stop_usage_ledger
 
 TOKEN = get_telegram_token()
 
@@ -51,16 +57,33 @@ async def main():
     bot = None
     try:
         await init_async_db()
+        start_write_behind()
+        start_usage_ledger()
+        start_janitor()
         bot, dp = await start_bot()
         await set_commands(bot)
         await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
     except Exception as e:
         logging.exception(f"An error occurred: {e}")
     finally:
+        await stop_janitor()
+        # Брошенные запуски ассистентов отменяются до закрытия клиентов
+        await stop_active_runs()
+        # Сохраняем все отложенные изменения перед остановкой
+        await stop_compaction()
+        try:
+            await stop_usage_ledger()
+        except Exception as e:
+            logging.exception(f"Failed to flush usage ledger: {e}")
+        try:
+            await stop_write_behind()
+        except Exception as e:
+            logging.exception(f"Failed to flush user data: {e}")
         if bot is not None:
             await bot.session.close()
             await close_bot()
             await close_openai_client()
+            await close_http_clients()
 
 
 if __name__ == "__main__":
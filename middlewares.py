@@ -46,3 +46,74 @@ class ThrottlingMiddleware(BaseMiddleware):
 
         self.caches[throttling_key][user.id] = None
         return await asyncio.shield(handler(event, data))
+
+
+class UserLane:
+    """
+    Очередь выполнения обработчиков одного пользователя.
+    """
+
+    __slots__ = ("lock", "depth", "max_depth", "processed")
+
+    def __init__(self) -> None:
+        self.lock = asyncio.Lock()
+        # Число обработчиков в полосе: выполняющийся плюс ожидающие
+        self.depth = 0
+        self.max_depth = 0
+        self.processed = 0
+
+
+class UserLaneMiddleware(BaseMiddleware):
+    """
+    Выполняет обработчики одного пользователя строго последовательно,
+    сохраняя параллелизм между разными пользователями.
+    Полоса удаляется, как только в ней не остаётся обработчиков.
+    """
+
+    def __init__(self) -> None:
+        self.lanes: Dict[int, UserLane] = {}
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Optional[Any]:
+        user: Optional[User] = data.get("event_from_user")
+
+        if user is None:
+            return await handler(event, data)
+
+        lane = self.lanes.get(user.id)
+        if lane is None:
+            lane = self.lanes[user.id] = UserLane()
+
+        lane.depth += 1
+        lane.max_depth = max(lane.max_depth, lane.depth)
+        try:
+            async with lane.lock:
+                return await handler(event, data)
+        finally:
+            lane.depth -= 1
+            lane.processed += 1
+            if lane.depth == 0:
+                self.lanes.pop(user.id, None)
+
+    def is_active(self, user_id: int) -> bool:
+        """Выполняется ли сейчас обработчик пользователя"""
+        return user_id in self.lanes
+
+    def queue_depths(self) -> Dict[int, int]:
+        """Возвращает число ожидающих обработчиков в каждой активной полосе"""
+        return {user_id: lane.depth - 1 for user_id, lane in self.lanes.items()}
+
+    def lane_metrics(self) -> Dict[int, Dict[str, int]]:
+        """Возвращает метрики активных полос: очередь, максимум очереди, обработано"""
+        return {
+            user_id: {
+                "queued": lane.depth - 1,
+                "max_queued": lane.max_depth - 1,
+                "processed": lane.processed,
+            }
+            for user_id, lane in self.lanes.items()
+        }
@@ -1,28 +1,549 @@
 """
 Менеджер OpenAI клиентов
-Предоставляет единый асинхронный клиент для всего проекта
+Предоставляет асинхронные клиенты для всего проекта (по одному на ключ API)
+и планировщик запросов с учётом лимитов API по ключам и моделям
 """
 
-from openai import AsyncOpenAI
+import asyncio
+import hashlib
+import heapq
+import itertools
+import logging
+import re
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Awaitable, Callable, Dict, Optional, Union
 
-from config_manager import get_openai_api_key
+from openai import AsyncOpenAI
 
-# Единственный экземпляр асинхронного OpenAI клиента
-_client_async = None
+from config_manager import (
+    get_openai_api_keys,
+    get_openai_key_cooldown,
+    get_openai_auth_cooldown,
+    get_openai_max_retries,
+    get_scheduler_concurrency,
+    get_scheduler_rpm,
+    get_scheduler_tpm,
+)
+from http_manager import create_openai_http_client
+from tokenizer import message_tokens
 
 
 def get_async_openai_client() -> AsyncOpenAI:
-    """Возвращает единственный экземпляр асинхронного OpenAI клиента"""
-    global _client_async
-    if _client_async is None:
-        api_key = get_openai_api_key()
-        _client_async = AsyncOpenAI(api_key=api_key)
-    return _client_async
+    """
+    Возвращает клиент основного ключа. Ассистенты, треды и файлы
+    принадлежат проекту основного ключа, поэтому вызовы с состоянием
+    всегда идут через него; остальные запросы распределяет scheduled().
+    """
+    return scheduler.primary.get_client()
 
 
 async def close_openai_client():
-    """Асинхронно закрывает OpenAI клиент"""
-    global _client_async
-    if _client_async is not None:
-        await _client_async.close()
-        _client_async = None
+    """Асинхронно закрывает клиенты всех ключей"""
+    await scheduler.close()
+
+
+# Приоритеты запросов: ответы пользователю важнее фоновой работы
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+# Доля лимитов, которую фоновые запросы оставляют интерактивным
+BACKGROUND_RESERVE = 0.2
+
+# Длительности в заголовках x-ratelimit-reset-*: "1s", "6m0s", "20ms"
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+# Модель запроса, выполняющегося в текущей задаче (для разбора заголовков)
+_current_model: ContextVar[Optional[str]] = ContextVar(
+    "openai_current_model", default=None
+)
+
+
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    """Переводит длительность из заголовков OpenAI в секунды"""
+    if not value:
+        return None
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return sum(float(number) * _DURATION_UNITS[unit] for number, unit in parts)
+
+
+def _header_int(headers, name: str) -> Optional[int]:
+    value = headers.get(name)
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class TokenBucket:
+    """
+    Ведро токенов: пополняется до capacity за period секунд.
+    Состояние уточняется по заголовкам x-ratelimit-* ответов API.
+    """
+
+    __slots__ = ("capacity", "period", "tokens", "updated", "blocked_until")
+
+    def __init__(self, capacity: int, period: float = 60.0) -> None:
+        self.capacity = capacity
+        self.period = period
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        rate = self.capacity / self.period
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+
+    def delay(self, amount: float, now: float, reserve: float = 0.0) -> float:
+        """Сколько ждать, пока в ведре наберётся amount (плюс резерв)"""
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self._refill(now)
+        needed = min(amount, self.capacity) + self.capacity * reserve
+        if self.blocked_until:
+            # Время ожидания из ответа API истекло - пропускаем запрос
+            self.blocked_until = 0.0
+            self.tokens = max(self.tokens, needed)
+        if self.tokens >= needed:
+            return 0.0
+        return (needed - self.tokens) * self.period / self.capacity
+
+    def level(self, now: float) -> float:
+        """Доля доступного запаса (0 - пусто или заблокировано, 1 - полно)"""
+        if now < self.blocked_until:
+            return 0.0
+        self._refill(now)
+        return max(self.tokens, 0.0) / self.capacity
+
+    def consume(self, amount: float, now: float) -> None:
+        self._refill(now)
+        self.tokens -= min(amount, self.capacity)
+
+    def sync(
+        self,
+        limit: Optional[int],
+        remaining: Optional[int],
+        reset: Optional[float],
+        now: float,
+    ) -> None:
+        """Обновляет состояние по значениям из заголовков ответа"""
+        if limit:
+            self.capacity = limit
+        if remaining is not None:
+            self.tokens = float(remaining)
+            self.updated = now
+            if remaining <= 0 and reset:
+                self.block(reset, now)
+
+    def block(self, seconds: float, now: float) -> None:
+        self.blocked_until = max(self.blocked_until, now + seconds)
+
+
+class PrioritySemaphore:
+    """Семафор, который при освобождении отдаёт слот ожидающему с высшим приоритетом"""
+
+    def __init__(self, value: int) -> None:
+        self._value = value
+        self._waiters: list = []
+        self._order = itertools.count()
+
+    @property
+    def waiting(self) -> int:
+        return sum(1 for _, _, future in self._waiters if not future.done())
+
+    async def acquire(self, priority: int) -> None:
+        if self._value > 0 and not self._waiters:
+            self._value -= 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._order), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Слот успели выдать, но задача отменена - возвращаем его
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self) -> None:
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self._value += 1
+
+
+class ModelLimiter:
+    """Ограничения одной модели: одновременные запросы, RPM и TPM"""
+
+    def __init__(self, model: str) -> None:
+        self.model = model
+        self.slots = PrioritySemaphore(get_scheduler_concurrency(model))
+        self.requests = TokenBucket(get_scheduler_rpm())
+        self.tokens = TokenBucket(get_scheduler_tpm())
+        self.active = 0
+        self.completed = 0
+        self.throttled = 0
+        self.waited = 0.0
+
+    async def acquire(self, tokens: int, priority: int) -> None:
+        started = time.monotonic()
+        await self.slots.acquire(priority)
+        try:
+            reserve = BACKGROUND_RESERVE if priority == PRIORITY_BACKGROUND else 0.0
+            while True:
+                now = time.monotonic()
+                delay = max(
+                    self.requests.delay(1, now, reserve),
+                    self.tokens.delay(tokens, now, reserve),
+                )
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+            self.requests.consume(1, now)
+            self.tokens.consume(tokens, now)
+        except BaseException:
+            self.slots.release()
+            raise
+        self.active += 1
+        self.waited += time.monotonic() - started
+
+    def release(self) -> None:
+        self.active -= 1
+        self.completed += 1
+        self.slots.release()
+
+    def headroom(self, now: float) -> float:
+        """Запас по лимитам модели: минимум из долей RPM и TPM"""
+        return min(self.requests.level(now), self.tokens.level(now))
+
+    def update(self, headers, status_code: int) -> None:
+        """Уточняет лимиты по заголовкам x-ratelimit-* ответа"""
+        now = time.monotonic()
+        self.requests.sync(
+            _header_int(headers, "x-ratelimit-limit-requests"),
+            _header_int(headers, "x-ratelimit-remaining-requests"),
+            parse_duration(headers.get("x-ratelimit-reset-requests")),
+            now,
+        )
+        self.tokens.sync(
+            _header_int(headers, "x-ratelimit-limit-tokens"),
+            _header_int(headers, "x-ratelimit-remaining-tokens"),
+            parse_duration(headers.get("x-ratelimit-reset-tokens")),
+            now,
+        )
+        if status_code == 429:
+            self.throttled += 1
+            retry_after = parse_duration(headers.get("retry-after")) or 1.0
+            self.requests.block(retry_after, now)
+            self.tokens.block(retry_after, now)
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "waiting": self.slots.waiting,
+            "completed": self.completed,
+            "throttled": self.throttled,
+            "avg_wait": self.waited / self.completed if self.completed else 0.0,
+            "requests_left": int(self.requests.tokens),
+            "tokens_left": int(self.tokens.tokens),
+        }
+
+
+class ApiKey:
+    """
+    Ключ API (или проект) со своим клиентом и пулом соединений,
+    лимитами по моделям и статистикой использования
+    """
+
+    def __init__(self, name: str, api_key: str, project: Optional[str] = None):
+        # Сам ключ не выводится ни в логи, ни в статистику
+        self.name = name
+        self.api_key = api_key
+        self.project = project
+        self.client: Optional[AsyncOpenAI] = None
+        self.limiters: Dict[str, ModelLimiter] = {}
+        self.cooldown_until = 0.0
+        self.requests = 0
+        self.tokens = 0
+        self.throttled = 0
+        self.unauthorized = 0
+
+    def get_client(self) -> AsyncOpenAI:
+        if self.client is None:
+            self.client = AsyncOpenAI(
+                api_key=self.api_key,
+                project=self.project,
+                # Повтор при 429 выполняет SDK на том же ключе (с учётом
+                # retry-after); следующие запросы планировщик направит
+                # на другие ключи, пока этот остывает
+                max_retries=get_openai_max_retries(),
+                http_client=create_openai_http_client(
+                    event_hooks={"response": [self.on_response]}
+                ),
+            )
+        return self.client
+
+    def limiter(self, model: str) -> ModelLimiter:
+        limiter = self.limiters.get(model)
+        if limiter is None:
+            limiter = self.limiters[model] = ModelLimiter(model)
+        return limiter
+
+    def headroom(self, model: str, now: float) -> float:
+        limiter = self.limiters.get(model)
+        return limiter.headroom(now) if limiter is not None else 1.0
+
+    def cooldown(self, seconds: float) -> None:
+        self.cooldown_until = max(self.cooldown_until, time.monotonic() + seconds)
+
+    async def on_response(self, response) -> None:
+        """Хук httpx: разбирает заголовки лимитов ответа OpenAI"""
+        model = _current_model.get()
+        if model is not None:
+            self.limiter(model).update(response.headers, response.status_code)
+
+        if response.status_code == 429:
+            self.throttled += 1
+            self.cooldown(get_openai_key_cooldown())
+        elif response.status_code == 401:
+            self.unauthorized += 1
+            self.cooldown(get_openai_auth_cooldown())
+            logging.error(f"Ключ OpenAI {self.name} отклонён (401), выведен из ротации")
+
+    def stats(self, now: float) -> dict:
+        return {
+            "requests": self.requests,
+            "tokens": self.tokens,
+            "throttled": self.throttled,
+            "unauthorized": self.unauthorized,
+            "cooldown": max(self.cooldown_until - now, 0.0),
+            "models": {
+                model: limiter.stats() for model, limiter in self.limiters.items()
+            },
+        }
+
+
+class RequestScheduler:
+    """
+    Планировщик запросов к OpenAI. Запрос направляется на ключ
+    с наибольшим запасом по лимитам своей модели, затем занимает слот
+    модели и ждёт, пока в ведрах RPM/TPM хватит запаса.
+    Медленные модели ограничены отдельно и не занимают слоты быстрых.
+    Ключ, получивший 429 или 401, исключается из ротации на время остывания.
+    """
+
+    def __init__(self) -> None:
+        self._keys: Optional[list] = None
+
+    @property
+    def keys(self) -> list:
+        if self._keys is None:
+            self._keys = [
+                ApiKey(f"key{index}", api_key, project)
+                for index, (api_key, project) in enumerate(
+                    get_openai_api_keys(), start=1
+                )
+            ]
+        return self._keys
+
+    @property
+    def primary(self) -> ApiKey:
+        return self.keys[0]
+
+    def pick(self, model: str) -> ApiKey:
+        """Выбирает ключ для запроса к модели"""
+        now = time.monotonic()
+        ready = [key for key in self.keys if key.cooldown_until <= now]
+        if not ready:
+            # Все ключи остывают - берём тот, что освободится раньше
+            return min(self.keys, key=lambda key: key.cooldown_until)
+        # При равном запасе предпочтение основному ключу
+        return max(ready, key=lambda key: key.headroom(model, now))
+
+    @asynccontextmanager
+    async def slot(
+        self, model: str, tokens: int = 0, priority: int = PRIORITY_INTERACTIVE
+    ):
+        key = self.pick(model)
+        limiter = key.limiter(model)
+        await limiter.acquire(tokens, priority)
+        key.requests += 1
+        key.tokens += tokens
+        # Не reset(): поток ответа может закрываться в другой задаче
+        previous_model = _current_model.get()
+        _current_model.set(model)
+        try:
+            yield key.get_client()
+        finally:
+            _current_model.set(previous_model)
+            limiter.release()
+
+    async def close(self) -> None:
+        for key in self._keys or ():
+            if key.client is not None:
+                await key.client.close()
+                key.client = None
+
+    def stats(self) -> Dict[str, dict]:
+        """Использование и лимиты по ключам"""
+        now = time.monotonic()
+        return {key.name: key.stats(now) for key in self.keys}
+
+
+scheduler = RequestScheduler()
+
+
+def scheduled(model: str, tokens: int = 0, priority: int = PRIORITY_INTERACTIVE):
+    """
+    Контекстный менеджер для вызова OpenAI через планировщик,
+    возвращает клиент выбранного ключа:
+        async with scheduled("gpt-4o", estimate_tokens(messages)) as client:
+            await client.chat.completions.create(...)
+    """
+    return scheduler.slot(model, tokens, priority)
+
+
+def estimate_tokens(messages: list, max_tokens: int = 0) -> int:
+    """Оценка токенов запроса для лимита TPM"""
+    total = max_tokens
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            total += message_tokens(content)
+            continue
+        for part in content:
+            if part.get("type") == "text":
+                total += message_tokens(part["text"])
+            else:
+                # Изображение в режиме high detail - порядка 765 токенов
+                total += 765
+    return total
+
+
+# Статистика кэша промптов по моделям: запросы, токены промпта и из кэша
+_prompt_cache_stats: Dict[str, Dict[str, int]] = {}
+
+
+def record_prompt_usage(model: str, usage) -> None:
+    """
+    Учитывает usage ответа Chat Completions: сколько токенов промпта
+    было взято из кэша (usage.prompt_tokens_details.cached_tokens).
+    """
+    if usage is None:
+        return
+
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached_tokens = getattr(details, "cached_tokens", None) or 0
+    stats = _prompt_cache_stats.setdefault(
+        model, {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0}
+    )
+    stats["requests"] += 1
+    stats["prompt_tokens"] += usage.prompt_tokens or 0
+    stats["cached_tokens"] += cached_tokens
+    logging.debug(
+        f"{model}: токенов промпта {usage.prompt_tokens}, из кэша {cached_tokens}"
+    )
+
+
+def prompt_cache_stats() -> Dict[str, dict]:
+    """Возвращает статистику кэша промптов и долю попаданий по моделям"""
+    return {
+        model: {
+            **stats,
+            "hit_rate": (
+                stats["cached_tokens"] / stats["prompt_tokens"]
+                if stats["prompt_tokens"]
+                else 0.0
+            ),
+        }
+        for model, stats in _prompt_cache_stats.items()
+    }
+
+
+class _Call:
+    """Выполняющийся общий вызов и число его ожидающих"""
+
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: asyncio.Task) -> None:
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Объединяет одновременные одинаковые вызовы: пока вызов с ключом
+    выполняется, повторные вызовы ждут его результат, а не запускают свой.
+    Ошибка вызова получают все ожидающие. Отмена одного ожидающего
+    не прерывает вызов; он отменяется, только когда ушли все ожидающие.
+    """
+
+    def __init__(self) -> None:
+        self._calls: Dict[str, _Call] = {}
+        self.started = 0
+        self.shared = 0
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    async def do(self, key: str, factory: Callable[[], Awaitable]):
+        call = self._calls.get(key)
+        if call is None:
+            call = _Call(asyncio.create_task(factory()))
+            self._calls[key] = call
+            call.task.add_done_callback(lambda task: self._finish(key, call))
+            self.started += 1
+        else:
+            self.shared += 1
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                # Результат больше никому не нужен
+                self._forget(key, call)
+                call.task.cancel()
+
+    def _forget(self, key: str, call: _Call) -> None:
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    def _finish(self, key: str, call: _Call) -> None:
+        self._forget(key, call)
+        # Забираем исключение, даже если ожидающих уже нет
+        if not call.task.cancelled():
+            call.task.exception()
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._calls),
+            "started": self.started,
+            "shared": self.shared,
+        }
+
+
+# Общие вызовы OpenAI (распознавание изображений, Whisper)
+openai_single_flight = SingleFlight()
+
+
+def request_key(*parts: Union[str, bytes]) -> str:
+    """Хэш содержимого и параметров запроса для SingleFlight"""
+    digest = hashlib.sha256()
+    for part in parts:
+        data = part.encode("utf-8") if isinstance(part, str) else part
+        digest.update(len(data).to_bytes(8, "big"))
+        digest.update(data)
+    return digest.hexdigest()
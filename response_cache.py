@@ -0,0 +1,145 @@
+"""
+Кэш ответов Chat Completions (включается в config.ini, [ResponseCache]).
+
+Ключ - SHA-256 от параметров запроса (модель, system, окно контекста
+и остальные параметры). Одинаковый запрос в пределах ttl отдаётся
+из таблицы 'response_cache' без обращения к API. Размер кэша ограничен
+max_entries, лишние записи вытесняются по давности использования (LRU).
+"""
+
+import hashlib
+import json
+import logging
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import delete, select, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from classes import SessionLocal, ResponseCacheModel
+from config_manager import (
+    get_response_cache_enabled,
+    get_response_cache_force_deterministic,
+    get_response_cache_ttl,
+    get_response_cache_max_entries,
+)
+
+# Модели, ответы которых зависят не только от запроса (поиск в интернете)
+BYPASS_MODELS = {"gpt-4o-search-preview"}
+
+# Модели, которым при force_deterministic передаётся temperature=0
+# (модели o1/o3 параметр temperature не принимают)
+DETERMINISTIC_MODELS = {"gpt-4o-mini", "gpt-4o", "gpt-4.1-2025-04-14"}
+
+_stats = {"hits": 0, "misses": 0, "bypassed": 0, "stored": 0}
+
+
+def response_cache_key(params: dict) -> Optional[str]:
+    """
+    Возвращает ключ кэша для параметров запроса или None, если запрос
+    не кэшируется: кэш выключен, модель с поиском или выборка
+    недетерминированная (temperature не равна 0 явно, n > 1).
+    По умолчанию API использует temperature=1, поэтому запрос
+    без temperature не кэшируется.
+    """
+    if not get_response_cache_enabled():
+        return None
+
+    if (
+        params["model"] in BYPASS_MODELS
+        or params.get("n", 1) > 1
+        or params.get("temperature") != 0
+    ):
+        _stats["bypassed"] += 1
+        return None
+
+    payload = json.dumps(
+        params, sort_keys=True, ensure_ascii=False, separators=(",", ":")
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def deterministic_params(params: dict) -> dict:
+    """
+    Добавляет temperature=0 в запрос модели, ответы которой кэшируются,
+    если это явно включено ([ResponseCache] force_deterministic).
+    По умолчанию выборка не меняется, и такие запросы не кэшируются.
+    """
+    if (
+        get_response_cache_enabled()
+        and get_response_cache_force_deterministic()
+        and params["model"] in DETERMINISTIC_MODELS
+    ):
+        params["temperature"] = 0
+    return params
+
+
+async def get_cached_response(key: str) -> Optional[str]:
+    """Возвращает сохранённый ответ или None (промах или истёк ttl)"""
+    cutoff = datetime.utcnow() - timedelta(seconds=get_response_cache_ttl())
+    try:
+        async with SessionLocal() as session:
+            response = await session.scalar(
+                select(ResponseCacheModel.response).where(
+                    ResponseCacheModel.key == key,
+                    ResponseCacheModel.created_at >= cutoff,
+                )
+            )
+            if response is not None:
+                await session.execute(
+                    update(ResponseCacheModel)
+                    .where(ResponseCacheModel.key == key)
+                    .values(last_used=datetime.utcnow())
+                )
+                await session.commit()
+    except Exception as e:
+        logging.error(f"Ошибка чтения кэша ответов: {e}")
+        return None
+
+    if response is None:
+        _stats["misses"] += 1
+    else:
+        _stats["hits"] += 1
+    return response
+
+
+async def store_cached_response(key: str, model: str, response: str) -> None:
+    """Сохраняет ответ и вытесняет устаревшие и лишние записи"""
+    now = datetime.utcnow()
+    cutoff = now - timedelta(seconds=get_response_cache_ttl())
+    try:
+        async with SessionLocal() as session:
+            stmt = sqlite_insert(ResponseCacheModel).values(
+                key=key, model=model, response=response, created_at=now, last_used=now
+            )
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[ResponseCacheModel.key],
+                set_={
+                    "response": stmt.excluded.response,
+                    "created_at": stmt.excluded.created_at,
+                    "last_used": stmt.excluded.last_used,
+                },
+            )
+            await session.execute(stmt)
+
+            await session.execute(
+                delete(ResponseCacheModel).where(ResponseCacheModel.created_at < cutoff)
+            )
+            recent = (
+                select(ResponseCacheModel.key)
+                .order_by(ResponseCacheModel.last_used.desc())
+                .limit(get_response_cache_max_entries())
+            )
+            await session.execute(
+                delete(ResponseCacheModel).where(ResponseCacheModel.key.not_in(recent))
+            )
+            await session.commit()
+        _stats["stored"] += 1
+    except Exception as e:
+        logging.error(f"Ошибка записи в кэш ответов: {e}")
+
+
+def response_cache_stats() -> dict:
+    """Возвращает счётчики кэша ответов"""
+    lookups = _stats["hits"] + _stats["misses"]
+    return {**_stats, "hit_rate": _stats["hits"] / lookups if lookups else 0.0}
@@ -0,0 +1,161 @@
+"""
+Сжатие старой части истории в краткое содержание.
+
+Когда несжатая часть истории перестаёт помещаться в лимит контекста
+модели, сообщения перед окном контекста пересказываются дешёвой моделью.
+В запросах краткое содержание заменяет эти сообщения, а сами сообщения
+остаются в БД. Сжатие выполняется фоновой задачей после ответа
+пользователю и не задерживает обработку запросов.
+"""
+
+import asyncio
+import logging
+from typing import Callable, Dict, Optional
+
+from base import save_history_summary
+from classes import History
+from config_manager import (
+    get_summary_enabled,
+    get_summary_model,
+)
+from openai_manager import (
+    record_prompt_usage,
+    scheduled,
+    estimate_tokens,
+    PRIORITY_BACKGROUND,
+)
+from usage_ledger import track
+
+SUMMARY_INSTRUCTION = (
+    "Ты сжимаешь историю диалога пользователя с ассистентом. "
+    "Составь краткое содержание, достаточное для продолжения разговора: "
+    "факты о пользователе, его цели и предпочтения, принятые решения, "
+    "важные детали (имена, числа, код, ссылки) и открытые вопросы. "
+    "Если дано предыдущее краткое содержание, объедини его с новыми "
+    "сообщениями. Пиши на языке диалога, без вступлений."
+)
+
+# Ограничение длины краткого содержания (токенов)
+SUMMARY_MAX_TOKENS = 1000
+
+_ROLE_TITLES = {"system": "Система", "user": "Пользователь", "assistant": "Ассистент"}
+
+
+class HistorySummarizer:
+    """
+    Составляет краткое содержание фрагмента истории.
+    Клиент OpenAI выдаёт планировщик; client_factory позволяет его подменить.
+    """
+
+    def __init__(
+        self,
+        client_factory: Optional[Callable] = None,
+        model: Optional[str] = None,
+        max_tokens: int = SUMMARY_MAX_TOKENS,
+    ) -> None:
+        self._client_factory = client_factory
+        self.model = model
+        self.max_tokens = max_tokens
+
+    async def summarize(
+        self, previous_summary: str, messages: list, user_id: Optional[int] = None
+    ) -> str:
+        transcript = "\n\n".join(
+            f"{_ROLE_TITLES[message['role']]}: {message['content']}"
+            for message in messages
+        )
+        prompt = f"Новые сообщения:\n\n{transcript}"
+        if previous_summary:
+            prompt = f"Предыдущее краткое содержание:\n{previous_summary}\n\n{prompt}"
+
+        model = self.model or get_summary_model()
+        request = [
+            {"role": "system", "content": SUMMARY_INSTRUCTION},
+            {"role": "user", "content": prompt},
+        ]
+        async with track("summary", model, user_id) as entry, scheduled(
+            model, estimate_tokens(request, self.max_tokens), PRIORITY_BACKGROUND
+        ) as client:
+            if self._client_factory is not None:
+                client = self._client_factory()
+            completion = await client.chat.completions.create(
+                model=model, messages=request, max_tokens=self.max_tokens
+            )
+            entry.add_usage(getattr(completion, "usage", None))
+        record_prompt_usage(model, getattr(completion, "usage", None))
+        return (completion.choices[0].message.content or "").strip()
+
+
+_summarizer = HistorySummarizer()
+
+# Выполняющиеся задачи сжатия: не больше одной на пользователя
+_compaction_tasks: Dict[int, asyncio.Task] = {}
+
+
+def schedule_compaction(
+    user_id: int,
+    messages: History,
+    max_tokens: int,
+    block_tokens: int = 0,
+    summarizer: Optional[HistorySummarizer] = None,
+) -> Optional[asyncio.Task]:
+    """
+    Запускает фоновое сжатие истории, если несжатая часть больше лимита
+    контекста модели max_tokens. Сжимаются только сообщения перед окном
+    контекста (см. History.context_window), поэтому в запрос попадает
+    не меньше сообщений, чем без сжатия.
+    Возвращает задачу или None, если сжатие не требуется.
+    """
+    if not get_summary_enabled() or user_id in _compaction_tasks:
+        return None
+    if messages.unsummarized_tokens() <= max_tokens:
+        return None
+
+    start = messages.summary_index
+    end = messages.window_start(max_tokens, block_tokens)
+    if end <= start:
+        return None
+
+    task = asyncio.create_task(
+        _compact(
+            user_id,
+            messages,
+            messages.summary,
+            messages[start:end],
+            end,
+            summarizer or _summarizer,
+        )
+    )
+    _compaction_tasks[user_id] = task
+    task.add_done_callback(lambda _: _compaction_tasks.pop(user_id, None))
+    return task
+
+
+async def _compact(
+    user_id: int,
+    messages: History,
+    previous_summary: str,
+    span: list,
+    end: int,
+    summarizer: HistorySummarizer,
+) -> None:
+    try:
+        summary = await summarizer.summarize(previous_summary, span, user_id)
+        if not summary:
+            return
+        if await save_history_summary(user_id, messages, summary, end):
+            logging.info(
+                f"История пользователя {user_id} сжата: {len(span)} сообщений"
+            )
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logging.error(f"Ошибка при сжатии истории пользователя {user_id}: {e}")
+
+
+async def stop_compaction() -> None:
+    """Отменяет незавершённые задачи сжатия (при остановке бота)"""
+    tasks = list(_compaction_tasks.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,43 @@
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import base  # noqa: E402
+import classes  # noqa: E402
+
+
+@pytest.fixture
+def run_db(tmp_path, monkeypatch):
+    """
+    Выполняет корутину на отдельной БД во временном каталоге
+    с пустыми кэшами пользователей.
+    """
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'test.sqlite'}")
+    session_local = async_sessionmaker(engine, expire_on_commit=False)
+    monkeypatch.setattr(classes, "engine", engine)
+    monkeypatch.setattr(classes, "SessionLocal", session_local)
+    monkeypatch.setattr(base, "SessionLocal", session_local)
+    monkeypatch.setattr(base, "users_data", {})
+    monkeypatch.setattr(base, "_history_sync", {})
+    monkeypatch.setattr(base, "_dirty_users", set())
+    monkeypatch.setattr(
+        base, "users_history", base.UserCache(base.get_cache_max_bytes(), 3600)
+    )
+
+    def run(coro_factory):
+        async def main():
+            monkeypatch.setattr(base, "_flush_lock", asyncio.Lock())
+            await classes.init_async_db()
+            try:
+                return await coro_factory()
+            finally:
+                await engine.dispose()
+
+        return asyncio.run(main())
+
+    return run
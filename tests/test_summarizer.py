@@ -0,0 +1,163 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import select
+
+import base
+import summarizer
+from classes import SummaryModel
+from summarizer import HistorySummarizer, schedule_compaction
+
+
+class StubCompletions:
+    """Заглушка chat.completions: возвращает пронумерованные сводки"""
+
+    def __init__(self, release: asyncio.Event = None) -> None:
+        self.calls = []
+        self.release = release
+
+    async def create(self, **params):
+        self.calls.append(params)
+        if self.release is not None:
+            await self.release.wait()
+        return SimpleNamespace(
+            choices=[
+                SimpleNamespace(
+                    message=SimpleNamespace(content=f" сводка {len(self.calls)} ")
+                )
+            ],
+            usage=None,
+        )
+
+
+def stub_summarizer(completions: StubCompletions) -> HistorySummarizer:
+    client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+    return HistorySummarizer(client_factory=lambda: client, model="gpt-4o-mini")
+
+
+# Лимит контекста модели в тестах: история из fill_history в него не помещается
+MAX_TOKENS = 300
+
+
+@pytest.fixture(autouse=True)
+def summary_enabled(monkeypatch):
+    monkeypatch.setattr(summarizer, "get_summary_enabled", lambda: True)
+
+
+async def fill_history(user_id: int, turns: int = 10):
+    history = await base.get_user_history(user_id)
+    for turn in range(turns):
+        history.append({"role": "user", "content": f"вопрос {turn} " + "слово " * 20})
+        history.append(
+            {"role": "assistant", "content": f"ответ {turn} " + "text " * 20}
+        )
+    await base.save_user_data(user_id)
+    return history
+
+
+async def stored_summary(user_id: int):
+    async with base.SessionLocal() as session:
+        return await session.scalar(
+            select(SummaryModel).where(SummaryModel.user_id == str(user_id))
+        )
+
+
+def test_compaction_replaces_old_messages(run_db):
+    completions = StubCompletions()
+
+    async def scenario():
+        history = await fill_history(1)
+        window_start = history.window_start(MAX_TOKENS)
+        task = schedule_compaction(
+            1, history, MAX_TOKENS, summarizer=stub_summarizer(completions)
+        )
+        assert task is not None
+        await task
+        return history, window_start, await stored_summary(1)
+
+    history, window_start, record = run_db(scenario)
+
+    assert len(completions.calls) == 1
+    prompt = completions.calls[0]["messages"][1]["content"]
+    assert "вопрос 0" in prompt
+    assert history.summary == "сводка 1"
+    # Сжимаются только сообщения, не попадавшие в окно контекста
+    assert 0 < history.summary_index == window_start
+    assert record.content == "сводка 1"
+    assert record.covered_seq == history.summary_index
+
+    window = history.context_window(
+        MAX_TOKENS, system={"role": "system", "content": "s"}
+    )
+    assert window[1]["content"].endswith("сводка 1")
+    assert window[-1] == history[len(history) - 1]
+    assert history[0] not in window
+
+
+def test_history_within_budget_is_not_summarized(run_db):
+    completions = StubCompletions()
+
+    async def scenario():
+        history = await fill_history(1)
+        task = schedule_compaction(
+            1,
+            history,
+            history.total_tokens(),
+            summarizer=stub_summarizer(completions),
+        )
+        return task, history, await stored_summary(1)
+
+    task, history, record = run_db(scenario)
+
+    assert task is None
+    assert not completions.calls
+    assert record is None
+    assert history.summary == ""
+    window = history.context_window(history.total_tokens())
+    assert window == history[:]
+
+
+def test_summary_is_reloaded_from_table(run_db):
+    async def scenario():
+        history = await fill_history(1)
+        await schedule_compaction(
+            1, history, MAX_TOKENS, summarizer=stub_summarizer(StubCompletions())
+        )
+        await base.flush_user_data()
+        covered = history[history.summary_index :]
+
+        # Вытесняем историю из кэша и загружаем заново из БД
+        base.users_history.pop(1)
+        base._history_sync.pop(1)
+        reloaded = await base.get_user_history(1)
+        return covered, reloaded
+
+    covered, reloaded = run_db(scenario)
+
+    assert reloaded.summary == "сводка 1"
+    assert reloaded.summary_index == 0
+    # Сообщения, покрытые кратким содержанием, не загружаются
+    assert list(reloaded) == covered
+
+
+def test_clear_during_compaction_discards_summary(run_db):
+    async def scenario():
+        release = asyncio.Event()
+        history = await fill_history(1)
+        completions = StubCompletions(release)
+        task = schedule_compaction(
+            1, history, MAX_TOKENS, summarizer=stub_summarizer(completions)
+        )
+        await asyncio.sleep(0)
+
+        cleared = await base.clear_user_history(1)
+        release.set()
+        await task
+        return history, cleared, await stored_summary(1)
+
+    history, cleared, record = run_db(scenario)
+
+    assert record is None
+    assert cleared.summary == ""
+    assert history.summary == ""
@@ -18,7 +18,10 @@ help_message = (
     "/start - Запуск бота\n"
     "/menu - Главное меню\n"
     "/help - Показать справку\n"
-    "/null - Сброс к заводским настройкам\n\n"
+    "/null - Сброс к заводским настройкам\n"
+    "/usage - Расходы по моделям за 7 дней (/usage 30 - за 30 дней)\n"
+    "/stats - Ключи API, очереди, кэши и пулы соединений с момента запуска\n"
+    "/janitor - Файлы, треды и хранилища OpenAI, созданные ботом, и их уборка\n\n"
     "⚙️ <b>Главное меню:</b>\n"
     " - <b>Выбор модели:</b> Изменить модель\n"
     " - <b>Параметры картинки:</b> Настройка генерации изображений\n"
@@ -0,0 +1,153 @@
+"""
+Подсчёт токенов для бюджета контекста.
+
+Если установлен tiktoken и его словарь o200k_base уже лежит локально,
+используется точный BPE. Иначе - быстрая оценка по доле кириллицы,
+откалиброванная под o200k_base (с небольшим запасом).
+Словарь никогда не скачивается во время работы бота.
+"""
+
+import hashlib
+import logging
+import math
+import os
+import tempfile
+from typing import Optional
+
+from config_manager import get_tokenizer_vocab_dir
+
+try:
+    import tiktoken
+except ImportError:  # pragma: no cover - зависит от окружения
+    tiktoken = None
+
+ENCODING_NAME = "o200k_base"
+_VOCAB_URL = "https://openaipublic.blob.core.windows.net/encodings/o200k_base.tiktoken"
+
+# Служебные токены разметки чата на каждое сообщение (роль и разделители)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Символов на токен для o200k_base: латиница и ASCII, кириллица
+_ASCII_CHARS_PER_TOKEN = 4.0
+_CYRILLIC_CHARS_PER_TOKEN = 3.2
+
+
+class Tokenizer:
+    """Интерфейс подсчёта токенов"""
+
+    name = "base"
+
+    def count(self, text: str) -> int:
+        raise NotImplementedError
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """Начало текста не длиннее max_tokens токенов"""
+        tokens = self.count(text)
+        while tokens > max_tokens and text:
+            # Отрезаем пропорционально лишним токенам, с небольшим запасом
+            text = text[: int(len(text) * max_tokens / tokens * 0.98)]
+            tokens = self.count(text)
+        return text
+
+
+class EstimatingTokenizer(Tokenizer):
+    """
+    Оценка числа токенов без словаря.
+    Доля не-ASCII символов определяется по длине UTF-8 представления:
+    кириллица занимает 2 байта, поэтому весь подсчёт выполняется в C.
+    """
+
+    name = "estimate"
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        chars = len(text)
+        extra_bytes = len(text.encode("utf-8")) - chars
+        ascii_chars = max(chars - extra_bytes, 0)
+        tokens = (
+            ascii_chars / _ASCII_CHARS_PER_TOKEN
+            + extra_bytes / _CYRILLIC_CHARS_PER_TOKEN
+        )
+        return max(math.ceil(tokens), 1)
+
+
+class BpeTokenizer(Tokenizer):
+    """Точный подсчёт токенов через tiktoken"""
+
+    def __init__(self, encoding) -> None:
+        self._encoding = encoding
+        self.name = encoding.name
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        return len(self._encoding.encode_ordinary(text))
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        tokens = self._encoding.encode_ordinary(text)
+        if len(tokens) <= max_tokens:
+            return text
+        return self._encoding.decode(tokens[:max_tokens])
+
+
+def _local_vocab_dir() -> Optional[str]:
+    """Ищет каталог кэша tiktoken, в котором уже есть словарь"""
+    candidates = (
+        get_tokenizer_vocab_dir(),
+        os.environ.get("TIKTOKEN_CACHE_DIR"),
+        os.environ.get("DATA_GYM_CACHE_DIR"),
+        os.path.join(tempfile.gettempdir(), "data-gym-cache"),
+    )
+    cache_key = hashlib.sha1(_VOCAB_URL.encode()).hexdigest()
+    for directory in candidates:
+        if directory and os.path.exists(os.path.join(directory, cache_key)):
+            return directory
+    return None
+
+
+def _create_tokenizer() -> Tokenizer:
+    if tiktoken is None:
+        return EstimatingTokenizer()
+
+    vocab_dir = _local_vocab_dir()
+    if vocab_dir is None:
+        logging.warning(
+            f"Словарь {ENCODING_NAME} не найден локально, токены считаются приближённо"
+        )
+        return EstimatingTokenizer()
+
+    try:
+        os.environ["TIKTOKEN_CACHE_DIR"] = vocab_dir
+        return BpeTokenizer(tiktoken.get_encoding(ENCODING_NAME))
+    except Exception as e:
+        logging.error(f"Не удалось загрузить словарь {ENCODING_NAME}: {e}")
+        return EstimatingTokenizer()
+
+
+_tokenizer: Optional[Tokenizer] = None
+
+
+def get_tokenizer() -> Tokenizer:
+    """Возвращает токенизатор (создаётся при первом обращении)"""
+    global _tokenizer
+    if _tokenizer is None:
+        _tokenizer = _create_tokenizer()
+    return _tokenizer
+
+
+def count_tokens(text: str) -> int:
+    """Число токенов в тексте"""
+    return get_tokenizer().count(text)
+
+
+def truncate_message(content: str, max_tokens: int) -> str:
+    """Обрезает текст сообщения до стоимости не больше max_tokens"""
+    return get_tokenizer().truncate(
+        content, max(max_tokens - MESSAGE_OVERHEAD_TOKENS, 0)
+    )
+
+
+def message_tokens(content: str) -> int:
+    """Стоимость сообщения в запросе: текст плюс служебные токены"""
+    return get_tokenizer().count(content) + MESSAGE_OVERHEAD_TOKENS
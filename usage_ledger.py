@@ -0,0 +1,316 @@
+"""
+Журнал расходов на OpenAI.
+
+Каждый вызов API (чат, распознавание изображений, Whisper, TTS, DALL-E,
+запуски ассистентов, сжатие истории) записывается в таблицу 'usage_ledger':
+модель, токены, секунды аудио, изображения, задержка и статус.
+Записи копятся в памяти и сбрасываются пакетами фоновой задачей;
+в той же транзакции обновляются дневные итоги 'usage_daily'
+по пользователю и модели. Отчёт строится по итогам, а не по журналу.
+"""
+
+import asyncio
+import json
+import logging
+import time
+from bisect import bisect_left
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from sqlalchemy import insert, select, tuple_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from classes import SessionLocal, UsageModel, UsageDailyModel
+from config_manager import get_usage_flush_interval, get_usage_batch_size
+
+# Верхние границы корзин гистограммы задержек (мс): от 50 мс до ~14 мин
+LATENCY_BUCKETS_MS = tuple(round(50 * 1.5**index) for index in range(25))
+
+# Суммируемые поля записи журнала
+_TOTALS = (
+    "prompt_tokens",
+    "completion_tokens",
+    "cached_tokens",
+    "audio_seconds",
+    "characters",
+    "images",
+    "latency_ms",
+)
+
+
+class UsageEntry:
+    """Запись журнала об одном вызове API"""
+
+    __slots__ = ("kind", "model", "user_id", "status", "created_at") + _TOTALS
+
+    def __init__(self, kind: str, model: str, user_id: Optional[int] = None):
+        self.kind = kind
+        self.model = model
+        self.user_id = user_id
+        self.status = "ok"
+        self.created_at = datetime.utcnow()
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+        self.audio_seconds = 0.0
+        self.characters = 0
+        self.images = 0
+        self.latency_ms = 0
+
+    def add_usage(self, usage) -> None:
+        """Учитывает usage ответа (Chat Completions или запуска ассистента)"""
+        if usage is None:
+            return
+        self.prompt_tokens += getattr(usage, "prompt_tokens", 0) or 0
+        self.completion_tokens += getattr(usage, "completion_tokens", 0) or 0
+        details = getattr(usage, "prompt_tokens_details", None)
+        self.cached_tokens += getattr(details, "cached_tokens", 0) or 0
+
+    def row(self) -> dict:
+        row = {name: getattr(self, name) for name in _TOTALS}
+        row.update(
+            created_at=self.created_at,
+            user_id=str(self.user_id) if self.user_id is not None else None,
+            kind=self.kind,
+            model=self.model,
+            status=self.status,
+        )
+        return row
+
+
+_pending: List[dict] = []
+_flush_event = asyncio.Event()
+_flush_lock = asyncio.Lock()
+_flusher_task: Optional[asyncio.Task] = None
+
+
+def _append(entry: UsageEntry) -> None:
+    _pending.append(entry.row())
+    if len(_pending) >= get_usage_batch_size():
+        _flush_event.set()
+
+
+@asynccontextmanager
+async def track(kind: str, model: str, user_id: Optional[int] = None):
+    """
+    Записывает вызов API в журнал: задержку и статус определяет сам,
+    токены и прочие объёмы заполняет вызывающий код:
+        async with track("chat", model, user_id) as entry:
+            completion = await client.chat.completions.create(...)
+            entry.add_usage(completion.usage)
+    """
+    entry = UsageEntry(kind, model, user_id)
+    started = time.monotonic()
+    try:
+        yield entry
+    except asyncio.CancelledError:
+        entry.status = "cancelled"
+        raise
+    except Exception as e:
+        entry.status = f"error:{type(e).__name__}"
+        raise
+    finally:
+        entry.latency_ms = round((time.monotonic() - started) * 1000)
+        _append(entry)
+
+
+def _empty_totals() -> dict:
+    totals = dict.fromkeys(_TOTALS, 0)
+    totals.update(requests=0, errors=0, histogram=[0] * (len(LATENCY_BUCKETS_MS) + 1))
+    return totals
+
+
+def _add_row(totals: dict, row: dict) -> None:
+    for name in _TOTALS:
+        totals[name] += row[name]
+    totals["requests"] += 1
+    if row["status"] != "ok":
+        totals["errors"] += 1
+    totals["histogram"][bisect_left(LATENCY_BUCKETS_MS, row["latency_ms"])] += 1
+
+
+def _merge(totals: dict, other: dict) -> None:
+    for name in _TOTALS + ("requests", "errors"):
+        totals[name] += other[name]
+    for index, count in enumerate(other["histogram"]):
+        totals["histogram"][index] += count
+
+
+def _from_daily(record: UsageDailyModel) -> dict:
+    totals = {name: getattr(record, name) for name in _TOTALS}
+    totals.update(requests=record.requests, errors=record.errors)
+    histogram = json.loads(record.latency_histogram or "[]")
+    totals["histogram"] = histogram + [0] * (
+        len(LATENCY_BUCKETS_MS) + 1 - len(histogram)
+    )
+    return totals
+
+
+async def flush_usage() -> None:
+    """Записывает накопленные записи и обновляет дневные итоги"""
+    async with _flush_lock:
+        if not _pending:
+            return
+        batch = _pending[:]
+        del _pending[:]
+
+        daily: Dict[tuple, dict] = {}
+        for row in batch:
+            day = row["created_at"].date().isoformat()
+            key = (day, row["user_id"] or "", row["model"])
+            _add_row(daily.setdefault(key, _empty_totals()), row)
+
+        try:
+            async with SessionLocal() as session:
+                await session.execute(insert(UsageModel), batch)
+
+                existing = await session.scalars(
+                    select(UsageDailyModel).where(
+                        tuple_(
+                            UsageDailyModel.day,
+                            UsageDailyModel.user_id,
+                            UsageDailyModel.model,
+                        ).in_(list(daily))
+                    )
+                )
+                for record in existing:
+                    key = (record.day, record.user_id, record.model)
+                    _merge(daily[key], _from_daily(record))
+
+                rows = []
+                for (day, user_id, model), totals in daily.items():
+                    row = {name: totals[name] for name in _TOTALS}
+                    row.update(
+                        day=day,
+                        user_id=user_id,
+                        model=model,
+                        requests=totals["requests"],
+                        errors=totals["errors"],
+                        latency_histogram=json.dumps(totals["histogram"]),
+                    )
+                    rows.append(row)
+                stmt = sqlite_insert(UsageDailyModel)
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=["day", "user_id", "model"],
+                    set_={
+                        name: stmt.excluded[name]
+                        for name in rows[0]
+                        if name not in ("day", "user_id", "model")
+                    },
+                )
+                await session.execute(stmt, rows)
+                await session.commit()
+        except Exception as e:
+            # Возвращаем записи в очередь, чтобы повторить запись позже
+            _pending[:0] = batch
+            logging.error(f"Ошибка записи журнала расходов ({len(batch)} записей): {e}")
+
+
+async def _flush_loop() -> None:
+    interval = get_usage_flush_interval()
+    while True:
+        try:
+            await asyncio.wait_for(_flush_event.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
+        _flush_event.clear()
+        await flush_usage()
+
+
+def start_usage_ledger() -> None:
+    """Запускает фоновую запись журнала расходов"""
+    global _flusher_task
+    if _flusher_task is None or _flusher_task.done():
+        _flush_event.clear()
+        _flusher_task = asyncio.create_task(_flush_loop())
+
+
+async def stop_usage_ledger() -> None:
+    """Останавливает фоновую запись и сохраняет оставшиеся записи"""
+    global _flusher_task
+    if _flusher_task is not None:
+        _flusher_task.cancel()
+        try:
+            await _flusher_task
+        except asyncio.CancelledError:
+            pass
+        _flusher_task = None
+
+    await flush_usage()
+
+
+def _percentile(histogram: List[int], q: float) -> str:
+    """Перцентиль задержки по гистограмме (верхняя граница корзины)"""
+    total = sum(histogram)
+    if not total:
+        return "-"
+    rank = q * total
+    seen = 0
+    for index, count in enumerate(histogram):
+        seen += count
+        if seen >= rank:
+            if index == len(LATENCY_BUCKETS_MS):
+                return f">{LATENCY_BUCKETS_MS[-1] / 1000:.0f} с"
+            bound = LATENCY_BUCKETS_MS[index]
+            return f"{bound} мс" if bound < 1000 else f"{bound / 1000:.1f} с"
+    return "-"
+
+
+async def usage_report(days: int = 7, top_users: int = 5) -> str:
+    """Отчёт по моделям и пользователям за последние days дней (HTML)"""
+    await flush_usage()
+    since = (datetime.utcnow() - timedelta(days=days - 1)).date().isoformat()
+    async with SessionLocal() as session:
+        records = list(
+            await session.scalars(
+                select(UsageDailyModel).where(UsageDailyModel.day >= since)
+            )
+        )
+
+    if not records:
+        return f"За {days} дн. вызовов OpenAI не было."
+
+    by_model: Dict[str, dict] = {}
+    by_user: Dict[str, dict] = {}
+    for record in records:
+        totals = _from_daily(record)
+        _merge(by_model.setdefault(record.model, _empty_totals()), totals)
+        _merge(by_user.setdefault(record.user_id, _empty_totals()), totals)
+
+    lines = [f"<b>Расходы за {days} дн.</b>", ""]
+    for model, totals in sorted(
+        by_model.items(), key=lambda item: item[1]["requests"], reverse=True
+    ):
+        lines.append(
+            f"<b>{model}</b>: {totals['requests']} выз., ошибок {totals['errors']}"
+        )
+        volume = []
+        if totals["prompt_tokens"] or totals["completion_tokens"]:
+            volume.append(
+                f"токены {totals['prompt_tokens']}/{totals['completion_tokens']}"
+                f" (кэш {totals['cached_tokens']})"
+            )
+        if totals["audio_seconds"]:
+            volume.append(f"аудио {totals['audio_seconds']:.0f} с")
+        if totals["characters"]:
+            volume.append(f"символов {totals['characters']}")
+        if totals["images"]:
+            volume.append(f"изображений {totals['images']}")
+        volume.append(
+            f"p50 {_percentile(totals['histogram'], 0.5)}, "
+            f"p95 {_percentile(totals['histogram'], 0.95)}"
+        )
+        lines.append("  " + ", ".join(volume))
+
+    lines += ["", "<b>Пользователи</b> (токены вход/выход):"]
+    for user_id, totals in sorted(
+        by_user.items(),
+        key=lambda item: item[1]["prompt_tokens"] + item[1]["completion_tokens"],
+        reverse=True,
+    )[:top_users]:
+        lines.append(
+            f"{user_id or 'фон'}: {totals['requests']} выз., "
+            f"{totals['prompt_tokens']}/{totals['completion_tokens']}"
+        )
+    return "\n".join(lines)
@@ -0,0 +1,245 @@
+"""
+Векторные хранилища документов для режима ассистентов.
+
+У каждого пользователя по одному хранилищу на слот ассистента
+(таблица 'vector_stores'). Новые документы добавляются в него пакетом
+(file_batches.create_and_poll), а хранилище подключается к треду через
+tool_resources, поэтому запуск ищет по уже проиндексированным документам.
+Документ, который уже есть в хранилище (таблица 'vector_store_files'),
+повторно не индексируется. Хранилище удаляется вместе с тредом
+(reset_thread, /null); не удалённые хранилища убирает janitor.
+Перед запуском ассистента проверяется, что подключённое к треду
+хранилище не истекло по expires_after: истёкшее создаётся заново
+с теми же документами, иначе запуск с file_search завершился бы ошибкой.
+"""
+
+import logging
+import math
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from openai import NotFoundError
+from sqlalchemy import delete, select, update
+
+from classes import SessionLocal, VectorStoreModel, VectorStoreFileModel
+from config_manager import get_vector_store_expire_days
+from janitor import mark_deleted, register_resource
+from openai_manager import get_async_openai_client
+
+_stats = {
+    "created": 0,
+    "indexed": 0,
+    "skipped": 0,
+    "attached": 0,
+    "dropped": 0,
+    "expired": 0,
+}
+
+# Срок хранилища по данным OpenAI (expires_at, unix-время) по (user_id, slot):
+# до него хранилище перед запуском повторно не проверяется
+_expires_at: Dict[Tuple[int, int], float] = {}
+
+
+async def _create_store(client, user_id: int, slot: int) -> VectorStoreModel:
+    params = {"name": f"user {user_id} assistant {slot}"}
+    expire_days = get_vector_store_expire_days()
+    if expire_days > 0:
+        params["expires_after"] = {"anchor": "last_active_at", "days": expire_days}
+    vector_store = await client.vector_stores.create(**params)
+    await register_resource("vector_store", vector_store.id, user_id)
+    _stats["created"] += 1
+    logging.info(
+        f"Создано векторное хранилище {vector_store.id} "
+        f"для пользователя {user_id}, ассистент {slot}"
+    )
+
+    record = VectorStoreModel(
+        user_id=str(user_id),
+        slot=slot,
+        vector_store_id=vector_store.id,
+        thread_id="",
+        created_at=datetime.utcnow(),
+    )
+    async with SessionLocal() as session:
+        session.add(record)
+        await session.commit()
+    return record
+
+
+async def add_documents(
+    user_id: int, slot: int, thread_id: str, file_ids: List[str]
+) -> str:
+    """
+    Добавляет документы в хранилище пользователя (создаёт его при первом
+    документе) и подключает хранилище к треду. Возвращает id хранилища.
+    """
+    client = get_async_openai_client()
+    async with SessionLocal() as session:
+        record = await session.get(VectorStoreModel, (str(user_id), slot))
+        known = set()
+        if record is not None:
+            known = set(
+                await session.scalars(
+                    select(VectorStoreFileModel.file_id).where(
+                        VectorStoreFileModel.vector_store_id
+                        == record.vector_store_id,
+                        VectorStoreFileModel.file_id.in_(file_ids),
+                    )
+                )
+            )
+    if record is None:
+        record = await _create_store(client, user_id, slot)
+    vector_store_id = record.vector_store_id
+
+    new_ids = [file_id for file_id in dict.fromkeys(file_ids) if file_id not in known]
+    _stats["skipped"] += len(file_ids) - len(new_ids)
+    if new_ids:
+        try:
+            batch = await client.vector_stores.file_batches.create_and_poll(
+                vector_store_id=vector_store_id, file_ids=new_ids
+            )
+        except NotFoundError:
+            # Хранилище истекло по expires_after - создаём новое
+            logging.warning(f"Векторное хранилище {vector_store_id} не найдено")
+            await _forget_store(user_id, slot)
+            await mark_deleted(vector_store_id)
+            record = await _create_store(client, user_id, slot)
+            vector_store_id = record.vector_store_id
+            new_ids = list(dict.fromkeys(file_ids))
+            batch = await client.vector_stores.file_batches.create_and_poll(
+                vector_store_id=vector_store_id, file_ids=new_ids
+            )
+        counts = batch.file_counts
+        if batch.status != "completed" or counts.failed:
+            raise Exception(
+                f"Индексация документов: {batch.status}, "
+                f"ошибок {counts.failed} из {counts.total}"
+            )
+        _stats["indexed"] += len(new_ids)
+        async with SessionLocal() as session:
+            session.add_all(
+                VectorStoreFileModel(
+                    vector_store_id=vector_store_id,
+                    file_id=file_id,
+                    added_at=datetime.utcnow(),
+                )
+                for file_id in new_ids
+            )
+            await session.commit()
+
+    if record.thread_id != thread_id:
+        await client.beta.threads.update(
+            thread_id,
+            tool_resources={"file_search": {"vector_store_ids": [vector_store_id]}},
+        )
+        _stats["attached"] += 1
+        async with SessionLocal() as session:
+            await session.execute(
+                update(VectorStoreModel)
+                .where(
+                    VectorStoreModel.user_id == str(user_id),
+                    VectorStoreModel.slot == slot,
+                )
+                .values(thread_id=thread_id)
+            )
+            await session.commit()
+    return vector_store_id
+
+
+async def ensure_vector_store(user_id: int, slot: int, thread_id: str) -> None:
+    """
+    Проверяет перед запуском, что хранилище, подключённое к треду, не истекло.
+    Истёкшее хранилище создаётся заново с теми же документами и снова
+    подключается к треду; если документы восстановить не удалось,
+    хранилище отключается от треда. OpenAI опрашивается, только когда
+    прошёл известный срок хранилища.
+    """
+    key = (user_id, slot)
+    if time.time() < _expires_at.get(key, 0):
+        return
+
+    async with SessionLocal() as session:
+        record = await session.get(VectorStoreModel, (str(user_id), slot))
+        if record is None or record.thread_id != thread_id:
+            return
+        vector_store_id = record.vector_store_id
+        file_ids = list(
+            await session.scalars(
+                select(VectorStoreFileModel.file_id).where(
+                    VectorStoreFileModel.vector_store_id == vector_store_id
+                )
+            )
+        )
+
+    client = get_async_openai_client()
+    try:
+        vector_store = await client.vector_stores.retrieve(vector_store_id)
+    except NotFoundError:
+        vector_store = None
+    if vector_store is not None and vector_store.status != "expired":
+        _expires_at[key] = vector_store.expires_at or math.inf
+        return
+
+    _stats["expired"] += 1
+    logging.warning(
+        f"Векторное хранилище {vector_store_id} пользователя {user_id} истекло, "
+        f"создаём новое"
+    )
+    await _forget_store(user_id, slot)
+    await mark_deleted(vector_store_id)
+    if file_ids:
+        try:
+            await add_documents(user_id, slot, thread_id, file_ids)
+            return
+        except Exception as e:
+            logging.error(f"Не удалось восстановить документы хранилища: {e}")
+
+    # Без хранилища тред остаётся рабочим, но без поиска по документам
+    await client.beta.threads.update(
+        thread_id, tool_resources={"file_search": {"vector_store_ids": []}}
+    )
+
+
+async def _forget_store(user_id: int, slot: int) -> Optional[str]:
+    """Удаляет запись о хранилище и его документах, возвращает id хранилища"""
+    _expires_at.pop((user_id, slot), None)
+    async with SessionLocal() as session:
+        record = await session.get(VectorStoreModel, (str(user_id), slot))
+        if record is None:
+            return None
+        vector_store_id = record.vector_store_id
+        await session.delete(record)
+        await session.execute(
+            delete(VectorStoreFileModel).where(
+                VectorStoreFileModel.vector_store_id == vector_store_id
+            )
+        )
+        await session.commit()
+    return vector_store_id
+
+
+async def drop_vector_store(user_id: int, slot: int) -> Optional[str]:
+    """
+    Удаляет хранилище пользователя для слота ассистента (вместе с тредом).
+    Если удалить в OpenAI не удалось, хранилище уберёт janitor.
+    """
+    vector_store_id = await _forget_store(user_id, slot)
+    if vector_store_id is None:
+        return None
+
+    _stats["dropped"] += 1
+    try:
+        await get_async_openai_client().vector_stores.delete(vector_store_id)
+        await mark_deleted(vector_store_id)
+        logging.info(f"Векторное хранилище {vector_store_id} удалено")
+    except Exception as e:
+        logging.warning(
+            f"Не удалось удалить векторное хранилище {vector_store_id}: {e}"
+        )
+    return vector_store_id
+
+
+def vector_store_stats() -> dict:
+    """Счётчики хранилищ: создано, проиндексировано, пропущено повторов, истекло"""
+    return dict(_stats)